@@ -0,0 +1,150 @@
+import gc
+import os
+from celery.signals import task_postrun, task_prerun, worker_init, worker_process_init, worker_process_shutdown
+from src.config.settings import get_settings
+from src.utils.processMemory import current_rss_mb, current_uss_mb, peak_rss_mb
+from src.utils.threadBudget import apply_env_budget, apply_thread_budget, compute_thread_budget
+
+settings = get_settings()
+
+# Models never loaded in the prefork parent: TensorFlow (ResNet50) keeps runtime threads and
+# session state that do not survive fork(), so each child loads it on first use instead.
+FORK_UNSAFE_MODELS = ('duplicate_image_detection_model',)
+
+# Thread budget of the pool processes, computed in the parent at worker start
+_pool_budget = None
+# Whether the pool replaces its children, only prefork children can be recycled
+_prefork_pool = False
+# RSS (MB) of the prefork parent once the models are loaded, every child starts with these pages shared
+_fork_baseline_rss = 0.0
+# RSS (MB) of this process when each running task started, and the tasks it has finished
+_rss_at_start = {}
+_tasks_done = 0
+
+
+def preforked_models(settings) -> list:
+    """Models of this worker's roles that are safe to load before the pool forks."""
+    from src.dependencies.mlModelsManager import ModelManager
+
+    unsafe = set(FORK_UNSAFE_MODELS)
+    if settings.INFERENCE_BACKEND == 'onnx':
+        # ONNX Runtime sessions own thread pools too, they are created in the children
+        from src.dependencies.onnxBackend import ONNX_MODEL_KEYS
+        unsafe.update(ONNX_MODEL_KEYS)
+    roles = ModelManager.process_roles(settings) or ['all']
+    return [name for name in ModelManager.models_for_roles(roles) if name not in unsafe]
+
+
+def uses_prefork_pool(worker) -> bool:
+    pool_cls = getattr(worker, 'pool_cls', '')
+    name = pool_cls if isinstance(pool_cls, str) else getattr(pool_cls, '__module__', '')
+    return 'prefork' in name
+
+
+def worker_thread_budget(worker) -> dict:
+    """Thread budget of one pool process, the node's cores split between the pool's processes."""
+    processes = 1
+    if uses_prefork_pool(worker):
+        processes = getattr(worker, 'concurrency', None) or settings.CELERY_WORKER_CONCURRENCY
+    return compute_thread_budget(processes, threads_per_process=settings.WORKER_THREADS_PER_PROCESS)
+
+
+@worker_init.connect
+def preload_models_before_fork(sender=None, **kwargs):
+    """
+    Loads the worker's models once in the parent process, before the prefork pool starts.
+
+    The children then share the weight pages copy-on-write instead of each loading its own
+    copy, and children recycled by worker_max_tasks_per_child start with the models in place.
+    A solo pool never forks, it applies its thread budget and loads every model of its roles up front.
+    """
+    global _pool_budget, _prefork_pool, _fork_baseline_rss
+    _pool_budget = worker_thread_budget(sender)
+    prefork = _prefork_pool = uses_prefork_pool(sender)
+    if prefork:
+        # inherited by the children, the libraries themselves are configured in each child
+        apply_env_budget(_pool_budget)
+    else:
+        apply_thread_budget(_pool_budget)
+
+    if not settings.CELERY_PRELOAD_MODELS:
+        return
+    from src.dependencies.mlModelsManager import ModelManager
+
+    if not prefork:
+        ModelManager.preload(ModelManager.process_roles(settings) or ['all'], settings)
+        return
+
+    import torch
+    # no intra-op pool in the parent, a forked OpenMP pool can deadlock the children
+    torch.set_num_threads(1)
+    for name in preforked_models(settings):
+        ModelManager.get_model(name, settings)
+    print(f"Preloaded models before fork: {ModelManager.load_times()}")
+
+    # move everything allocated so far out of the collector's reach, otherwise the first
+    # collection in every child touches (and copies) the pages holding the model objects
+    gc.freeze()
+
+    # the pool compares a child's peak RSS, which counts the shared model pages, with its limit,
+    # the ceiling applies to what a child adds on top of them
+    _fork_baseline_rss = current_rss_mb()
+    ceiling = settings.CELERY_MAX_MEMORY_PER_CHILD_MB
+    if ceiling and hasattr(sender, 'max_memory_per_child'):
+        sender.max_memory_per_child = int((ceiling + _fork_baseline_rss) * 1024) # in KiB
+        print(f"Children share {_fork_baseline_rss:.0f} MB with the parent, recycling them above {ceiling + _fork_baseline_rss:.0f} MB RSS")
+
+
+@worker_process_init.connect
+def reinitialize_child(**kwargs):
+    """Recreates the per-process state a forked child must not share with its parent."""
+    apply_thread_budget(_pool_budget or compute_thread_budget(settings.CELERY_WORKER_CONCURRENCY, threads_per_process=settings.WORKER_THREADS_PER_PROCESS))
+
+    # pooled database connections belong to the parent, the child opens its own
+    from src.config.syncDatabase import sync_engine
+    sync_engine.dispose(close=False)
+
+
+def recycle_reason(peak_rss:float, tasks_done:int, shared_rss:float=0.0):
+    """
+    Why the pool replaces this child after its current task, None when it keeps it. The memory
+    ceiling applies to the child's own growth, its peak RSS minus the `shared_rss` it inherited
+    from the parent at fork.
+    """
+    ceiling = settings.CELERY_MAX_MEMORY_PER_CHILD_MB
+    growth = peak_rss - shared_rss
+    if ceiling and growth > ceiling:
+        return f"peak RSS {peak_rss:.0f} MB is {growth:.0f} MB above the {shared_rss:.0f} MB shared at fork, over the {ceiling:.0f} MB ceiling"
+    if settings.CELERY_MAX_TASKS_PER_CHILD and tasks_done >= settings.CELERY_MAX_TASKS_PER_CHILD:
+        return f"reached the limit of {settings.CELERY_MAX_TASKS_PER_CHILD} tasks"
+    return None
+
+
+@task_prerun.connect
+def record_task_memory(task_id=None, **kwargs):
+    _rss_at_start[task_id] = current_rss_mb()
+
+
+@task_postrun.connect
+def log_task_memory(task_id=None, task=None, **kwargs):
+    """Logs how much each task grew the process, and whether that gets the child recycled."""
+    global _tasks_done
+    _tasks_done += 1
+    rss = current_rss_mb()
+    peak_rss = peak_rss_mb()
+    growth = rss - _rss_at_start.pop(task_id, rss)
+    task_name = getattr(task, 'name', task_id)
+    print(f"Task {task_name} finished in pid {os.getpid()}: RSS {rss:.0f} MB ({growth:+.0f} MB), USS {current_uss_mb():.0f} MB, peak {peak_rss:.0f} MB")
+
+    reason = recycle_reason(peak_rss, _tasks_done, _fork_baseline_rss if _prefork_pool else 0.0)
+    if reason is None:
+        return
+    if _prefork_pool:
+        print(f"Recycling worker child {os.getpid()} after {task_name}: {reason} (RSS {rss:.0f} MB, {_tasks_done} tasks)")
+    else:
+        print(f"Worker {os.getpid()}: {reason}, a non prefork pool can't recycle its process, restart the worker to release the memory")
+
+
+@worker_process_shutdown.connect
+def log_child_exit(pid=None, exitcode=None, **kwargs):
+    print(f"Worker child {pid or os.getpid()} exiting (code {exitcode}) after {_tasks_done} tasks, RSS {current_rss_mb():.0f} MB, peak {peak_rss_mb():.0f} MB")
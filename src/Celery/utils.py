@@ -27,7 +27,11 @@ def create_celery():
     # celery_app.conf.update(redis_socket_timeout=43200) # Set to 12 hours for long-running tasks
     # celery_app.conf.update(redis_socket_keepalive=True)  # Keep the Redis connection alive
     # Worker-related settings
-    celery_app.conf.update(worker_max_tasks_per_child=10) # will retart after 10 task so if any task won't let the resource free it will help in that case
+    # Children are recycled when their memory crosses the ceiling (checked after every task), not after a fixed
+    # number of tasks, so the loaded models survive small tasks. A task count limit stays available, 0 disables it.
+    # Once the models are preloaded the limit is raised by what the children share with the parent (src/Celery/signals.py).
+    celery_app.conf.update(worker_max_memory_per_child=int(settings.CELERY_MAX_MEMORY_PER_CHILD_MB * 1024) or None) # in KiB
+    celery_app.conf.update(worker_max_tasks_per_child=settings.CELERY_MAX_TASKS_PER_CHILD or None)
     celery_app.conf.update(worker_concurrency=settings.CELERY_WORKER_CONCURRENCY) # 4 task can run at same time
     
     # Broker transport options for visibility timeout
@@ -44,6 +48,8 @@ def create_celery():
     celery_app.conf.update(worker_send_task_events=False)
     celery_app.conf.update(broker_connection_retry_on_startup=True)
     celery_app.conf.update(imports=['src.services.SmartShare.tasks','src.services.Culling.tasks'])
+    # connects the worker_init / worker_process_init handlers (model preload before fork)
+    import src.Celery.signals  # noqa: F401
     # celery_app.conf.update(imports=['src.Celery.tasks'])
 
     return celery_app
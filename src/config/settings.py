@@ -6,6 +6,9 @@ from pathlib import Path
 import os
 from urllib.parse import quote_plus
 
+# Repository root, relative data directories are resolved against it instead of the working directory
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+
 env_path = Path(".") / ".env"
 load_dotenv(dotenv_path=env_path)
 
@@ -90,13 +93,27 @@ class Settings(BaseSettings):
     AWS_BUCKET_SMART_SHARE_NAME: str = os.environ.get('AWS_BUCKET_SMART_SHARE_NAME',None)
     PRESIGNED_URL_EXPIRY_SEC:int = os.environ.get('PRESIGNED_URL_EXPIRY_SEC',1800)
     AWS_ENDPOINT_URL:str = os.environ.get('AWS_ENDPOINT_URL',None)
+    # Workers fetch images of their own buckets by key with the S3 client instead of their presigned URLs
+    S3_KEY_DOWNLOADS_ENABLED:bool = os.environ.get('S3_KEY_DOWNLOADS_ENABLED', 'true').lower() == 'true'
+    # Objects downloaded at the same time by one task
+    S3_DOWNLOAD_CONCURRENCY:int = int(os.environ.get('S3_DOWNLOAD_CONCURRENCY', 16))
+    # Minimum seconds between two download progress updates of a task
+    S3_DOWNLOAD_PROGRESS_INTERVAL_SEC:float = float(os.environ.get('S3_DOWNLOAD_PROGRESS_INTERVAL_SEC', 1.0))
+    # Image bytes a streaming task keeps in memory, images fetched beyond it are spilled to local disk
+    STREAMING_MEMORY_BUDGET_MB:float = float(os.environ.get('STREAMING_MEMORY_BUDGET_MB', 1024))
+    # Images a streaming task fetches ahead of its detectors
+    STREAMING_QUEUE_SIZE:int = int(os.environ.get('STREAMING_QUEUE_SIZE', 32))
+    # Smart share publishing streams the event images from S3 into face detection instead of downloading them first
+    SMART_SHARE_STREAMING_ENABLED:bool = os.environ.get('SMART_SHARE_STREAMING_ENABLED', 'false').lower() == 'true'
   
     #AWS FOLDERS
     IMAGES_BEFORE_CULLING_STARTS_Folder:str = os.environ.get("IMAGES_BEFORE_CULLING_STARTS_Folder",None)
     BLUR_FOLDER:str = os.environ.get("BLUR_FOLDER",None)
     CLOSED_EYE_FOLDER:str = os.environ.get("CLOSED_EYE_FOLDER",None)
     DUPLICATE_FOLDER:str = os.environ.get("DUPLICATE_FOLDER",None)
-    FINE_COLLECTION_FOLDER: str = os.environ.get("FINE_COLLECTION_FOLDER",None) 
+    FINE_COLLECTION_FOLDER: str = os.environ.get("FINE_COLLECTION_FOLDER",None)
+    # 'upload' re-uploads the culled images from the worker, 'copy' copies the original pre-cull objects server side (same bucket)
+    CULLING_RESULT_MODE:str = os.environ.get("CULLING_RESULT_MODE", "upload").lower()
 
     #Google OAuth CREDENTIALS
     CLIENT_ID: str = os.environ.get("CLIENT_ID",None)
@@ -125,11 +142,101 @@ class Settings(BaseSettings):
     #Threshold value for duplicate image detection
     BLUR_IMAGE_THRESHOLD:float = os.environ.get('BLUR_IMAGE_THRESHOLD',None)
 
+    #CULLING PIPELINE
+    # Number of images decoded and classified together in one blur model forward pass
+    BLUR_BATCH_SIZE:int = int(os.environ.get('BLUR_BATCH_SIZE', 16))
+    # Number of face crops (collected across images) classified together by the closed eye model, 1 classifies face by face
+    CLOSED_EYE_FACE_BATCH_SIZE:int = int(os.environ.get('CLOSED_EYE_FACE_BATCH_SIZE', 32))
+    # Number of preprocessed images stacked into one ResNet50 feature extraction call
+    DUPLICATE_FEATURE_BATCH_SIZE:int = int(os.environ.get('DUPLICATE_FEATURE_BATCH_SIZE', 32))
+    # Peak memory (in MB) a single tile of the duplicate similarity matrix may use
+    DUPLICATE_SIMILARITY_MAX_BLOCK_MB:float = float(os.environ.get('DUPLICATE_SIMILARITY_MAX_BLOCK_MB', 64))
+    # Folders with at least this many images use the approximate (hnswlib) duplicate search, 0 disables it
+    DUPLICATE_ANN_MIN_IMAGES:int = int(os.environ.get('DUPLICATE_ANN_MIN_IMAGES', 5000))
+    # Nearest neighbours looked up per image and HNSW search breadth for the approximate duplicate search
+    DUPLICATE_ANN_NEIGHBOURS:int = int(os.environ.get('DUPLICATE_ANN_NEIGHBOURS', 32))
+    DUPLICATE_ANN_EF:int = int(os.environ.get('DUPLICATE_ANN_EF', 64))
+    # Only compare shots taken within this many seconds of each other (EXIF DateTimeOriginal), 0 compares all pairs
+    DUPLICATE_TIME_WINDOW_SEC:float = float(os.environ.get('DUPLICATE_TIME_WINDOW_SEC', 0))
+    # Additionally restrict burst comparisons to shots from the same camera body
+    DUPLICATE_SAME_CAMERA_ONLY:bool = os.environ.get('DUPLICATE_SAME_CAMERA_ONLY', 'false').lower() == 'true'
+    # Images without capture time are compared with the whole folder, otherwise only with their file order neighbours
+    DUPLICATE_UNTIMED_FULL_SCAN:bool = os.environ.get('DUPLICATE_UNTIMED_FULL_SCAN', 'true').lower() == 'true'
+    DUPLICATE_FILE_ORDER_WINDOW:int = int(os.environ.get('DUPLICATE_FILE_ORDER_WINDOW', 20))
+    # SHA-256 + dHash prefilter marking exact and near-exact copies as duplicates without a ResNet50 pass
+    DUPLICATE_HASH_PREFILTER:bool = os.environ.get('DUPLICATE_HASH_PREFILTER', 'true').lower() == 'true'
+    # Largest dHash Hamming distance (out of 64 bits) still treated as the same picture
+    DUPLICATE_HASH_MAX_DISTANCE:int = int(os.environ.get('DUPLICATE_HASH_MAX_DISTANCE', 3))
+    # Laplacian variance pre-screen in front of the blur model, scores below/above the band are decided without the model
+    BLUR_CASCADE_ENABLED:bool = os.environ.get('BLUR_CASCADE_ENABLED', 'false').lower() == 'true'
+    BLUR_CASCADE_BLURRED_BELOW:float = float(os.environ.get('BLUR_CASCADE_BLURRED_BELOW', 30.0))
+    BLUR_CASCADE_SHARP_ABOVE:float = float(os.environ.get('BLUR_CASCADE_SHARP_ABOVE', 600.0))
+    BLUR_CASCADE_MAX_SIDE:int = int(os.environ.get('BLUR_CASCADE_MAX_SIDE', 512))
+    # Shorter side (px) each model input is decoded at, JPEGs are scaled in the DCT domain while decoding, 0 = full resolution
+    BLUR_DECODE_MIN_SIDE:int = int(os.environ.get('BLUR_DECODE_MIN_SIDE', 448))
+    FACE_DETECTION_DECODE_MIN_SIDE:int = int(os.environ.get('FACE_DETECTION_DECODE_MIN_SIDE', 960))
+    # Eye classifier crops are cut from the full resolution image, faces are still detected on the reduced decode
+    CLOSED_EYE_FULL_RESOLUTION_CROPS:bool = os.environ.get('CLOSED_EYE_FULL_RESOLUTION_CROPS', 'true').lower() == 'true'
+    DUPLICATE_DECODE_MIN_SIDE:int = int(os.environ.get('DUPLICATE_DECODE_MIN_SIDE', 224))
+    # Content addressed cache of model outputs (blur logits, eye predictions, ResNet features, FaceNet embeddings)
+    INFERENCE_CACHE_ENABLED:bool = os.environ.get('INFERENCE_CACHE_ENABLED', 'false').lower() == 'true'
+    INFERENCE_CACHE_PATH:str = os.environ.get('INFERENCE_CACHE_PATH', '/app/.cache/inference/inference_cache.sqlite3')
+    INFERENCE_CACHE_MAX_MB:float = float(os.environ.get('INFERENCE_CACHE_MAX_MB', 2048))
+    # Duplicate embedding: 'resnet' (TensorFlow ResNet50) or 'vit' (CLS token of the blur pass, TensorFlow is never loaded)
+    DUPLICATE_EMBEDDING_SOURCE:str = os.environ.get('DUPLICATE_EMBEDDING_SOURCE', 'resnet').lower()
+    # Cosine similarity above which two ViT CLS embeddings are duplicates
+    DUPLICATE_VIT_THRESHOLD:float = float(os.environ.get('DUPLICATE_VIT_THRESHOLD', 0.92))
+    # 'torch' runs the eager models, 'onnx' exports ViTs, CLIP and FaceNet to ONNX Runtime (MTCNN and ResNet50 stay eager)
+    INFERENCE_BACKEND:str = os.environ.get('INFERENCE_BACKEND', 'torch').lower()
+    ONNX_MODEL_DIR:str = os.environ.get('ONNX_MODEL_DIR', os.path.join(os.environ.get("HF_HOME", "/app/.cache/huggingface"), 'onnx'))
+    # dynamic int8 weight quantization of the exported graphs
+    ONNX_QUANTIZE:bool = os.environ.get('ONNX_QUANTIZE', 'true').lower() == 'true'
+    # 0 = the worker's thread budget, or the ONNX Runtime default of one thread per core outside workers
+    ONNX_INTRA_OP_THREADS:int = int(os.environ.get('ONNX_INTRA_OP_THREADS', 0))
+    # compare every ONNX model with its eager version at load time and keep the eager one if they disagree
+    ONNX_PARITY_CHECK:bool = os.environ.get('ONNX_PARITY_CHECK', 'true').lower() == 'true'
+    ONNX_PARITY_MIN_AGREEMENT:float = float(os.environ.get('ONNX_PARITY_MIN_AGREEMENT', 0.9))
+    # folder of sample photos the parity check runs on, random noise is used when it is unset or empty
+    ONNX_PARITY_SAMPLE_DIR:str = os.environ.get('ONNX_PARITY_SAMPLE_DIR', '')
+    # Comma separated roles of this process (api, culling, smart_sharing, email or all), decides which models are preloaded, an unknown role falls back to all
+    PROCESS_ROLE:str = os.environ.get('PROCESS_ROLE', '')
+    # safetensors snapshots of the from_tf ViT checkpoints, converted once and memory mapped on later starts
+    MODEL_SNAPSHOT_ENABLED:bool = os.environ.get('MODEL_SNAPSHOT_ENABLED', 'true').lower() == 'true'
+    MODEL_SNAPSHOT_DIR:str = os.environ.get('MODEL_SNAPSHOT_DIR', os.path.join(os.environ.get("HF_HOME", "/app/.cache/huggingface"), 'safetensors'))
+    # 'staged' runs blur, closed eye and duplicate as separate chained tasks, 'fused' decodes every image once in a single task,
+    # 'sharded' runs the fused pass on shards of the folder in parallel (Celery chord) and merges them for the duplicate search,
+    # 'streaming' runs the fused pass on images streamed from S3 in memory instead of downloading the folder to disk first
+    CULLING_PIPELINE_MODE:str = os.environ.get('CULLING_PIPELINE_MODE', 'staged').lower()
+    # Images per shard in the 'sharded' pipeline mode
+    CULLING_SHARD_SIZE:int = int(os.environ.get('CULLING_SHARD_SIZE', 500))
+    # Per job JSONL manifests of the images every stage finished, a retried stage resumes instead of re-uploading
+    CULLING_CHECKPOINT_ENABLED:bool = os.environ.get('CULLING_CHECKPOINT_ENABLED', 'true').lower() == 'true'
+    CULLING_CHECKPOINT_DIR:str = str(PROJECT_ROOT / os.environ.get('CULLING_CHECKPOINT_DIR', os.path.join("src", "services", "Culling", "Culling_Folders_Data", "checkpoints")))
+    # Checkpoints of jobs that failed or were abandoned are removed once no stage wrote to them for this many seconds
+    CULLING_CHECKPOINT_TTL_SEC:int = int(os.environ.get('CULLING_CHECKPOINT_TTL_SEC', 7 * 24 * 3600))
+
     #CELERY VARIABLES
     CELERY_BROKER_URL:str = os.environ.get("CELERY_BROKER_URL",None)
+    # Where tasks keep the payloads they hand to each other, only a reference goes through the broker:
+    # 'none' (inline in the messages), 'file' (JOB_MANIFEST_DIR must be a volume shared by the API and every worker),
+    # 'redis' (workers on several nodes) or 'memory' (a single process only, the API can't hand a reference to a worker)
+    JOB_MANIFEST_BACKEND:str = os.environ.get("JOB_MANIFEST_BACKEND", "none").lower()
+    JOB_MANIFEST_DIR:str = str(PROJECT_ROOT / os.environ.get("JOB_MANIFEST_DIR", os.path.join(".cache", "job_manifests")))
+    JOB_MANIFEST_REDIS_URL:str = os.environ.get("JOB_MANIFEST_REDIS_URL", CELERY_BROKER_URL)
+    # File and Redis manifests of jobs that never finished are removed after this many seconds
+    JOB_MANIFEST_TTL_SEC:int = int(os.environ.get("JOB_MANIFEST_TTL_SEC", 7 * 24 * 3600))
     CELERY_RESULT_BACKEND_URL:str = f"db+{SYNC_DATABASE_URI}"
     CELERY_WORKER_CONCURRENCY :int = os.environ.get("WORKER_CONCURRENCY",1)
     CELERY_WORKING_ENV_CONFIG:str = os.environ.get("CELERY_WORKING_ENV_CONFIG","development")
+    # Intra-op threads every worker process gives torch, TensorFlow, OpenCV and BLAS, 0 splits the cores evenly between the pool processes
+    WORKER_THREADS_PER_PROCESS:int = int(os.environ.get("WORKER_THREADS_PER_PROCESS", 0))
+    # Memory (MB) a prefork child may add on top of the model pages it shares with the parent before it is replaced,
+    # 0 disables memory based recycling
+    CELERY_MAX_MEMORY_PER_CHILD_MB:float = float(os.environ.get("CELERY_MAX_MEMORY_PER_CHILD_MB", 6144))
+    # Replace a child after this many tasks regardless of its memory, 0 = no limit
+    CELERY_MAX_TASKS_PER_CHILD:int = int(os.environ.get("CELERY_MAX_TASKS_PER_CHILD", 0))
+    # Load the worker's models in the parent process before the prefork pool forks its children
+    CELERY_PRELOAD_MODELS:bool = os.environ.get("CELERY_PRELOAD_MODELS", "true").lower() == "true"
 
 
 @lru_cache()
@@ -1,68 +1,241 @@
 import os
-from transformers import ViTForImageClassification, ViTFeatureExtractor, CLIPImageProcessor, CLIPModel
-from tensorflow.keras.applications import ResNet50 # type: ignore
-from facenet_pytorch import MTCNN, InceptionResnetV1
+import re
+import shutil
+import threading
+import time
+from collections.abc import Mapping
 import torch
+from src.config.settings import get_settings
+
+# Models every process role needs, anything else is still loaded on first access but never preloaded.
+# The 'all' role stands for every model.
+MODEL_ROLES = {
+    'api': ('face_detector', 'face_net_model'),
+    'culling': ('feature_extractor', 'blur_detect_model', 'closed_eye_detection_model', 'face_detector', 'duplicate_image_detection_model'),
+    'smart_sharing': ('face_detector', 'face_net_model'),
+    'email': (),
+}
+
+
+def load_feature_extractor(settings):
+    from transformers import ViTFeatureExtractor
+    return ViTFeatureExtractor.from_pretrained(
+        settings.FEATURE_EXTRACTOR,
+        cache_dir=settings.HF_HOME
+    )
+
+
+def snapshot_path(checkpoint:str, snapshot_dir:str) -> str:
+    """Directory of the safetensors snapshot of a checkpoint, one per checkpoint name."""
+    return os.path.join(snapshot_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', checkpoint))
+
+
+def load_vit_classifier(checkpoint:str, settings):
+    """
+    Loads a ViT classifier published as a TensorFlow checkpoint.
+
+    The TF -> PyTorch conversion of `from_tf=True` runs on every start and needs TensorFlow, so the
+    converted weights are saved once as a safetensors snapshot under MODEL_SNAPSHOT_DIR and later
+    starts load (memory map) that snapshot instead. The snapshot is written to a temporary directory
+    and renamed into place, so workers starting together never read a half written one.
+    """
+    from transformers import ViTForImageClassification
+
+    target_dir = snapshot_path(checkpoint, settings.MODEL_SNAPSHOT_DIR)
+    if settings.MODEL_SNAPSHOT_ENABLED and os.path.exists(os.path.join(target_dir, 'model.safetensors')):
+        try:
+            model = ViTForImageClassification.from_pretrained(target_dir, use_safetensors=True)
+            # keep the checkpoint name, the ONNX export file names are derived from it
+            model.config._name_or_path = checkpoint
+            return model.to(ModelManager.device)
+        except Exception as e:
+            print(f"Snapshot of {checkpoint} could not be loaded, converting the checkpoint again: {str(e)}")
+            shutil.rmtree(target_dir, ignore_errors=True)
+
+    model = ViTForImageClassification.from_pretrained(
+        checkpoint,
+        from_tf=True,
+        use_auth_token=settings.HUGGINGFACE_TOKEN,
+        cache_dir=settings.HF_HOME
+    )
+
+    if settings.MODEL_SNAPSHOT_ENABLED:
+        tmp_dir = f"{target_dir}.{os.getpid()}.tmp"
+        try:
+            model.save_pretrained(tmp_dir, safe_serialization=True)
+            if os.path.exists(os.path.join(target_dir, 'model.safetensors')):
+                # another worker finished its snapshot first, keep that one
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            else:
+                os.replace(tmp_dir, target_dir)
+                print(f"Saved safetensors snapshot of {checkpoint} to {target_dir}")
+        except OSError as e:
+            print(f"Could not save the safetensors snapshot of {checkpoint}: {str(e)}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return model.to(ModelManager.device)
+
+
+def load_blur_detect_model(settings):
+    return load_vit_classifier(settings.BLUR_IMAGE_DETECTION_MODEL, settings)
+
+
+def load_closed_eye_detection_model(settings):
+    return load_vit_classifier(settings.CLOSED_EYE_DETECTION_MODEL, settings)
+
+
+def load_duplicate_image_detection_model(settings):
+    if settings.DUPLICATE_EMBEDDING_SOURCE == 'vit':
+        return None
+    # TensorFlow is only imported when ResNet50 embeddings are used
+    from tensorflow.keras.applications import ResNet50 # type: ignore
+    return ResNet50(weights='imagenet', include_top=False, pooling='avg')
+
+
+def load_embedding_img_processor(settings):
+    from transformers import CLIPImageProcessor
+    return CLIPImageProcessor.from_pretrained(
+        settings.FACE_EMBEDDING_GENERATOR_MODEL,
+        cache_dir=settings.HF_HOME
+    )
+
+
+def load_embedding_model(settings):
+    from transformers import CLIPModel
+    return CLIPModel.from_pretrained(
+        settings.FACE_EMBEDDING_GENERATOR_MODEL,
+        cache_dir=settings.HF_HOME
+    ).to(ModelManager.device)
+
+
+def load_face_detector(settings):
+    from facenet_pytorch import MTCNN
+    return MTCNN(keep_all=True)
+
+
+def load_face_net_model(settings):
+    from facenet_pytorch import InceptionResnetV1
+    return InceptionResnetV1(pretrained='vggface2').eval()
+
+
+MODEL_LOADERS = {
+    "blur_detect_model": load_blur_detect_model,
+    "feature_extractor": load_feature_extractor,
+    "closed_eye_detection_model": load_closed_eye_detection_model,
+    "duplicate_image_detection_model": load_duplicate_image_detection_model,
+    "embedding_img_processor": load_embedding_img_processor,
+    "embedding_model": load_embedding_model,
+    "face_detector": load_face_detector,
+    "face_net_model": load_face_net_model,
+}
+
+
+class LazyModels(Mapping):
+    """Read-only `models['name']` view that loads each model on first access."""
+
+    def __init__(self, settings=None):
+        self.settings = settings
+
+    def __getitem__(self, name):
+        if name not in MODEL_LOADERS:
+            raise KeyError(name)
+        return ModelManager.get_model(name, self.settings)
+
+    def __iter__(self):
+        return iter(MODEL_LOADERS)
+
+    def __len__(self):
+        return len(MODEL_LOADERS)
+
 
 class ModelManager:
-    _models = None
+    _models = {}
+    _load_times = {}
+    _warned_roles = set()
+    _lock = threading.RLock()
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     @staticmethod
-    def get_models(settings):
-        if ModelManager._models is None:
-            ModelManager._models = ModelManager.initialize_models(settings=settings)
-        return ModelManager._models
+    def get_model(name:str, settings=None):
+        """Returns a model, loading it the first time any caller in this process asks for it."""
+        if name in ModelManager._models:
+            return ModelManager._models[name]
+
+        settings = settings or get_settings()
+        with ModelManager._lock:
+            if name not in ModelManager._models:
+                roles = ModelManager.process_roles(settings)
+                if roles and name not in ModelManager.models_for_roles(roles):
+                    print(f"Model {name} is not declared for process role {','.join(roles)}, loading it anyway")
+
+                start_time = time.time()
+                try:
+                    model = MODEL_LOADERS[name](settings)
+                    if model is not None and settings.INFERENCE_BACKEND == 'onnx':
+                        # onnxruntime is only imported when the ONNX backend is selected
+                        from src.dependencies.onnxBackend import convert_models
+                        model = convert_models({name: model}, settings)[name]
+                except Exception as e:
+                    print(f"Error loading model {name}: {str(e)}")
+                    raise
+                ModelManager._models[name] = model
+                ModelManager._load_times[name] = round(time.time() - start_time, 2)
+                print(f"Loaded {name} in {ModelManager._load_times[name]}s (pid {os.getpid()})")
+        return ModelManager._models[name]
 
     @staticmethod
-    def initialize_models(settings):
+    def get_models(settings=None):
+        """Lazy mapping of every model, kept for the `models['name']` call sites."""
+        return LazyModels(settings)
 
-        try:
-            feature_extractor = ViTFeatureExtractor.from_pretrained(
-                settings.FEATURE_EXTRACTOR,
-                cache_dir=settings.HF_HOME
-            )
-
-            blur_detect_model = ViTForImageClassification.from_pretrained(
-                settings.BLUR_IMAGE_DETECTION_MODEL,
-                from_tf=True,
-                use_auth_token=settings.HUGGINGFACE_TOKEN,
-                cache_dir=settings.HF_HOME
-            ).to(ModelManager.device)
-
-            closed_eye_detection_model = ViTForImageClassification.from_pretrained(
-                settings.CLOSED_EYE_DETECTION_MODEL,
-                from_tf=True,
-                use_auth_token=settings.HUGGINGFACE_TOKEN,
-                cache_dir=settings.HF_HOME
-            ).to(ModelManager.device)
-
-            duplicate_image_detection_model = ResNet50(weights='imagenet', include_top=False, pooling='avg')
-
-            embedding_img_processor = CLIPImageProcessor.from_pretrained(
-                settings.FACE_EMBEDDING_GENERATOR_MODEL,
-                cache_dir=settings.HF_HOME
-            )
-
-            embedding_model = CLIPModel.from_pretrained(
-                settings.FACE_EMBEDDING_GENERATOR_MODEL,
-                cache_dir=settings.HF_HOME
-            ).to(ModelManager.device)
-
-            face_detector = MTCNN(keep_all=True)
-
-            face_net_model = InceptionResnetV1(pretrained='vggface2').eval()
-
-            return {
-                "blur_detect_model": blur_detect_model,
-                "feature_extractor": feature_extractor,
-                "closed_eye_detection_model": closed_eye_detection_model,
-                "duplicate_image_detection_model": duplicate_image_detection_model,
-                "embedding_img_processor": embedding_img_processor,
-                "embedding_model": embedding_model,
-                "face_detector": face_detector,
-                "face_net_model": face_net_model
-            }
-        except Exception as e:
-            print(f"Error loading models: {str(e)}")
-            raise
+    @staticmethod
+    def process_roles(settings=None) -> list:
+        """Roles of the current process from PROCESS_ROLE (comma separated), empty when undeclared."""
+        settings = settings or get_settings()
+        roles = [role.strip() for role in (settings.PROCESS_ROLE or '').split(',') if role.strip()]
+        unknown = [role for role in roles if role != 'all' and role not in MODEL_ROLES]
+        if unknown:
+            # a typo in PROCESS_ROLE must not fail every model load, the process serves every model instead
+            if settings.PROCESS_ROLE not in ModelManager._warned_roles:
+                ModelManager._warned_roles.add(settings.PROCESS_ROLE)
+                print(f"Unknown PROCESS_ROLE {', '.join(unknown)}, expected any of {', '.join(MODEL_ROLES)} or all, falling back to all")
+            return ['all']
+        return roles
+
+    @staticmethod
+    def models_for_roles(roles) -> list:
+        """Model names declared by the given roles, in load order and without duplicates."""
+        if isinstance(roles, str):
+            roles = [roles]
+        names = []
+        for role in roles:
+            if role == 'all':
+                return list(MODEL_LOADERS)
+            if role not in MODEL_ROLES:
+                raise ValueError(f"Unknown process role {role}, expected one of {', '.join(MODEL_ROLES)}")
+            names.extend(name for name in MODEL_ROLES[role] if name not in names)
+        return names
+
+    @staticmethod
+    def preload(roles=None, settings=None) -> dict:
+        """
+        Loads every model the roles declare, by default the roles of this process.
+
+        Returns:
+            dict: model name -> load time in seconds for the models of these roles.
+        """
+        settings = settings or get_settings()
+        roles = roles if roles is not None else ModelManager.process_roles(settings)
+        for name in ModelManager.models_for_roles(roles):
+            ModelManager.get_model(name, settings)
+        return {name: ModelManager._load_times.get(name, 0.0) for name in ModelManager.models_for_roles(roles)}
+
+    @staticmethod
+    def load_times() -> dict:
+        """Seconds each model loaded in this process took."""
+        return dict(ModelManager._load_times)
+
+    @staticmethod
+    def initialize_models(settings):
+        """Eagerly loads every model, for processes that really need all of them."""
+        return {name: ModelManager.get_model(name, settings) for name in MODEL_LOADERS}
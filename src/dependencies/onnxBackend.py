@@ -0,0 +1,287 @@
+import importlib.util
+import logging
+import os
+import re
+import time
+import numpy as np
+import torch
+from src.utils.threadBudget import current_thread_budget
+
+logger = logging.getLogger(__name__)
+
+# Packages of the `onnx` extra (poetry install --extras onnx), the backend falls back to eager without them
+ONNX_PACKAGES = ('onnx', 'onnxruntime')
+
+# Models served through ONNX Runtime when INFERENCE_BACKEND=onnx. MTCNN stays eager: its image
+# pyramid and per-stage NMS are data dependent and don't export to a single static graph, and
+# ResNet50 is a TensorFlow model that torch.onnx can't export.
+ONNX_MODEL_KEYS = ('blur_detect_model', 'closed_eye_detection_model', 'embedding_model', 'face_net_model')
+
+
+class OnnxClassifierOutput:
+    """Mimics the HF `ImageClassifierOutput` fields the call sites read."""
+
+    def __init__(self, logits, cls_embedding=None):
+        self.logits = logits
+        self.cls_embedding = cls_embedding
+        # the last hidden state isn't exported, only its normalised CLS token
+        self.hidden_states = None
+
+
+class ViTExportWrapper(torch.nn.Module):
+    """Exports logits together with the layer-normalised CLS token the classifier head reads."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        outputs = self.model(pixel_values=pixel_values, output_hidden_states=True)
+        return outputs.logits, self.model.vit.layernorm(outputs.hidden_states[-1])[:, 0]
+
+
+class CLIPImageExportWrapper(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values)
+
+
+class OnnxModelAdapter:
+    """Base adapter, an ONNX Runtime session with the attributes the eager call sites rely on."""
+
+    device = torch.device('cpu')
+
+    def __init__(self, session, name:str, quantized:bool=False):
+        self.session = session
+        self.name = name
+        self.quantized = quantized
+        self.input_name = session.get_inputs()[0].name
+
+    @property
+    def backend_tag(self) -> str:
+        """Inference cache tag of the outputs of this graph."""
+        return 'onnx-int8' if self.quantized else 'onnx-fp32'
+
+    def run(self, pixel_values):
+        if isinstance(pixel_values, torch.Tensor):
+            pixel_values = pixel_values.detach().cpu().numpy()
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(pixel_values, dtype=np.float32)})
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def eval(self):
+        return self
+
+
+class OnnxViTClassifier(OnnxModelAdapter):
+    """Drop-in for `ViTForImageClassification` calls: `model(pixel_values=...)`."""
+
+    def __call__(self, pixel_values=None, output_hidden_states=False, **kwargs):
+        logits, cls_embedding = self.run(pixel_values)
+        return OnnxClassifierOutput(
+            logits=torch.from_numpy(logits),
+            cls_embedding=torch.from_numpy(cls_embedding) if output_hidden_states else None
+        )
+
+
+class OnnxCLIPImageEncoder(OnnxModelAdapter):
+    """Drop-in for `CLIPModel.get_image_features`."""
+
+    def get_image_features(self, pixel_values=None, **kwargs):
+        return torch.from_numpy(self.run(pixel_values)[0])
+
+
+class OnnxFaceNet(OnnxModelAdapter):
+    """Drop-in for `InceptionResnetV1(face_batch)`."""
+
+    def __call__(self, faces):
+        return torch.from_numpy(self.run(faces)[0])
+
+
+# name -> (export wrapper, dummy input shape, output names, adapter)
+EXPORT_SPECS = {
+    'blur_detect_model': (ViTExportWrapper, (1, 3, 224, 224), ['logits', 'cls_embedding'], OnnxViTClassifier),
+    'closed_eye_detection_model': (ViTExportWrapper, (1, 3, 224, 224), ['logits', 'cls_embedding'], OnnxViTClassifier),
+    'embedding_model': (CLIPImageExportWrapper, (1, 3, 224, 224), ['image_embeds'], OnnxCLIPImageEncoder),
+    'face_net_model': (lambda model: model, (1, 3, 160, 160), ['embedding'], OnnxFaceNet),
+}
+
+
+def export_model(name:str, model, onnx_dir:str, quantize:bool=False) -> str:
+    """
+    Exports an eager model to ONNX once and returns the path of the file to load.
+
+    The export is written to a temporary file and renamed, so workers starting together never
+    load a half written graph. With `quantize` the fp32 graph is converted with dynamic int8
+    weight quantization, which suits the CPU-only workers.
+    """
+    wrapper, input_shape, output_names, _ = EXPORT_SPECS[name]
+    os.makedirs(onnx_dir, exist_ok=True)
+    # the checkpoint name is part of the file name, so changing a model in settings triggers a new export
+    source = getattr(getattr(model, 'config', None), '_name_or_path', '') or type(model).__name__
+    stem = f"{name}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', source)}"
+    fp32_path = os.path.join(onnx_dir, f"{stem}.onnx")
+    int8_path = os.path.join(onnx_dir, f"{stem}.int8.onnx")
+
+    if not os.path.exists(fp32_path):
+        tmp_path = f"{fp32_path}.{os.getpid()}.tmp"
+        torch.onnx.export(
+            wrapper(model).eval(),
+            torch.zeros(input_shape),
+            tmp_path,
+            input_names=['pixel_values'],
+            output_names=output_names,
+            dynamic_axes={'pixel_values': {0: 'batch'}, **{output: {0: 'batch'} for output in output_names}},
+            opset_version=17,
+        )
+        os.replace(tmp_path, fp32_path)
+
+    if not quantize:
+        return fp32_path
+
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path
+
+
+def create_session(onnx_path:str, intra_op_threads:int=0):
+    """ONNX Runtime CPU session, `intra_op_threads` of 0 keeps the runtime default (one per core)."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.inter_op_num_threads = 1
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    return ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def missing_onnx_packages() -> list:
+    """Packages of the `onnx` extra that are not installed."""
+    return [package for package in ONNX_PACKAGES if importlib.util.find_spec(package) is None]
+
+
+def load_sample_images(sample_dir:str, limit:int=16) -> list:
+    """RGB images of `sample_dir` the parity check runs on, empty when the folder is unset or has none."""
+    from PIL import Image
+
+    if not sample_dir or not os.path.isdir(sample_dir):
+        return []
+    images = []
+    for file_name in sorted(os.listdir(sample_dir)):
+        if len(images) >= limit:
+            break
+        try:
+            with Image.open(os.path.join(sample_dir, file_name)) as image:
+                images.append(image.convert('RGB'))
+        except OSError:
+            continue
+    return images
+
+
+def sample_pixel_values(name:str, images:list) -> torch.Tensor:
+    """Preprocesses sample images the way the call sites feed them to the model."""
+    from src.dependencies.mlModelsManager import ModelManager
+
+    if name == 'embedding_model':
+        return ModelManager.get_model('embedding_img_processor')(images=images, return_tensors='pt')['pixel_values']
+    if name == 'face_net_model':
+        _, input_shape, _, _ = EXPORT_SPECS[name]
+        # facenet_pytorch's fixed_image_standardization, applied to the whole image instead of a face crop
+        faces = np.stack([np.asarray(image.resize(input_shape[2:]), dtype=np.float32) for image in images])
+        return torch.from_numpy((faces - 127.5) / 128.0).permute(0, 3, 1, 2).contiguous()
+    return ModelManager.get_model('feature_extractor')(images=images, return_tensors='pt')['pixel_values']
+
+
+def check_parity(name:str, eager_model, onnx_model, inputs:torch.Tensor=None, batch_size:int=16, seed:int=0) -> dict:
+    """
+    Compares an ONNX adapter against its eager model on the same inputs.
+
+    `inputs` are preprocessed sample images, without them the models are compared on a batch of
+    random noise, which says much less about real photos.
+
+    Returns:
+        dict: max absolute difference of the first output, for classifiers the share of inputs
+        whose predicted class agrees and for embedding models the lowest cosine similarity.
+    """
+    if inputs is None:
+        _, input_shape, _, _ = EXPORT_SPECS[name]
+        generator = torch.Generator().manual_seed(seed)
+        inputs = torch.randn((batch_size, *input_shape[1:]), generator=generator)
+
+    with torch.no_grad():
+        if name == 'embedding_model':
+            expected = eager_model.get_image_features(inputs)
+            actual = onnx_model.get_image_features(inputs)
+        elif name == 'face_net_model':
+            expected, actual = eager_model(inputs), onnx_model(inputs)
+        else:
+            expected, actual = eager_model(pixel_values=inputs).logits, onnx_model(pixel_values=inputs).logits
+
+    report = {'max_abs_diff': float((expected - actual).abs().max()), 'samples': int(inputs.shape[0])}
+    if name in ('blur_detect_model', 'closed_eye_detection_model'):
+        report['label_agreement'] = float((expected.argmax(-1) == actual.argmax(-1)).float().mean())
+    else:
+        report['cosine_min'] = float(torch.nn.functional.cosine_similarity(expected, actual).min())
+    return report
+
+
+def parity_ok(report:dict, min_label_agreement:float=0.9, min_cosine:float=0.98) -> bool:
+    """Int8 graphs may flip the odd input sitting close to a decision boundary, hence a share and not all of them."""
+    if 'label_agreement' in report:
+        return report['label_agreement'] >= min_label_agreement
+    return report['cosine_min'] >= min_cosine
+
+
+def convert_models(models:dict, settings) -> dict:
+    """
+    Replaces the exportable eager models with ONNX Runtime adapters.
+
+    A model whose export, session or parity check fails keeps its eager version, so switching
+    the backend never stops a worker from starting. The parity check runs on the images of
+    ONNX_PARITY_SAMPLE_DIR, or on random noise when that folder is unset or empty.
+    """
+    missing = missing_onnx_packages()
+    if missing:
+        logger.warning(f"INFERENCE_BACKEND=onnx but {', '.join(missing)} is not installed (poetry install --extras onnx), keeping the eager models")
+        return dict(models)
+
+    onnx_dir = settings.ONNX_MODEL_DIR
+    # without an explicit setting the sessions follow the worker's thread budget
+    intra_op_threads = settings.ONNX_INTRA_OP_THREADS or current_thread_budget().get('threads', 0)
+    converted = dict(models)
+    sample_images = load_sample_images(settings.ONNX_PARITY_SAMPLE_DIR) if settings.ONNX_PARITY_CHECK else []
+    if settings.ONNX_PARITY_CHECK and not sample_images:
+        logger.warning("No ONNX_PARITY_SAMPLE_DIR images found, checking ONNX parity on random noise")
+    for name in ONNX_MODEL_KEYS:
+        eager_model = models.get(name)
+        if eager_model is None:
+            continue
+        try:
+            start_time = time.time()
+            onnx_path = export_model(name, eager_model, onnx_dir, quantize=settings.ONNX_QUANTIZE)
+            adapter = EXPORT_SPECS[name][3](create_session(onnx_path, intra_op_threads), name, quantized=onnx_path.endswith('.int8.onnx'))
+
+            if settings.ONNX_PARITY_CHECK:
+                inputs = sample_pixel_values(name, sample_images) if sample_images else None
+                report = check_parity(name, eager_model, adapter, inputs)
+                logger.info(f"ONNX parity for {name}: {report}")
+                if not parity_ok(report, settings.ONNX_PARITY_MIN_AGREEMENT):
+                    logger.warning(f"ONNX {name} failed the parity check, keeping the eager model")
+                    continue
+
+            converted[name] = adapter
+            logger.info(f"{name} served by ONNX Runtime from {onnx_path} ({time.time() - start_time:.2f}s)")
+        except ImportError as e:
+            logger.warning(f"ONNX export of {name} needs {e.name or str(e)}, keeping the eager model")
+        except Exception as e:
+            logger.warning(f"ONNX export of {name} failed, keeping the eager model: {str(e)}")
+    return converted
@@ -3,22 +3,22 @@ import os
 import logging
 import sys
 import warnings
+from src.utils.startupTimer import StartupTimer
+
+startup_timer = StartupTimer('api')
 
 
 if  sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())    
 
-# Suppress TensorFlow warnings
+# Suppress TensorFlow warnings, TensorFlow itself is only imported by the workers that need it
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Suppress all logs (0=all logs, 1=INFO, 2=WARNING, 3=ERROR)
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'  # Disable oneDNN optimizations
-
-from fastapi.templating import Jinja2Templates
-import tensorflow as tf
-from transformers import logging as transformers_logging
-
-tf.get_logger().setLevel('ERROR')
 logging.getLogger('tensorflow').setLevel(logging.ERROR)
 
+# Suppress Transformers model initialization messages, read by transformers whenever it gets imported
+os.environ.setdefault('TRANSFORMERS_VERBOSITY', 'error')
+
 # Suppress specific warnings
 warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -27,25 +27,24 @@ warnings.filterwarnings("ignore", category=UserWarning)
 # Suppress all warnings as a fallback
 warnings.simplefilter("ignore")
 
-# Suppress Transformers model initialization messages
-transformers_logging.set_verbosity_error()
-
-
-
 
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from starlette.middleware.sessions import SessionMiddleware
-from starlette.responses import RedirectResponse
-from src.config.settings import get_settings
-from src.routes import OAuth, Culling, SmartShare, Task, Dashboard, EventArrangment
-from src.config.Database import sessionmanager
-from src.Celery.utils import create_celery
-from contextlib import asynccontextmanager 
-from src.dependencies.mlModelsManager import ModelManager
-from starlette.middleware.cors import CORSMiddleware 
-from starlette.middleware import Middleware
-from fastapi.staticfiles import StaticFiles
+with startup_timer.phase('import fastapi'):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+    from starlette.middleware.sessions import SessionMiddleware
+    from starlette.responses import RedirectResponse
+    from contextlib import asynccontextmanager 
+    from starlette.middleware.cors import CORSMiddleware 
+    from starlette.middleware import Middleware
+    from fastapi.staticfiles import StaticFiles
+    from src.config.settings import get_settings
+    from src.config.Database import sessionmanager
+with startup_timer.phase('import celery'):
+    from src.Celery.utils import create_celery
+with startup_timer.phase('import model manager'):
+    from src.dependencies.mlModelsManager import ModelManager
+with startup_timer.phase('import routes'):
+    from src.routes import OAuth, Culling, SmartShare, Task, Dashboard, EventArrangment
 
 settings = get_settings()
 
@@ -53,11 +52,14 @@ settings = get_settings()
 @asynccontextmanager
 async def lifeSpan(app:FastAPI):
     print('initalizations of models')
-    # Initialize or load the ML models
-    ModelManager.get_models(settings)
+    # Load only the models the API serves (face query), workers load their own on first use
+    with startup_timer.phase('load models'):
+        model_load_times = ModelManager.preload(ModelManager.process_roles(settings) or ['api'], settings)
     print('Test connection to database')
-    async with sessionmanager.connect() as conn:
-        conn.execute('SELECT 1')
+    with startup_timer.phase('database check'):
+        async with sessionmanager.connect() as conn:
+            conn.execute('SELECT 1')
+    app.state.startup_report = startup_timer.print_report(model_load_times)
 
     yield
     print('closing database connection')
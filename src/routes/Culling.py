@@ -8,6 +8,7 @@ from fastapi.responses import JSONResponse
 from sqlalchemy import asc, desc, func
 from sqlalchemy.future import select
 
+from src.Celery.utils import create_celery
 from src.config.settings import get_settings
 from src.dependencies.core import DBSessionDep
 from src.dependencies.user import get_user
@@ -20,7 +21,6 @@ from src.schemas.ImageTaskData import ImageTaskData
 from src.services.Culling.createFolderInS3 import create_folder_in_S3
 from src.services.Culling.deleteFolderFromS3 import delete_s3_folder_and_update_db
 from src.services.Culling.savePreCullImagesMetadata import save_pre_cull_images_metadata
-from src.services.Culling.tasks.cullingTask import culling_task
 from src.utils.S3Utils import S3Utils
 
 
@@ -32,6 +32,8 @@ router = APIRouter(
 
 #instance of settings
 settings = get_settings()
+# tasks are sent by name, so the API never imports the culling models or their frameworks
+celery = create_celery()
 
 
 #instance of S3
@@ -490,7 +492,7 @@ async def start_culling(culling_data: ImageTaskData, db_session: DBSessionDep, u
 
     #Sending images URL and other info to Celery task
     try:
-        task = culling_task.apply_async(args=[user_id, culling_data.images_url, folder_data.name, folder_data.id, local_folder_path])
+        task = celery.send_task('culling_task', args=[user_id, culling_data.images_url, folder_data.name, folder_data.id, local_folder_path], queue='culling')
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error sending task to Celery: {str(e)}")
 
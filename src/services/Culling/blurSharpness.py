@@ -0,0 +1,50 @@
+import numpy as np
+from PIL import Image
+
+# Labels shared with the blur model so cascade decisions and model predictions mix freely
+BLURRED_LABEL = 'blurred'
+SHARP_LABEL = 'undistorted'
+
+
+def grayscale_thumbnail(image_pillow_obj, max_side:int=512) -> np.ndarray:
+    """Shrinks an image to a float32 grayscale array whose longer side is `max_side`, keeping the aspect ratio."""
+    gray = image_pillow_obj.convert('L')
+    gray.thumbnail((max_side, max_side), Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32)
+
+
+def laplacian_variance(gray:np.ndarray) -> float:
+    """
+    Variance of the 4-neighbour Laplacian, the classic focus measure: sharp edges give a
+    high response, defocus and motion blur flatten it.
+    """
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4.0 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var()) if laplacian.size else 0.0
+
+
+def sharpness_scores(pil_images:list, max_side:int=512) -> np.ndarray:
+    """Returns the Laplacian variance of every image, computed on a downscaled grayscale copy."""
+    return np.array([laplacian_variance(grayscale_thumbnail(image, max_side)) for image in pil_images], dtype=np.float32)
+
+
+def cascade_labels(scores, blurred_below:float, sharp_above:float) -> list:
+    """
+    Splits images into the three cascade tiers.
+
+    Args:
+        scores (np.ndarray): Sharpness score of every image.
+        blurred_below (float): Scores under this are clearly blurred.
+        sharp_above (float): Scores over this are clearly sharp.
+
+    Returns:
+        list: 'blurred' or 'undistorted' for images the cascade decided, None for the ambiguous
+        band that still needs the blur model.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    labels = np.full(len(scores), None, dtype=object)
+    labels[scores < blurred_below] = BLURRED_LABEL
+    labels[scores > sharp_above] = SHARP_LABEL
+    return labels.tolist()
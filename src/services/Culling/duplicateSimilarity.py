@@ -0,0 +1,319 @@
+import hnswlib
+import numpy as np
+
+# bytes held per similarity cell while a tile is alive: float32 score + bool threshold mask
+_BYTES_PER_SIMILARITY_CELL = 5
+
+
+def normalize_features(features) -> np.ndarray:
+    """
+    Stacks feature vectors into a float32 matrix with L2 normalized rows.
+
+    After normalization a plain dot product between two rows is their cosine similarity.
+    Zero vectors are left as zeros (similarity 0 with everything), matching sklearn's cosine_similarity.
+
+    Args:
+        features (list | np.ndarray): One feature vector per image.
+
+    Returns:
+        np.ndarray: A (n_images, n_features) float32 matrix.
+    """
+    matrix = np.asarray(features, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def rows_per_block(num_images: int, max_block_mb: float) -> int:
+    """Returns how many rows of the similarity matrix fit in one tile for the given memory budget."""
+    bytes_per_row = max(1, num_images) * _BYTES_PER_SIMILARITY_CELL
+    return max(1, int((max_block_mb * 1024 * 1024) // bytes_per_row))
+
+
+def iter_similar_pairs(features, threshold: float, max_block_mb: float = 64):
+    """
+    Finds all image pairs whose cosine similarity is above the threshold, one row tile at a time.
+
+    Only the upper triangle (i < j) of the similarity matrix is ever materialized and never more than
+    `max_block_mb` of it at once, so peak memory stays flat no matter how many images the folder has.
+
+    Args:
+        features (list | np.ndarray): One feature vector per image.
+        threshold (float): Pairs with a cosine similarity strictly greater than this are returned.
+        max_block_mb (float): Upper bound for the memory used by a single similarity tile.
+
+    Yields:
+        tuple: (rows_done, i, j) where `i` and `j` are index arrays of the similar pairs found in the tile
+               and `rows_done` is how many rows of the matrix have been processed so far.
+    """
+    normalized = normalize_features(features)
+    num_images = len(normalized)
+    block_rows = rows_per_block(num_images, max_block_mb)
+
+    for start in range(0, num_images, block_rows):
+        stop = min(start + block_rows, num_images)
+
+        # columns before `start` belong to the lower triangle of this tile, so skip them entirely
+        similarity_block = normalized[start:stop] @ normalized[start:].T
+        block_i, block_j = np.nonzero(similarity_block > threshold)
+        upper_triangle = block_j > block_i
+
+        yield stop, block_i[upper_triangle] + start, block_j[upper_triangle] + start
+
+
+def find_duplicate_indices(features, threshold: float, max_block_mb: float = 64, progress_callback=None) -> set:
+    """
+    Returns the indices of every image that is similar to at least one other image.
+
+    Args:
+        features (list | np.ndarray): One feature vector per image.
+        threshold (float): Cosine similarity above which two images count as duplicates.
+        max_block_mb (float): Upper bound for the memory used by a single similarity tile.
+        progress_callback (callable, optional): Called with (rows_done, total_rows) after every tile.
+
+    Returns:
+        set: Indices (into `features`) of the duplicate images.
+    """
+    duplicate_indices = set()
+    total_rows = len(features)
+
+    for rows_done, pair_i, pair_j in iter_similar_pairs(features, threshold, max_block_mb):
+        duplicate_indices.update(pair_i.tolist())
+        duplicate_indices.update(pair_j.tolist())
+        if progress_callback:
+            progress_callback(rows_done, total_rows)
+
+    return duplicate_indices
+
+
+class DisjointSet:
+    """Union-find over image indices, used to merge duplicate pairs into duplicate clusters."""
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+        self.rank = [0] * size
+
+    def find(self, item: int) -> int:
+        while self.parent[item] != item:
+            # path halving keeps the trees flat without recursion
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, first: int, second: int):
+        first_root, second_root = self.find(first), self.find(second)
+        if first_root == second_root:
+            return
+        if self.rank[first_root] < self.rank[second_root]:
+            first_root, second_root = second_root, first_root
+        self.parent[second_root] = first_root
+        if self.rank[first_root] == self.rank[second_root]:
+            self.rank[first_root] += 1
+
+    def union_pairs(self, pair_i, pair_j):
+        for first, second in zip(pair_i, pair_j):
+            self.union(int(first), int(second))
+
+    def clusters(self, min_size: int = 2) -> list:
+        groups = {}
+        for item in range(len(self.parent)):
+            groups.setdefault(self.find(item), []).append(item)
+        return [members for members in groups.values() if len(members) >= min_size]
+
+
+def iter_similar_pairs_ann(features, threshold: float, neighbours: int = 32, ef: int = 64, query_batch_size: int = 1024):
+    """
+    Approximate counterpart of `iter_similar_pairs` backed by an HNSW index.
+
+    Every image is queried for its `neighbours` nearest neighbours by cosine distance and only neighbours
+    above the similarity threshold are kept, so the work grows roughly as n log n instead of n².
+    Groups larger than `neighbours` are still merged transitively once the pairs go through a DisjointSet.
+
+    Args:
+        features (list | np.ndarray): One feature vector per image.
+        threshold (float): Pairs with a cosine similarity strictly greater than this are returned.
+        neighbours (int): Number of nearest neighbours looked up per image.
+        ef (int): HNSW search breadth, raised to at least `neighbours`; higher is slower but more exact.
+        query_batch_size (int): Number of images queried against the index at once.
+
+    Yields:
+        tuple: (rows_done, i, j) in the same format as `iter_similar_pairs`.
+    """
+    normalized = normalize_features(features)
+    num_images, dim = normalized.shape
+    k = min(neighbours + 1, num_images)  # +1 because every image finds itself first
+
+    index = hnswlib.Index(space='cosine', dim=dim)
+    index.init_index(max_elements=num_images, ef_construction=200, M=16)
+    index.add_items(normalized, np.arange(num_images))
+    index.set_ef(max(ef, k))
+
+    for start in range(0, num_images, query_batch_size):
+        stop = min(start + query_batch_size, num_images)
+        labels, distances = index.knn_query(normalized[start:stop], k=k)
+
+        rows = np.repeat(np.arange(start, stop), k)
+        cols = labels.reshape(-1).astype(np.int64)
+        # hnswlib's cosine space returns 1 - cosine similarity
+        similar = (1.0 - distances.reshape(-1)) > threshold
+        similar &= rows != cols
+
+        pair_i, pair_j = np.minimum(rows[similar], cols[similar]), np.maximum(rows[similar], cols[similar])
+        yield stop, pair_i, pair_j
+
+
+def iter_similar_pairs_windowed(
+    features,
+    threshold: float,
+    capture_times: list,
+    window_sec: float,
+    camera_ids: list = None,
+    untimed_full_scan: bool = True,
+    file_order_window: int = 20,
+    max_block_mb: float = 64,
+):
+    """
+    Candidate-pruned counterpart of `iter_similar_pairs` for burst shots.
+
+    Images with a capture time are only compared with images taken at most `window_sec` later (and,
+    when `camera_ids` is given, by the same camera body), which makes the work close to linear in the
+    folder size. Images without a capture time are either compared with every image (`untimed_full_scan`)
+    or with the `file_order_window` images on each side of them in file order.
+
+    Args:
+        features (list | np.ndarray): One feature vector per image.
+        threshold (float): Pairs with a cosine similarity strictly greater than this are returned.
+        capture_times (list): Capture time of every image in seconds, None when it is unknown.
+        window_sec (float): Maximum time between two shots that are still compared.
+        camera_ids (list, optional): Camera body of every image; only images of the same body are compared.
+        untimed_full_scan (bool): Compare images without a capture time against the whole folder.
+        file_order_window (int): Neighbours on each side compared in file order when the full scan is off.
+        max_block_mb (float): Upper bound for the memory used by a single similarity tile.
+
+    Yields:
+        tuple: (rows_done, i, j) in the same format as `iter_similar_pairs`.
+    """
+    normalized = normalize_features(features)
+    num_images = len(normalized)
+    rows_done = 0
+
+    timed_groups = {}
+    untimed = []
+    for idx, captured_at in enumerate(capture_times):
+        if captured_at is None:
+            untimed.append(idx)
+        else:
+            group_key = camera_ids[idx] if camera_ids is not None else None
+            timed_groups.setdefault(group_key, []).append(idx)
+
+    # Sliding time window inside every camera group
+    for group in timed_groups.values():
+        group = np.asarray(sorted(group, key=lambda idx: capture_times[idx]), dtype=np.int64)
+        times = np.asarray([capture_times[idx] for idx in group], dtype=np.float64)
+        # window_ends[p] is the first position that is too late to be compared with position p
+        window_ends = np.searchsorted(times, times + window_sec, side='right')
+        block_rows = rows_per_block(len(group), max_block_mb)
+
+        for start in range(0, len(group), block_rows):
+            stop = min(start + block_rows, len(group))
+            columns_end = window_ends[stop - 1]
+            similarity_block = normalized[group[start:stop]] @ normalized[group[start:columns_end]].T
+
+            block_i, block_j = np.nonzero(similarity_block > threshold)
+            row_pos, col_pos = block_i + start, block_j + start
+            in_window = (col_pos > row_pos) & (col_pos < window_ends[row_pos])
+
+            first, second = group[row_pos[in_window]], group[col_pos[in_window]]
+            rows_done += stop - start
+            yield rows_done, np.minimum(first, second), np.maximum(first, second)
+
+    if not untimed:
+        return
+
+    untimed = np.asarray(untimed, dtype=np.int64)
+    if untimed_full_scan:
+        # Global fallback: every untimed image against the whole folder
+        block_rows = rows_per_block(num_images, max_block_mb)
+        for start in range(0, len(untimed), block_rows):
+            rows = untimed[start:start + block_rows]
+            block_i, block_j = np.nonzero(normalized[rows] @ normalized.T > threshold)
+            first, second = rows[block_i], block_j
+            not_self = first != second
+            rows_done += len(rows)
+            yield rows_done, np.minimum(first, second)[not_self], np.maximum(first, second)[not_self]
+    else:
+        # File order fallback: only the neighbouring files of every untimed image
+        for idx in untimed:
+            neighbours = np.arange(max(0, idx - file_order_window), min(num_images, idx + file_order_window + 1))
+            neighbours = neighbours[neighbours != idx]
+            similar = neighbours[normalized[neighbours] @ normalized[idx] > threshold]
+            rows_done += 1
+            yield rows_done, np.minimum(similar, idx), np.maximum(similar, idx)
+
+
+def find_duplicate_clusters(
+    features,
+    threshold: float,
+    max_block_mb: float = 64,
+    ann_min_images: int = 0,
+    ann_neighbours: int = 32,
+    ann_ef: int = 64,
+    capture_times: list = None,
+    time_window_sec: float = 0,
+    camera_ids: list = None,
+    untimed_full_scan: bool = True,
+    file_order_window: int = 20,
+    progress_callback=None,
+) -> list:
+    """
+    Groups similar images into duplicate clusters.
+
+    When `time_window_sec` and `capture_times` are given only burst candidates are compared (see
+    `iter_similar_pairs_windowed`). Otherwise folders with at least `ann_min_images` images are searched
+    with the approximate HNSW index, and smaller folders (or every folder when `ann_min_images` is 0)
+    use the exact blockwise search.
+
+    Args:
+        features (list | np.ndarray): One feature vector per image.
+        threshold (float): Cosine similarity above which two images count as duplicates.
+        max_block_mb (float): Tile memory budget for the exact and windowed searches.
+        ann_min_images (int): Folder size from which the approximate search is used, 0 disables it.
+        ann_neighbours (int): Nearest neighbours looked up per image in approximate mode.
+        ann_ef (int): HNSW search breadth in approximate mode.
+        capture_times (list, optional): Capture time in seconds of every image, None when unknown.
+        time_window_sec (float): Burst window for the time pruned search, 0 disables it.
+        camera_ids (list, optional): Camera body of every image to only compare shots of the same body.
+        untimed_full_scan (bool): Compare images without a capture time against the whole folder.
+        file_order_window (int): File order neighbours compared for untimed images without the full scan.
+        progress_callback (callable, optional): Called with (rows_done, total_rows) while searching.
+
+    Returns:
+        list: Clusters of two or more indices (into `features`) that are duplicates of each other.
+    """
+    num_images = len(features)
+    if num_images < 2:
+        return []
+
+    if time_window_sec and capture_times is not None:
+        pairs = iter_similar_pairs_windowed(
+            features, threshold, capture_times, time_window_sec,
+            camera_ids=camera_ids,
+            untimed_full_scan=untimed_full_scan,
+            file_order_window=file_order_window,
+            max_block_mb=max_block_mb,
+        )
+    elif ann_min_images and num_images >= ann_min_images:
+        pairs = iter_similar_pairs_ann(features, threshold, neighbours=ann_neighbours, ef=ann_ef)
+    else:
+        pairs = iter_similar_pairs(features, threshold, max_block_mb)
+
+    disjoint_set = DisjointSet(num_images)
+    for rows_done, pair_i, pair_j in pairs:
+        disjoint_set.union_pairs(pair_i, pair_j)
+        if progress_callback:
+            progress_callback(rows_done, num_images)
+
+    return disjoint_set.clusters()
@@ -0,0 +1,418 @@
+import io
+import time
+from itertools import islice
+import logging
+import numpy as np
+from PIL import Image
+from src.config.settings import get_settings
+from src.services.Culling.separateBlurImages import cached_blur_labels, classify_blur, new_tier_counts, upload_blurred_image
+from src.services.Culling.separateClosedEye import ClosedEyeDetection, eye_cache_model_id, image_eye_state
+from src.services.Culling.separateDuplicateImages import (
+    embed_images,
+    embedding_cache_model_id,
+    prepare_embedding_input,
+    use_vit_embeddings,
+    find_embedding_duplicates,
+    read_capture_info,
+    upload_duplicate_results,
+)
+from src.utils.reducedDecode import apply_draft, open_reduced
+from src.utils.imageStream import read_image_bytes, release_image
+from src.utils.inferenceCache import cache_stats, get_inference_cache
+from src.utils.threadBudget import current_thread_budget
+from src.services.Culling.stageCheckpoint import record_duplicate_decisions, resume_duplicate_decisions
+from src.services.Culling.perceptualHash import content_hash, dhash_batch, dhash_thumbnail, find_hash_duplicate_groups
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+
+def fused_decode_min_side() -> int:
+    """The shared decode has to satisfy the largest input of the three detectors, 0 when any of them needs full resolution."""
+    min_sides = [settings.BLUR_DECODE_MIN_SIDE, settings.FACE_DETECTION_DECODE_MIN_SIDE, settings.DUPLICATE_DECODE_MIN_SIDE]
+    return 0 if not all(min_sides) else max(min_sides)
+
+
+def decode_image(image_info:dict, min_side:int=0) -> dict:
+    """
+    Reads and decodes an image file exactly once, at reduced resolution when `min_side` is set.
+
+    Returns:
+        dict: The image entry extended with the decoded RGB PIL image, its raw bytes digest,
+        dHash thumbnail and EXIF capture info, everything the three detectors need.
+    """
+    image_bytes = read_image_bytes(image_info)
+
+    with Image.open(io.BytesIO(image_bytes)) as image_pil:
+        captured_at, camera_id = read_capture_info(image_pil)
+        image_rgb = apply_draft(image_pil, min_side).convert('RGB')
+
+    return {
+        **image_info,
+        'image': image_rgb,
+        'content_hash': content_hash(image_bytes),
+        'dhash_thumbnail': dhash_thumbnail(image_rgb),
+        'captured_at': captured_at,
+        'camera_id': camera_id,
+    }
+
+
+async def cull_images_fused(images_path:list, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj, task, batch_size:int=None, progress_offset:float=0, progress_span:float=66.6, checkpoint=None, image_source=None) -> dict:
+    """
+    Runs blur and closed eye detection and extracts the duplicate features in a single pass over the images.
+
+    Every image is decoded once per micro-batch and the decoded array is shared by the blur model,
+    the face detector / eye classifier and the duplicate embedding model, instead of each Celery
+    stage reopening and decoding the file again. Blurred and closed eye images are uploaded right
+    away, the others keep their local file until the duplicate search has seen the whole folder.
+
+    `image_source` turns the entries into the images to cull (e.g. an S3ImageStream reading them
+    into memory), by default the entries' local files are read.
+
+    Returns:
+        dict: 'images_metadata' of the uploaded (rejected) images, 'image_features' of the images
+        left for the duplicate search and the 'blur_tiers' counters.
+    """
+    images_metadata = []
+    image_features = []
+    total_images = len(images_path)
+    processed = 0
+    if checkpoint:
+        # Rejected images an earlier attempt already uploaded are skipped, the others are culled again
+        images_metadata.extend(record['metadata'] for record in checkpoint.completed())
+        images_path = checkpoint.remaining(images_path)
+        processed = total_images - len(images_path)
+    batch_size = max(1, int(batch_size or settings.BLUR_BATCH_SIZE))
+    face_batch_size = max(1, int(settings.CLOSED_EYE_FACE_BATCH_SIZE))
+    closed_eye_detector = ClosedEyeDetection(S3_util_obj, root_folder, inside_root_main_folder)
+    decode_min_side = fused_decode_min_side()
+    tier_counts = new_tier_counts()
+    cache = get_inference_cache()
+    # Rejected images are uploaded in full resolution, a reduced decode can't be re-encoded for that
+    upload_from_decode = decode_min_side == 0
+
+    def update_progress(info):
+        # Decoding and classification is two thirds of the folder's work, duplicate search and uploads the rest
+        task.update_state(
+            state='PROGRESS',
+            meta={'progress': round(progress_offset + (processed / total_images) * progress_span, 2), 'info': info}
+        )
+
+    def report_failure(image_info, error):
+        logger.error(f"Error processing {image_info['name']}: {str(error)}")
+        update_progress(f"Failed {image_info['name']}: {str(error)}")
+        release_image(image_info)
+
+    images = image_source(images_path) if image_source else iter(images_path)
+    while True:
+        # Decode only one bounded micro-batch at a time to keep memory flat
+        batch = list(islice(images, batch_size))
+        if not batch:
+            break
+        decoded_batch = []
+        for image_info in batch:
+            try:
+                decoded_batch.append(decode_image(image_info, decode_min_side))
+            except Exception as e:
+                processed += 1
+                report_failure(image_info, e)
+
+        if not decoded_batch:
+            continue
+
+        # Blur: one model prediction for the whole micro-batch, minus the images the cache or the cascade already decided
+        try:
+            cached_labels = cached_blur_labels([image['content_hash'] for image in decoded_batch], decode_min_side)
+            tier_counts['cache'] += sum(1 for image in decoded_batch if image['content_hash'] in cached_labels)
+            uncached = [image for image in decoded_batch if image['content_hash'] not in cached_labels]
+            # In ViT embedding mode the blur forward pass also yields the duplicate detection embedding
+            blur_embeddings = {} if use_vit_embeddings() else None
+            if uncached:
+                cached_labels.update(zip(
+                    [image['content_hash'] for image in uncached],
+                    classify_blur(
+                        [image['image'] for image in uncached],
+                        tier_counts,
+                        content_hashes=[image['content_hash'] for image in uncached],
+                        decode_min_side=decode_min_side,
+                        embeddings=blur_embeddings
+                    )
+                ))
+            blur_embeddings = {uncached[pos]['content_hash']: embedding for pos, embedding in (blur_embeddings or {}).items()}
+            batch_labels = [cached_labels[image['content_hash']] for image in decoded_batch]
+        except Exception as e:
+            for image in decoded_batch:
+                processed += 1
+                report_failure(image, e)
+            continue
+
+        sharp_images = []
+        for image, predicted_label_name in zip(decoded_batch, batch_labels):
+            if predicted_label_name != "blurred":
+                sharp_images.append(image)
+                continue
+            processed += 1
+            try:
+                images_metadata.append(await upload_blurred_image(
+                    image_info=image,
+                    open_images=image['image'] if upload_from_decode else None,
+                    root_folder=root_folder,
+                    inside_root_main_folder=inside_root_main_folder,
+                    folder_id=folder_id,
+                    S3_util_obj=S3_util_obj
+                ))
+                if checkpoint:
+                    checkpoint.record(image['checkpoint_key'], 'blurred', metadata=images_metadata[-1])
+                release_image(image)
+                update_progress(f"Processed {image['name']}")
+            except Exception as e:
+                report_failure(image, e)
+
+        # Closed eye: faces are detected on the decoded array, crops of the whole batch are classified together
+        eye_model_id = eye_cache_model_id(decode_min_side)
+        cached_eye_states = cache.get_many([image['content_hash'] for image in sharp_images], eye_model_id) if cache else {}
+        face_owners, face_crops, eye_images = [], [], []
+        for image in sharp_images:
+            if image['content_hash'] in cached_eye_states:
+                continue
+            try:
+                image_array = np.asarray(image['image'])
+                extracted_faces = closed_eye_detector.detect_faces_in_array(image_array)
+                if extracted_faces and closed_eye_detector.needs_full_resolution_crops(decode_min_side):
+                    # faces are cropped from the original, only for the images that have any
+                    full_array = np.asarray(open_reduced(read_image_bytes(image), min_side=0))
+                    extracted_faces = closed_eye_detector.scale_boxes(extracted_faces, image_array.shape, full_array.shape)
+                    image_array = full_array
+                # the staged path crops from the cv2 BGR decode, a reversed channel view keeps the classifier input identical
+                image_bgr = image_array[..., ::-1]
+                for box in extracted_faces:
+                    face = closed_eye_detector.crop_face(image_bgr, box)
+                    if face is not None:
+                        face_owners.append(len(eye_images))
+                        face_crops.append(face)
+                eye_images.append(image)
+            except Exception as e:
+                processed += 1
+                report_failure(image, e)
+
+        try:
+            predictions = []
+            for start in range(0, len(face_crops), face_batch_size):
+                predictions.extend(await closed_eye_detector.predict_eye_states(face_crops[start:start + face_batch_size]))
+        except Exception as e:
+            for image in eye_images:
+                processed += 1
+                report_failure(image, e)
+            # images answered from the cache still go on
+            eye_images, face_owners, predictions = [], [], []
+
+        face_predictions = [[] for _ in eye_images]
+        for pos, prediction in zip(face_owners, predictions):
+            face_predictions[pos].append(prediction)
+        if cache:
+            cache.put_many({image['content_hash']: face_predictions[pos] for pos, image in enumerate(eye_images)}, eye_model_id)
+        cached_eye_states.update((image['content_hash'], face_predictions[pos]) for pos, image in enumerate(eye_images))
+
+        # A single closed face marks the whole image
+        open_eye_images = []
+        for image in sharp_images:
+            if image['content_hash'] not in cached_eye_states:
+                # face detection failed and was already reported
+                continue
+            if image_eye_state(cached_eye_states[image['content_hash']]) != ["ClosedFace"]:
+                open_eye_images.append(image)
+                continue
+            processed += 1
+            metadata = await closed_eye_detector.upload_closed_eye_image(image, folder_id, image=image['image'] if upload_from_decode else None)
+            if metadata:
+                images_metadata.append(metadata)
+                if checkpoint:
+                    checkpoint.record(image['checkpoint_key'], 'closed_eye', metadata=metadata)
+            update_progress(f"Processed {image['name']}")
+
+        if not open_eye_images:
+            continue
+
+        # Duplicate features: the same decoded images feed the embedding model, only the features are kept past the batch
+        try:
+            feature_model_id = embedding_cache_model_id(decode_min_side)
+            cached_features = {image['content_hash']: blur_embeddings[image['content_hash']] for image in open_eye_images if image['content_hash'] in blur_embeddings}
+            if cache:
+                cached_features.update(cache.get_many([image['content_hash'] for image in open_eye_images if image['content_hash'] not in cached_features], feature_model_id))
+            uncached = [image for image in open_eye_images if image['content_hash'] not in cached_features]
+            if uncached:
+                uncached_features = embed_images([prepare_embedding_input(image['image']) for image in uncached])
+                new_features = {image['content_hash']: features for image, features in zip(uncached, uncached_features)}
+                if cache:
+                    cache.put_many(new_features, feature_model_id)
+                cached_features.update(new_features)
+            batch_features = [cached_features[image['content_hash']] for image in open_eye_images]
+        except Exception as e:
+            for image in open_eye_images:
+                processed += 1
+                report_failure(image, e)
+            continue
+
+        for image, features in zip(open_eye_images, batch_features):
+            processed += 1
+            image_features.append({
+                'name': image['name'],
+                'features': features,
+                'local_path': image.get('local_path'),
+                'content_type': image['content_type'],
+                'captured_at': image['captured_at'],
+                'camera_id': image['camera_id'],
+                'content_hash': image['content_hash'],
+                'dhash_thumbnail': image['dhash_thumbnail'],
+                'url': image.get('url'),
+                # streamed images keep their bytes in memory until they are uploaded
+                **{key: image[key] for key in ('content', 'memory_budget') if key in image},
+            })
+            update_progress(f"Processed {image['name']}")
+
+    return {
+        'images_metadata': images_metadata,
+        'image_features': image_features,
+        'blur_tiers': tier_counts,
+    }
+
+
+async def merge_duplicates(image_features:list, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj, task, progress_offset:float=66.6, checkpoint=None, decision_checkpoint=None, restore_images=None) -> list:
+    """
+    Finds the duplicates among every image left after blur and closed eye detection and uploads
+    them to the Duplicate or FineCollection folder. `restore_images` fetches the images of resumed
+    decisions again when they were only held in memory by the failed attempt, except those it
+    already uploaded.
+
+    Returns:
+        list: metadata of the uploaded images.
+    """
+    # duplicate search takes 40% of the remaining progress, the uploads the rest
+    search_span = (100 - progress_offset) * 0.4
+
+    # A retry reuses the decisions of the attempt that already started uploading
+    resumed = resume_duplicate_decisions(decision_checkpoint)
+    if resumed:
+        image_features, duplicates = resumed
+        if restore_images:
+            # images the earlier attempt already uploaded are skipped by the upload, their bytes aren't needed
+            restore_images([image for idx, image in enumerate(image_features) if not (checkpoint and checkpoint.get(str(idx)))])
+        return await upload_duplicate_results(
+            image_features, duplicates, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task,
+            progress_offset=progress_offset + search_span, checkpoint=checkpoint
+        )
+
+    duplicates = set()
+    if settings.DUPLICATE_HASH_PREFILTER and image_features:
+        try:
+            hash_groups = find_hash_duplicate_groups(
+                content_hashes=[x['content_hash'] for x in image_features],
+                perceptual_hashes=dhash_batch([x['dhash_thumbnail'] for x in image_features]),
+                max_distance=settings.DUPLICATE_HASH_MAX_DISTANCE
+            )
+            # positions, not names, two different images may share a file name
+            duplicates.update(idx for group in hash_groups for idx in group)
+        except Exception as e:
+            task.update_state(state='PROGRESS', meta={'progress': progress_offset, 'info': f"Hash prefilter failed: {str(e)}"})
+    duplicates.update(find_embedding_duplicates(image_features, task, progress_offset=progress_offset, progress_span=search_span))
+    if decision_checkpoint:
+        record_duplicate_decisions(decision_checkpoint, image_features, duplicates)
+
+    return await upload_duplicate_results(
+        image_features, duplicates, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task,
+        progress_offset=progress_offset + search_span, checkpoint=checkpoint
+    )
+
+
+def combine_shard_results(shard_results:list) -> dict:
+    """
+    Concatenates the outputs of the culled shards in shard order, the positions the duplicate
+    search works with follow that order, and adds up their blur tier counters.
+    """
+    blur_tiers = {}
+    for shard in shard_results:
+        for tier, count in shard['blur_tiers'].items():
+            blur_tiers[tier] = blur_tiers.get(tier, 0) + count
+    return {
+        'images_metadata': [metadata for shard in shard_results for metadata in shard['images_metadata']],
+        'image_features': [features for shard in shard_results for features in shard['image_features']],
+        'blur_tiers': blur_tiers,
+    }
+
+
+async def merge_shard_results(shard_results:list, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj, task, progress_offset:float=10, checkpoint=None, decision_checkpoint=None, fetch_missing=None) -> dict:
+    """
+    Merges the culled shards of a folder and runs the duplicate search over all of their images,
+    duplicates are found across shards too. `fetch_missing` is called with the combined image
+    features before the search, to fetch again the files a shard left on another node.
+
+    Returns:
+        dict: 'images_metadata' of every uploaded image, the summed 'blur_tiers' and the number of 'shards'.
+    """
+    combined = combine_shard_results(shard_results)
+    if fetch_missing:
+        fetch_missing(combined['image_features'])
+    duplicates_metadata = await merge_duplicates(
+        image_features=combined['image_features'],
+        root_folder=root_folder,
+        inside_root_main_folder=inside_root_main_folder,
+        folder_id=folder_id,
+        S3_util_obj=S3_util_obj,
+        task=task,
+        progress_offset=progress_offset,
+        checkpoint=checkpoint,
+        decision_checkpoint=decision_checkpoint
+    )
+    return {
+        'status': 'SUCCESS',
+        'images_metadata': combined['images_metadata'] + duplicates_metadata,
+        'blur_tiers': combined['blur_tiers'],
+        'shards': len(shard_results)
+    }
+
+
+async def separate_images_fused(images_path:list, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj, task, batch_size:int=None, checkpoints:dict=None, image_stream=None):
+    """
+    Runs blur, closed eye and duplicate detection over the folder, decoding every image only once.
+    Outputs and the S3 folder layout are the same as the staged chain.
+
+    `checkpoints` holds the 'cull', 'duplicate' and 'duplicate_decisions' stage checkpoints of a job,
+    a retried run then resumes where the previous attempt stopped. With an `image_stream` the
+    images are read from S3 by the stream instead of from local files.
+    """
+    start_time = time.time()
+    total_images = len(images_path)
+    checkpoints = checkpoints or {}
+    if resume_duplicate_decisions(checkpoints.get('duplicate_decisions')):
+        # the earlier attempt finished culling and started uploading, only its uploads are left
+        culled = {'images_metadata': [record['metadata'] for record in checkpoints['cull'].completed()], 'image_features': [], 'blur_tiers': new_tier_counts()}
+    else:
+        culled = await cull_images_fused(images_path, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task, batch_size, checkpoint=checkpoints.get('cull'), image_source=image_stream)
+    tier_counts = culled['blur_tiers']
+
+    # Duplicates are only known once every image has been seen
+    images_metadata = culled['images_metadata'] + await merge_duplicates(
+        culled['image_features'], root_folder, inside_root_main_folder, folder_id, S3_util_obj, task, progress_offset=66.6,
+        checkpoint=checkpoints.get('duplicate'), decision_checkpoint=checkpoints.get('duplicate_decisions'),
+        restore_images=image_stream.restore if image_stream else None
+    )
+
+    # Cleanup any remaining files
+    for image_info in images_path:
+        release_image(image_info)
+
+    task.update_state(
+        state='SUCCESS',
+        meta={'progress': 100, 'info': 'Culling completed', 'blur_tiers': tier_counts, 'inference_cache': cache_stats(), 'thread_budget': current_thread_budget()}
+    )
+    print(f"Fused culling of {total_images} images took {time.time() - start_time:.2f}s, blur tiers: {tier_counts}")
+    time.sleep(0.2)
+    return {
+        'status': 'SUCCESS',
+        'images_metadata': images_metadata,
+        'blur_tiers': tier_counts,
+        'inference_cache': cache_stats(),
+        'thread_budget': current_thread_budget()
+    }
@@ -0,0 +1,89 @@
+import hashlib
+import numpy as np
+from PIL import Image
+from src.services.Culling.duplicateSimilarity import DisjointSet
+
+# dHash compares horizontally adjacent pixels of a 9x8 grayscale thumbnail -> 8x8 = 64 bits
+DHASH_SIZE = (9, 8)
+
+
+def content_hash(image_bytes: bytes) -> str:
+    """Returns the SHA-256 hex digest of the raw file bytes, identical re-uploads share it."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def dhash_thumbnail(image_pillow_obj) -> np.ndarray:
+    """
+    Shrinks an image to the tiny grayscale thumbnail dHash is computed from.
+
+    For JPEGs `draft` lets the decoder do most of the shrinking in the DCT domain, so the full
+    resolution image is never decoded.
+    """
+    image_pillow_obj.draft('L', (DHASH_SIZE[0] * 8, DHASH_SIZE[1] * 8))
+    thumbnail = image_pillow_obj.convert('L').resize(DHASH_SIZE, Image.BILINEAR)
+    return np.asarray(thumbnail, dtype=np.uint8)
+
+
+def dhash_batch(thumbnails) -> np.ndarray:
+    """
+    Computes the 64-bit difference hash of every thumbnail at once.
+
+    Args:
+        thumbnails (list | np.ndarray): (n, 8, 9) grayscale thumbnails from `dhash_thumbnail`.
+
+    Returns:
+        np.ndarray: (n,) uint64 hashes.
+    """
+    thumbnails = np.asarray(thumbnails, dtype=np.int16).reshape(-1, DHASH_SIZE[1], DHASH_SIZE[0])
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    packed = np.packbits(bits.reshape(len(thumbnails), 64), axis=1)
+    return packed.view('>u8').reshape(-1).astype(np.uint64)
+
+
+def hamming_distances(hash_value, hashes) -> np.ndarray:
+    """Returns the number of differing bits between one 64-bit hash and an array of hashes."""
+    differing = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(hash_value))
+    return np.unpackbits(differing.reshape(-1, 1).view(np.uint8), axis=1).sum(axis=1)
+
+
+def find_hash_duplicate_groups(content_hashes: list, perceptual_hashes, max_distance: int = 3) -> list:
+    """
+    Groups byte-identical and near-identical images (resized copies, re-encodes) without any model.
+
+    Images are first grouped by SHA-256, then by dHash: the 64 hash bits are cut into
+    `max_distance + 1` bands, and by the pigeonhole principle two hashes within `max_distance`
+    bits agree on at least one band, so only images sharing a band bucket are compared.
+
+    Args:
+        content_hashes (list): SHA-256 digest of every image.
+        perceptual_hashes (np.ndarray): 64-bit dHash of every image.
+        max_distance (int): Largest Hamming distance still treated as the same picture.
+
+    Returns:
+        list: Groups of two or more indices that are exact or near-exact duplicates.
+    """
+    perceptual_hashes = np.asarray(perceptual_hashes, dtype=np.uint64)
+    disjoint_set = DisjointSet(len(content_hashes))
+
+    first_seen = {}
+    for idx, digest in enumerate(content_hashes):
+        disjoint_set.union(first_seen.setdefault(digest, idx), idx)
+
+    bit_bands = np.array_split(np.arange(64), max_distance + 1)
+    for band in bit_bands:
+        band_width, band_shift = len(band), 63 - int(band[-1])
+        band_values = (perceptual_hashes >> np.uint64(band_shift)) & np.uint64((1 << band_width) - 1)
+
+        _, bucket_ids = np.unique(band_values, return_inverse=True)
+        order = np.argsort(bucket_ids, kind='stable')
+        bucket_starts = np.flatnonzero(np.diff(bucket_ids[order], prepend=-1))
+        for bucket in np.split(order, bucket_starts[1:]):
+            if len(bucket) < 2:
+                continue
+            for pos, idx in enumerate(bucket[:-1]):
+                others = bucket[pos + 1:]
+                close = others[hamming_distances(perceptual_hashes[idx], perceptual_hashes[others]) <= max_distance]
+                for other in close:
+                    disjoint_set.union(int(idx), int(other))
+
+    return disjoint_set.clusters()
@@ -1,12 +1,19 @@
 from datetime import datetime, timedelta
 import os
 import time
-from PIL import Image
 import io
+import numpy as np
 import torch
 from uuid import uuid4
 from src.config.settings import get_settings
 from src.dependencies.mlModelsManager import ModelManager
+from src.utils.reducedDecode import open_reduced
+from src.utils.imageStream import image_source
+from src.services.Culling.blurSharpness import cascade_labels, sharpness_scores
+from src.services.Culling.perceptualHash import content_hash
+from src.services.Culling.storeCulledImage import store_culled_image
+from src.utils.inferenceCache import cache_stats, get_inference_cache, inference_backend_tag
+from src.utils.threadBudget import current_thread_budget
 
 settings = get_settings()
 
@@ -14,108 +21,315 @@ settings = get_settings()
 predicted_labels = ['undistorted', 'blurred']
 upload_image_folder = settings.BLUR_FOLDER
 
-#models
-models = ModelManager.get_models(settings=settings)
-feature_extractor = models['feature_extractor']
-blur_detect_model = models['blur_detect_model']
 
 
-async def separate_blur_images(images_path:list, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj, task):
+def blur_cache_model_id(decode_min_side:int) -> str:
+    """Inference cache key of the blur model, the decode resolution and the inference backend change its output so they are part of the key."""
+    return f"blur:{settings.BLUR_IMAGE_DETECTION_MODEL}:{decode_min_side}:{inference_backend_tag('blur_detect_model')}"
+
+
+def vit_embedding_cache_model_id(decode_min_side:int) -> str:
+    """Inference cache key of the blur ViT CLS embeddings used for duplicate detection."""
+    return f"blur_cls:{settings.BLUR_IMAGE_DETECTION_MODEL}:{decode_min_side}:{inference_backend_tag('blur_detect_model')}"
+
+
+def keep_vit_embeddings() -> bool:
+    """Whether the blur pass keeps its CLS embedding for the duplicate stage."""
+    return settings.DUPLICATE_EMBEDDING_SOURCE == 'vit'
+
+
+def predict_blur_outputs(pil_images:list, with_embeddings:bool=False) -> tuple:
+    """
+    Runs a single forward pass of the blur model over a micro-batch of images.
+
+    Args:
+        pil_images (list): RGB PIL images belonging to the same micro-batch.
+        with_embeddings (bool): Also return the pooled CLS token of the last encoder layer.
+
+    Returns:
+        tuple: (n, 2) logits in input order, columns follow `predicted_labels`, and the
+        (n, hidden_size) CLS embeddings or None.
+    """
+    # models are loaded on first use, not when the module is imported
+    feature_extractor = ModelManager.get_model('feature_extractor')
+    blur_detect_model = ModelManager.get_model('blur_detect_model')
+
+    inputs = feature_extractor(pil_images, return_tensors='pt')
+    inputs = {k: v.to(blur_detect_model.device) for k, v in inputs.items()} \
+             if isinstance(inputs, dict) else inputs.to(blur_detect_model.device)
+
+    with torch.no_grad():
+        outputs = blur_detect_model(**inputs, output_hidden_states=with_embeddings)
+        embeddings = None
+        if with_embeddings:
+            # the same normalised CLS token the classifier head reads, ONNX adapters export it directly
+            cls_embedding = getattr(outputs, 'cls_embedding', None)
+            if cls_embedding is None:
+                cls_embedding = blur_detect_model.vit.layernorm(outputs.hidden_states[-1])[:, 0]
+            embeddings = cls_embedding.float().cpu().numpy()
+    return outputs.logits.float().cpu().numpy(), embeddings
+
+
+def predict_blur_logits(pil_images:list) -> np.ndarray:
+    """Returns the (n, 2) blur logits of a micro-batch."""
+    return predict_blur_outputs(pil_images)[0]
+
+
+def compute_vit_embeddings(pil_images:list) -> np.ndarray:
+    """CLS embeddings for images the blur pass didn't run the model on (cache or cascade decisions)."""
+    return predict_blur_outputs(pil_images, with_embeddings=True)[1]
+
+
+def predict_blur_labels(pil_images:list) -> list:
+    """Returns the predicted label ('undistorted' or 'blurred') for each image, in input order."""
+    return [predicted_labels[label_idx] for label_idx in predict_blur_logits(pil_images).argmax(-1).tolist()]
+
+
+def cached_blur_labels(content_hashes:list, decode_min_side:int) -> dict:
+    """Returns content hash -> label for the images whose blur logits are already cached."""
+    cache = get_inference_cache()
+    if cache is None or not content_hashes:
+        return {}
+    cached_logits = cache.get_many(content_hashes, blur_cache_model_id(decode_min_side))
+    return {image_hash: predicted_labels[int(np.argmax(logits))] for image_hash, logits in cached_logits.items()}
+
+
+def new_tier_counts() -> dict:
+    """Counters of how many images each blur tier decided."""
+    return {'cache': 0, 'laplacian_blurred': 0, 'laplacian_sharp': 0, 'model': 0}
+
+
+def classify_blur(pil_images:list, tier_counts:dict=None, content_hashes:list=None, decode_min_side:int=None, embeddings:dict=None) -> list:
+    """
+    Labels a micro-batch of images, with the optional Laplacian cascade in front of the blur model.
+
+    Clearly blurred and clearly sharp images are decided by their sharpness score, only the
+    ambiguous band runs through `blur_detect_model`.
+
+    Args:
+        pil_images (list): RGB PIL images belonging to the same micro-batch.
+        tier_counts (dict): Counters from `new_tier_counts`, updated in place.
+        content_hashes (list): SHA-256 of each image, when given the model logits are stored in the inference cache.
+        decode_min_side (int): Resolution the images were decoded at, part of the cache key.
+        embeddings (dict): When given, filled with position -> CLS embedding for the images the model ran on.
+
+    Returns:
+        list: The label ('undistorted' or 'blurred') for each image, in input order.
+    """
+    tier_counts = tier_counts if tier_counts is not None else new_tier_counts()
+    decode_min_side = settings.BLUR_DECODE_MIN_SIDE if decode_min_side is None else decode_min_side
+
+    def run_model(indices):
+        logits, cls_embeddings = predict_blur_outputs([pil_images[idx] for idx in indices], with_embeddings=embeddings is not None)
+        cache = get_inference_cache()
+        if cache is not None and content_hashes:
+            cache.put_many({content_hashes[idx]: row for idx, row in zip(indices, logits)}, blur_cache_model_id(decode_min_side))
+        if embeddings is not None:
+            embeddings.update(zip(indices, cls_embeddings))
+            if cache is not None and content_hashes:
+                cache.put_many({content_hashes[idx]: row for idx, row in zip(indices, cls_embeddings)}, vit_embedding_cache_model_id(decode_min_side))
+        tier_counts['model'] += len(indices)
+        return [predicted_labels[label_idx] for label_idx in logits.argmax(-1).tolist()]
+
+    if not settings.BLUR_CASCADE_ENABLED:
+        return run_model(list(range(len(pil_images))))
+
+    labels = cascade_labels(
+        sharpness_scores(pil_images, settings.BLUR_CASCADE_MAX_SIDE),
+        blurred_below=settings.BLUR_CASCADE_BLURRED_BELOW,
+        sharp_above=settings.BLUR_CASCADE_SHARP_ABOVE
+    )
+    tier_counts['laplacian_blurred'] += labels.count('blurred')
+    tier_counts['laplacian_sharp'] += labels.count('undistorted')
+
+    ambiguous = [idx for idx, label in enumerate(labels) if label is None]
+    if ambiguous:
+        for idx, label in zip(ambiguous, run_model(ambiguous)):
+            labels[idx] = label
+    return labels
+
+
+async def upload_blurred_image(image_info:dict, open_images, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj) -> dict:
+    """
+    Uploads an image classified as blurred to the Blur folder and returns its metadata record.
+
+    Args:
+        image_info (dict): The image entry ('name', 'content_type', 'local_path' and the pre-cull 'url').
+        open_images (PIL.Image.Image): The full resolution decoded image, it is re-encoded for the upload.
+            When None (the model input was decoded at reduced resolution) the file is decoded again.
+            Neither happens when the original object is copied (CULLING_RESULT_MODE 'copy').
+
+    Returns:
+        dict: Metadata of the uploaded image ready to be saved to the database.
+    """
+    def encode_image():
+        image = open_images if open_images is not None else open_reduced(image_source(image_info), min_side=0)
+        byte_arr = io.BytesIO()
+        image.save(byte_arr, format=image.format or 'JPEG')
+        byte_arr.seek(0)
+        return byte_arr
+
+    # Copy or upload to S3
+    filename = f"{uuid4()}__{image_info['name']}"
+    await store_culled_image(
+        image_info=image_info,
+        S3_util_obj=S3_util_obj,
+        root_folder=root_folder,
+        inside_root_main_folder=inside_root_main_folder,
+        upload_image_folder=upload_image_folder,
+        filename=filename,
+        read_image_data=encode_image
+    )
+
+    # Generate presigned URL
+    key = f"{root_folder}/{inside_root_main_folder}/{upload_image_folder}/{filename}"
+    presigned_url = await S3_util_obj.generate_presigned_url(
+        key, expiration=settings.PRESIGNED_URL_EXPIRY_SEC
+    )
+
+    # Add metadata
+    return {
+        'id': filename,
+        'name': image_info['name'],
+        'file_type': image_info['content_type'],
+        'detection_status': 'Blur',
+        'image_download_path': presigned_url,
+        'image_download_validity': datetime.now() + timedelta(seconds=settings.PRESIGNED_URL_EXPIRY_SEC),
+        'culling_folder_id': folder_id
+    }
+
+
+async def separate_blur_images(images_path:list, root_folder:str, inside_root_main_folder:str, folder_id:int, S3_util_obj, task, batch_size:int=None, checkpoint=None):
     non_blur_images = []
     blurred_metadata = []
     total_img_len = len(images_path)
     progress = 0.0
+    processed = 0
+    if checkpoint:
+        # A retried run restores the images an earlier attempt finished and only processes the rest
+        blurred_metadata.extend(record['metadata'] for record in checkpoint.completed('blurred'))
+        non_blur_images.extend(record['image'] for record in checkpoint.completed('sharp'))
+        images_path = checkpoint.remaining(images_path)
+        processed = total_img_len - len(images_path)
+    batch_size = max(1, int(batch_size or settings.BLUR_BATCH_SIZE))
+    tier_counts = new_tier_counts()
 
-    for index, image_info in enumerate(images_path):
-        image_path = image_info['local_path']  # Get path from dict
-        image_name = image_info['name']
-        content_type = image_info['content_type']
-        
-        try:
-            # Open image from local path
-            with open(image_path, 'rb') as f:
-                image_file = f.read()
-            
-            # Load image for processing
-            open_images = Image.open(io.BytesIO(image_file)).convert('RGB')
-            
-            # Prepare model inputs
-            inputs = feature_extractor(open_images, return_tensors='pt')
-            inputs = {k: v.to(blur_detect_model.device) for k, v in inputs.items()} \
-                     if isinstance(inputs, dict) else inputs.to(blur_detect_model.device)
-
-            # Model prediction
-            with torch.no_grad():
-                outputs = blur_detect_model(**inputs)
-            predicted_label_name = predicted_labels[outputs.logits.argmax(-1).item()]
-
-            if predicted_label_name == "blurred":
-                # Upload to S3
-                filename = f"{uuid4()}__{image_name}"
-                byte_arr = io.BytesIO()
-                open_images.save(byte_arr, format=open_images.format or 'JPEG')
-                byte_arr.seek(0)
-
-                await S3_util_obj.upload_smart_cull_images(
-                    root_folder=root_folder,
-                    main_folder=inside_root_main_folder,
-                    upload_image_folder=upload_image_folder,
-                    image_data=byte_arr,
-                    filename=filename
-                )
+    def report_failure(image_name, error):
+        # Handle failures but keep processing other images
+        task.update_state(
+            state='PROGRESS',
+            meta={'progress': progress, 'info': f"Failed {image_name}: {str(error)}"}
+        )
+
+    for batch_start in range(0, len(images_path), batch_size):
+        # Read one bounded micro-batch at a time to keep memory flat
+        read_batch = []
+        for image_info in images_path[batch_start:batch_start + batch_size]:
+            try:
+                # Open image from local path
+                with open(image_info['local_path'], 'rb') as f:
+                    image_file = f.read()
+                read_batch.append((image_info, image_file, content_hash(image_file)))
+            except Exception as e:
+                processed += 1
+                report_failure(image_info['name'], e)
+
+        # Images seen by an earlier run are neither decoded nor classified again
+        cached_labels = cached_blur_labels([image_hash for _, _, image_hash in read_batch], settings.BLUR_DECODE_MIN_SIDE)
+        tier_counts['cache'] += sum(1 for _, _, image_hash in read_batch if image_hash in cached_labels)
 
-                # Generate presigned URL
-                key = f"{root_folder}/{inside_root_main_folder}/{upload_image_folder}/{filename}"
-                presigned_url = await S3_util_obj.generate_presigned_url(
-                    key, expiration=settings.PRESIGNED_URL_EXPIRY_SEC
+        labelled_batch = []
+        decoded_batch = []
+        for image_info, image_file, image_hash in read_batch:
+            if image_hash in cached_labels:
+                labelled_batch.append((image_info, None, cached_labels[image_hash], None))
+                continue
+            try:
+                # Load image for processing, decoded only as large as the blur model needs
+                decoded_batch.append((image_info, open_reduced(image_file, settings.BLUR_DECODE_MIN_SIDE), image_hash))
+            except Exception as e:
+                # Undecodable images are skipped without dropping the rest of the batch
+                processed += 1
+                report_failure(image_info['name'], e)
+
+        # One model prediction for the whole micro-batch, minus the images the cascade already decided
+        if decoded_batch:
+            try:
+                # In ViT embedding mode the same forward pass also yields the duplicate detection embedding
+                batch_embeddings = {} if keep_vit_embeddings() else None
+                batch_labels = classify_blur(
+                    [open_images for _, open_images, _ in decoded_batch],
+                    tier_counts,
+                    content_hashes=[image_hash for _, _, image_hash in decoded_batch],
+                    embeddings=batch_embeddings
+                )
+                labelled_batch.extend(
+                    (image_info, open_images, label, (batch_embeddings or {}).get(pos))
+                    for pos, ((image_info, open_images, _), label) in enumerate(zip(decoded_batch, batch_labels))
                 )
+            except Exception as e:
+                for image_info, _, _ in decoded_batch:
+                    processed += 1
+                    report_failure(image_info['name'], e)
+
+        for image_info, open_images, predicted_label_name, vit_embedding in labelled_batch:
+            image_path = image_info['local_path']  # Get path from dict
+            image_name = image_info['name']
+            processed += 1
 
-                # Add metadata
-                blurred_metadata.append({
-                    'id': filename,
-                    'name': image_name,
-                    'file_type': content_type,
-                    'detection_status': 'Blur',
-                    'image_download_path': presigned_url,
-                    'image_download_validity': datetime.now() + timedelta(seconds=settings.PRESIGNED_URL_EXPIRY_SEC),
-                    'culling_folder_id': folder_id
+            try:
+                if predicted_label_name == "blurred":
+                    blurred_metadata.append(await upload_blurred_image(
+                        image_info=image_info,
+                        open_images=None if settings.BLUR_DECODE_MIN_SIDE else open_images,
+                        root_folder=root_folder,
+                        inside_root_main_folder=inside_root_main_folder,
+                        folder_id=folder_id,
+                        S3_util_obj=S3_util_obj
+                    ))
+                    if checkpoint:
+                        checkpoint.record(image_info['checkpoint_key'], 'blurred', metadata=blurred_metadata[-1])
+
+                    # Remove local blurred image
+                    os.remove(image_path)
+                else:
+                    # Keep non-blurred image path
+                    non_blur_images.append({
+                    'name': image_info['name'],
+                    'content_type': image_info['content_type'],
+                    'local_path':image_info['local_path'],
+                    'url': image_info.get('url'),
                 })
+                    if checkpoint:
+                        # the embedding isn't checkpointed, a resumed run lets the duplicate stage compute it
+                        checkpoint.record(image_info['checkpoint_key'], 'sharp', image=non_blur_images[-1])
+                    if vit_embedding is not None:
+                        non_blur_images[-1]['vit_embedding'] = vit_embedding
+
+                # Update progress
+                progress = (processed / total_img_len) * 100
+                task.update_state(
+                    state='PROGRESS',
+                    meta={'progress': round(progress, 2), 'info': f'Processed {image_name}'}
+                )
 
-                # Remove local blurred image
-                os.remove(image_path)
-            else:
-                # Keep non-blurred image path
-                non_blur_images.append({
-                'name': image_info['name'],
-                'content_type': image_info['content_type'],
-                'local_path':image_info['local_path'],
-            })
-
-            # Update progress
-            progress = ((index + 1) / total_img_len) * 100
-            task.update_state(
-                state='PROGRESS',
-                meta={'progress': round(progress, 2), 'info': f'Processed {image_name}'}
-            )
-
-        except Exception as e:
-            # Handle failures but keep processing other images
-            error_msg = f"Failed {image_name}: {str(e)}"
-            task.update_state(
-                state='PROGRESS',
-                meta={'progress': progress, 'info': error_msg}
-            )
-            continue
+            except Exception as e:
+                report_failure(image_name, e)
+                continue
 
     # Final status update
+    inference_cache = cache_stats()
     task.update_state(
         state='SUCCESS',
-        meta={'progress': 100, 'info': 'Blur separation completed'}
+        meta={'progress': 100, 'info': 'Blur separation completed', 'blur_tiers': tier_counts, 'inference_cache': inference_cache, 'thread_budget': current_thread_budget()}
     )
     time.sleep(0.2)
     return {
         'status': 'SUCCESS',
         'non_blur_images': non_blur_images, 
         'images_metadata': blurred_metadata,
+        'blur_tiers': tier_counts,
+        'inference_cache': inference_cache,
+        'thread_budget': current_thread_budget(),
         's3_response': 'Blur images uploaded successfully'
     }
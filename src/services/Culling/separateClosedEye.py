@@ -1,14 +1,18 @@
 from datetime import datetime, timedelta
 import io
-import os
 import time
 from uuid import uuid4
 import cv2
-import numpy as np
 from PIL import Image
 import torch
 from src.config.settings import get_settings
 from src.dependencies.mlModelsManager import ModelManager
+from src.utils.reducedDecode import decode_reduced_cv2, scale_boxes
+from src.utils.imageStream import read_image_bytes, release_image
+from src.utils.inferenceCache import cache_stats, get_inference_cache, inference_backend_tag
+from src.utils.threadBudget import current_thread_budget
+from src.services.Culling.perceptualHash import content_hash
+from src.services.Culling.storeCulledImage import store_culled_image
 import asyncio
 import logging
 
@@ -18,17 +22,24 @@ logger = logging.getLogger(__name__)
 
 settings = get_settings()
 
-# Load models
-models = ModelManager.get_models(settings)
-face_detector = models['face_detector']  
-feature_extractor = models['feature_extractor']  
-closed_eye_model = models['closed_eye_detection_model']  
+
+
+def eye_cache_model_id(decode_min_side:int) -> str:
+    """Inference cache key of the face detector + eye classifier pair, faces depend on the decode resolution."""
+    crops = 'full' if settings.CLOSED_EYE_FULL_RESOLUTION_CROPS else 'reduced'
+    return f"closed_eye:{settings.CLOSED_EYE_DETECTION_MODEL}:{decode_min_side}:{crops}:{inference_backend_tag('closed_eye_detection_model')}"
+
+
+def image_eye_state(face_predictions:list) -> list:
+    """Reduces the per-face predictions of an image, a single closed face marks the whole image."""
+    return ["ClosedFace"] if "ClosedFace" in face_predictions else ["OpenFace"]
 
 class ClosedEyeDetection:
     def __init__(self, S3_util_obj, root_folder: str, inside_root_main_folder: str):
-        self.face_detector = face_detector
-        self.model = closed_eye_model
-        self.feature_extractor = feature_extractor
+        # Load models, on first use in this process
+        self.face_detector = ModelManager.get_model('face_detector')
+        self.model = ModelManager.get_model('closed_eye_detection_model')
+        self.feature_extractor = ModelManager.get_model('feature_extractor')
         self.S3 = S3_util_obj
         self.root_folder = root_folder
         self.inside_root_main_folder = inside_root_main_folder
@@ -44,18 +55,41 @@ class ClosedEyeDetection:
             logger.error("Image data is empty")
             raise ValueError("Image data is empty")
 
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Faces are detected on a mid resolution decode
+        image = decode_reduced_cv2(image_data, settings.FACE_DETECTION_DECODE_MIN_SIDE)
         if image is None:
             logger.error("Failed to decode image")
             raise ValueError("Failed to decode image")
 
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        extracted_faces = self.detect_faces_in_array(image_rgb)
+        if extracted_faces and self.needs_full_resolution_crops(settings.FACE_DETECTION_DECODE_MIN_SIDE):
+            full_image = decode_reduced_cv2(image_data, 0)
+            if full_image is not None:
+                return self.scale_boxes(extracted_faces, image.shape, full_image.shape), full_image
+        return extracted_faces, image
+
+    @staticmethod
+    def needs_full_resolution_crops(decode_min_side:int) -> bool:
+        """
+        Whether faces found on a reduced decode are cropped from the full resolution image instead.
+        A small face in a large group shot is only a few dozen pixels in the reduced decode, upscaled
+        to the classifier's 224x224 input it loses the eye detail.
+        """
+        return bool(decode_min_side) and settings.CLOSED_EYE_FULL_RESOLUTION_CROPS
+
+    @staticmethod
+    def scale_boxes(boxes:list, from_shape:tuple, to_shape:tuple) -> list:
+        """Maps (x1, y1, x2, y2) boxes found on an image of `from_shape` onto the same image decoded at `to_shape`."""
+        return scale_boxes(boxes, from_shape, to_shape)
+
+    def detect_faces_in_array(self, image_rgb):
+        """Returns the boxes of forward facing faces in an already decoded RGB array."""
         boxes, _, landmarks = self.face_detector.detect(image_rgb, landmarks=True)
 
         if boxes is None:
             logger.info("No faces detected.")
-            return [], image
+            return []
 
         extracted_faces = [
             tuple(map(int, box[:4]))
@@ -64,7 +98,7 @@ class ClosedEyeDetection:
         ]
 
         logger.info(f"Detected {len(extracted_faces)} faces.")
-        return extracted_faces, image
+        return extracted_faces
 
 
     async def preprocess_face_image(self, face_image):
@@ -78,6 +112,22 @@ class ClosedEyeDetection:
             return prediction
 
 
+    async def predict_eye_states(self, face_images):
+        """Classifies a batch of face crops, possibly from different images, in one forward pass."""
+        inputs = self.feature_extractor([Image.fromarray(face) for face in face_images], return_tensors="pt")
+        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            predictions = [self.labels[label_idx] for label_idx in self.model(**inputs).logits.argmax(-1).tolist()]
+        logger.info(f"Predicted eye states for {len(predictions)} faces.")
+        return predictions
+
+    @staticmethod
+    def crop_face(image, box):
+        x1, y1, x2, y2 = box
+        # clamp boxes that MTCNN places partly outside the frame so one bad crop can't fail a whole batch
+        face = image[max(0, y1):max(0, y2), max(0, x1):max(0, x2)]
+        return face.copy() if face.size else None
+
     async def process_image(self, image_data):
         extracted_faces, image = await self.detect_faces(image_data['content'])
         
@@ -90,73 +140,139 @@ class ClosedEyeDetection:
         
         return {image_data['name']: ["OpenFace"]}
 
-    async def separate_closed_eye_images_and_upload_to_s3(self, images_path, folder_id, task=None, prev_images_metadata=None):
+    async def upload_closed_eye_image(self, image_info, folder_id, image=None):
+        """
+        Uploads a closed eye image and removes its local copy.
+
+        `image` is an already decoded PIL image, when given the file isn't read and decoded again.
+        With CULLING_RESULT_MODE 'copy' the original object is copied and nothing is decoded.
+        """
+        try:
+            filename = f"{uuid4()}__{image_info['name']}"
+
+            # Normalize format
+            format_map = {
+                "image/jpeg": "JPEG",
+                "image/jpg": "JPEG",
+                "image/png": "PNG",
+                "image/webp": "WEBP",
+            }
+            
+            img_format = format_map.get(image_info['content_type'].lower(), "JPEG")
+
+            def encode_image():
+                decoded = image
+                if decoded is None:
+                    # Read image from local path (or memory, when streamed)
+                    decoded = Image.open(io.BytesIO(read_image_bytes(image_info)))
+                byte_arr = io.BytesIO()
+                decoded.convert('RGB').save(byte_arr, format=img_format)
+                byte_arr.seek(0)
+                return byte_arr
+
+            # Copy or upload to S3
+            key = f"{self.root_folder}/{self.inside_root_main_folder}/{self.upload_image_folder}/{filename}"
+            await store_culled_image(
+                image_info=image_info,
+                S3_util_obj=self.S3,
+                root_folder=self.root_folder,
+                inside_root_main_folder=self.inside_root_main_folder,
+                upload_image_folder=self.upload_image_folder,
+                filename=filename,
+                read_image_data=encode_image
+            )
+            
+            # Generate presigned URL
+            presigned_url = await self.S3.generate_presigned_url(
+                key, 
+                expiration=settings.PRESIGNED_URL_EXPIRY_SEC
+            )
+
+            # Cleanup local file
+            release_image(image_info)
+
+            return {
+                'id': filename,
+                'name': image_info['name'],
+                'detection_status': 'ClosedEye',
+                'file_type': img_format,
+                'image_download_path': presigned_url,
+                'image_download_validity': datetime.now() + timedelta(seconds=settings.PRESIGNED_URL_EXPIRY_SEC),
+                'culling_folder_id': folder_id
+            }
+        except Exception as e:
+            logger.error(f"Failed to upload closed eye image: {str(e)}")
+            return None
+
+    async def separate_closed_eye_images_and_upload_to_s3(self, images_path, folder_id, task=None, prev_images_metadata=None, face_batch_size=None, checkpoint=None):
         prev_images_metadata = prev_images_metadata or []
         open_eye_images = []
         metadata_list = prev_images_metadata.copy()
         total_images = len(images_path)
+        if checkpoint:
+            # A retried run restores the images an earlier attempt finished and only processes the rest
+            metadata_list.extend(record['metadata'] for record in checkpoint.completed('closed_eye'))
+            open_eye_images.extend(record['image'] for record in checkpoint.completed('open_eye'))
+            images_path = checkpoint.remaining(images_path)
+        # progress counts the images finished by an earlier attempt too
+        completed_before = total_images - len(images_path)
+        cache = get_inference_cache()
+        cache_model_id = eye_cache_model_id(settings.FACE_DETECTION_DECODE_MIN_SIDE)
 
-        async def upload_closed_eye_image(image_info):
-            try:
-                # Read image from local path
-                with open(image_info['local_path'], 'rb') as f:
-                    image_content = f.read()
-                
-                # Process and upload
-                filename = f"{uuid4()}__{image_info['name']}"
-                byte_arr = io.BytesIO()
-                
-                # Normalize format
-                format_map = {
-                    "image/jpeg": "JPEG",
-                    "image/jpg": "JPEG",
-                    "image/png": "PNG",
-                    "image/webp": "WEBP",
-                }
-                
-                img_format = format_map.get(image_info['content_type'].lower(), "JPEG")
-                Image.open(io.BytesIO(image_content)).convert('RGB').save(byte_arr, format=img_format)
-                byte_arr.seek(0)
+        async def record_prediction(index, image_info, prediction):
+            logger.info(f"Image {image_info['name']}: Prediction {prediction}")
 
-                # Upload to S3
-                key = f"{self.root_folder}/{self.inside_root_main_folder}/{self.upload_image_folder}/{filename}"
-                await self.S3.upload_smart_cull_images(
-                    self.root_folder, 
-                    self.inside_root_main_folder, 
-                    self.upload_image_folder, 
-                    byte_arr, 
-                    filename
-                )
-                
-                # Generate presigned URL
-                presigned_url = await self.S3.generate_presigned_url(
-                    key, 
-                    expiration=settings.PRESIGNED_URL_EXPIRY_SEC
-                )
+            if "ClosedFace" in prediction:
+                metadata = await self.upload_closed_eye_image(image_info, folder_id)
+                if metadata:
+                    metadata_list.append(metadata)
+                if checkpoint and metadata:
+                    checkpoint.record(image_info['checkpoint_key'], 'closed_eye', metadata=metadata)
+            else:
+                # Retain local path for open-eye images
+                open_eye_images.append({
+                    'local_path': image_info['local_path'],
+                    'name': image_info['name'],
+                    'content_type': image_info['content_type'],
+                    'url': image_info.get('url')
+                })
+                if checkpoint:
+                    checkpoint.record(image_info['checkpoint_key'], 'open_eye', image=open_eye_images[-1])
+                # ViT embedding from the blur pass, reused by the duplicate stage
+                if image_info.get('vit_embedding') is not None:
+                    open_eye_images[-1]['vit_embedding'] = image_info['vit_embedding']
 
-                # Cleanup local file
-                os.remove(image_info['local_path'])
+            # Update progress
+            if task:
+                progress = ((completed_before + index + 1) / total_images) * 100
+                task.update_state(
+                    state='PROGRESS',
+                    meta={'progress': round(progress, 2), 'info': f'Processed {image_info["name"]}'}
+                )
 
-                return {
-                    'id': filename,
-                    'name': image_info['name'],
-                    'detection_status': 'ClosedEye',
-                    'file_type': img_format,
-                    'image_download_path': presigned_url,
-                    'image_download_validity': datetime.now() + timedelta(seconds=settings.PRESIGNED_URL_EXPIRY_SEC),
-                    'culling_folder_id': folder_id
-                }
-            except Exception as e:
-                logger.error(f"Failed to upload closed eye image: {str(e)}")
-                return None
+        def report_failure(index, image_info, error):
+            logger.error(f"Error processing {image_info['name']}: {str(error)}")
+            if task:
+                task.update_state(
+                    state='PROGRESS',
+                    meta={'progress': ((completed_before + index + 1) / total_images) * 100, 
+                        'info': f'Failed {image_info["name"]}: {str(error)}'}
+                )
 
         async def process_single_image(index, image_info):
             try:
-                logger.info(f"Processing image {index + 1}/{total_images}: {image_info['name']}")
+                logger.info(f"Processing image {completed_before + index + 1}/{total_images}: {image_info['name']}")
                 
                 # Load image from local path
                 with open(image_info['local_path'], 'rb') as f:
                     image_content = f.read()
+
+                # Images seen by an earlier run skip detection and classification
+                image_hash = content_hash(image_content)
+                cached_predictions = cache.get(image_hash, cache_model_id) if cache else None
+                if cached_predictions is not None:
+                    await record_prediction(index, image_info, image_eye_state(cached_predictions))
+                    return
                 
                 # Perform detection
                 results = await self.process_image({
@@ -165,49 +281,91 @@ class ClosedEyeDetection:
                     'local_path': image_info['local_path']
                 })
 
-                for image_name, prediction in results.items():
-                    logger.info(f"Image {image_name}: Prediction {prediction}")
-                    
-                    if "ClosedFace" in prediction:
-                        metadata = await upload_closed_eye_image(image_info)
-                        if metadata:
-                            metadata_list.append(metadata)
-                    else:
-                        # Retain local path for open-eye images
-                        open_eye_images.append({
-                            'local_path': image_info['local_path'],
-                            'name': image_info['name'],
-                            'content_type': image_info['content_type']
-                        })
-
-                # Update progress
-                if task:
-                    progress = ((index + 1) / total_images) * 100
-                    task.update_state(
-                        state='PROGRESS',
-                        meta={'progress': round(progress, 2), 'info': f'Processed {image_info["name"]}'}
-                    )
+                for _, prediction in results.items():
+                    if cache:
+                        cache.put(image_hash, cache_model_id, prediction)
+                    await record_prediction(index, image_info, prediction)
 
             except Exception as e:
-                logger.error(f"Error processing {image_info['name']}: {str(e)}")
-                if task:
-                    task.update_state(
-                        state='PROGRESS',
-                        meta={'progress': ((index + 1) / total_images) * 100, 
-                            'info': f'Failed {image_info["name"]}: {str(e)}'}
-                    )
-
-        # Process images concurrently
-        await asyncio.gather(*[
-            process_single_image(i, img) 
-            for i, img in enumerate(images_path)
-        ])
+                report_failure(index, image_info, e)
+
+        async def process_images_batched(batch_size):
+            # Images whose faces are waiting to be classified and their face crops, tagged with the image position
+            pending_images = []
+            pending_faces = []
+
+            async def flush_pending_faces():
+                try:
+                    predictions = []
+                    for start in range(0, len(pending_faces), batch_size):
+                        predictions.extend(await self.predict_eye_states(
+                            [face for _, face in pending_faces[start:start + batch_size]]
+                        ))
+                except Exception as e:
+                    for index, image_info, _ in pending_images:
+                        report_failure(index, image_info, e)
+                else:
+                    # Reduce face predictions per image, a single closed face marks the whole image
+                    face_predictions = [[] for _ in pending_images]
+                    for (pos, _), prediction in zip(pending_faces, predictions):
+                        face_predictions[pos].append(prediction)
+                    if cache:
+                        cache.put_many({image_hash: face_predictions[pos] for pos, (_, _, image_hash) in enumerate(pending_images)}, cache_model_id)
+                    for pos, (index, image_info, _) in enumerate(pending_images):
+                        try:
+                            await record_prediction(index, image_info, image_eye_state(face_predictions[pos]))
+                        except Exception as e:
+                            report_failure(index, image_info, e)
+                pending_images.clear()
+                pending_faces.clear()
+
+            for index, image_info in enumerate(images_path):
+                try:
+                    logger.info(f"Detecting faces in image {completed_before + index + 1}/{total_images}: {image_info['name']}")
+                    with open(image_info['local_path'], 'rb') as f:
+                        image_content = f.read()
+
+                    # Images seen by an earlier run skip detection and classification
+                    image_hash = content_hash(image_content)
+                    cached_predictions = cache.get(image_hash, cache_model_id) if cache else None
+                    if cached_predictions is not None:
+                        await record_prediction(index, image_info, image_eye_state(cached_predictions))
+                        continue
+
+                    extracted_faces, image = await self.detect_faces(image_content)
+                except Exception as e:
+                    report_failure(index, image_info, e)
+                    continue
+
+                pending_images.append((index, image_info, image_hash))
+                for box in extracted_faces:
+                    face = self.crop_face(image, box)
+                    if face is not None:
+                        pending_faces.append((len(pending_images) - 1, face))
+
+                if len(pending_faces) >= batch_size:
+                    await flush_pending_faces()
+
+            if pending_images:
+                await flush_pending_faces()
+
+        face_batch_size = max(1, int(face_batch_size or settings.CLOSED_EYE_FACE_BATCH_SIZE))
+        if face_batch_size > 1:
+            # Classify face crops collected across images in shared batches
+            await process_images_batched(face_batch_size)
+        else:
+            # Process images concurrently
+            await asyncio.gather(*[
+                process_single_image(i, img) 
+                for i, img in enumerate(images_path)
+            ])
 
         # Final status update
+        inference_cache = cache_stats()
         if task:
             task.update_state(
                 state='SUCCESS',
-                meta={'progress': 100, 'info': 'Closed eye processing complete'}
+                meta={'progress': 100, 'info': 'Closed eye processing complete', 'inference_cache': inference_cache, 'thread_budget': current_thread_budget()}
             )
 
         time.sleep(0.2)
@@ -215,5 +373,7 @@ class ClosedEyeDetection:
             'status': 'SUCCESS',
             'open_eye_images': open_eye_images,
             'images_metadata': metadata_list,
+            'inference_cache': inference_cache,
+            'thread_budget': current_thread_budget(),
             's3_response': 'Closed eye images processed successfully'
         }
\ No newline at end of file
@@ -262,122 +262,230 @@
 from datetime import datetime, timedelta
 from uuid import uuid4
 import io
-from tensorflow.keras.applications.resnet50 import preprocess_input  # type: ignore
-from sklearn.metrics.pairwise import cosine_similarity
 from PIL import Image
 import numpy as np
-from tensorflow.keras.applications import ResNet50
 from src.config.settings import get_settings
 from src.dependencies.mlModelsManager import ModelManager
+from src.services.Culling.duplicateSimilarity import find_duplicate_clusters
+from src.utils.reducedDecode import apply_draft
+from src.utils.imageStream import read_image_bytes, release_image
+from src.utils.inferenceCache import cache_stats, get_inference_cache
+from src.utils.threadBudget import current_thread_budget
+from src.services.Culling.stageCheckpoint import record_duplicate_decisions, resume_duplicate_decisions
+from src.services.Culling.storeCulledImage import store_culled_image
+from src.services.Culling.separateBlurImages import compute_vit_embeddings, vit_embedding_cache_model_id
+from src.services.Culling.perceptualHash import content_hash, dhash_batch, dhash_thumbnail, find_hash_duplicate_groups
 import os
 import time
 
 settings = get_settings()
-models = ModelManager.get_models(settings)
-duplicate_model = models['duplicate_image_detection_model']
+
+# EXIF tags used to find burst shots
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME = 0x0132
+EXIF_CAMERA_MODEL = 0x0110
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_SUBSEC_TIME_ORIGINAL = 0x9291
+EXIF_BODY_SERIAL_NUMBER = 0xA431
+
+
+# Function to read when and with which camera body an image was shot
+def read_capture_info(image_pillow_obj):
+    """
+    Reads the capture time and camera body of an image from its EXIF data.
+
+    Returns:
+        tuple: (capture time as a POSIX timestamp or None, camera identifier or None)
+    """
+    try:
+        exif = image_pillow_obj.getexif()
+        exif_ifd = exif.get_ifd(EXIF_IFD_POINTER)
+    except Exception:
+        return None, None
+
+    captured_at = None
+    raw_datetime = exif_ifd.get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    if raw_datetime:
+        try:
+            captured_at = datetime.strptime(str(raw_datetime).strip('\x00 '), "%Y:%m:%d %H:%M:%S").timestamp()
+            # burst frames share the same second, the sub-second field tells them apart
+            subsec = str(exif_ifd.get(EXIF_SUBSEC_TIME_ORIGINAL) or '').strip('\x00 ')
+            if subsec.isdigit():
+                captured_at += float(f"0.{subsec}")
+        except ValueError:
+            captured_at = None
+
+    camera_parts = [str(part).strip('\x00 ') for part in (exif.get(EXIF_CAMERA_MODEL), exif_ifd.get(EXIF_BODY_SERIAL_NUMBER)) if part]
+    camera_id = "/".join(camera_parts) or None
+    return captured_at, camera_id
+
+
+def feature_cache_model_id(decode_min_side:int) -> str:
+    """Inference cache key of the ResNet50 duplicate features."""
+    return f"resnet50_imagenet_avg:{decode_min_side}"
+
+
+def use_vit_embeddings() -> bool:
+    """Whether duplicates are found on the blur ViT CLS embeddings instead of ResNet50 features."""
+    return settings.DUPLICATE_EMBEDDING_SOURCE == 'vit'
+
+
+def embedding_decode_min_side() -> int:
+    """Resolution the duplicate embedding input is decoded at, the ViT shares the blur model input size."""
+    return settings.BLUR_DECODE_MIN_SIDE if use_vit_embeddings() else settings.DUPLICATE_DECODE_MIN_SIDE
+
+
+def embedding_cache_model_id(decode_min_side:int) -> str:
+    """
+    Inference cache key of whichever duplicate embedding is configured. The ViT key carries the
+    inference backend, ResNet50 is a TensorFlow model that always runs eager.
+    """
+    return vit_embedding_cache_model_id(decode_min_side) if use_vit_embeddings() else feature_cache_model_id(decode_min_side)
+
+
+def duplicate_threshold() -> float:
+    """Cosine similarity threshold matching the configured embedding."""
+    return settings.DUPLICATE_VIT_THRESHOLD if use_vit_embeddings() else settings.BLUR_IMAGE_THRESHOLD
+
+
+def prepare_embedding_input(image_pillow_obj):
+    """Shrinks a decoded RGB image to what the embedding model consumes, so batches stay small."""
+    return image_pillow_obj if use_vit_embeddings() else image_pillow_obj.resize((224, 224))
+
+
+def embed_images(image_pillow_objs):
+    """Computes the configured duplicate embedding for a batch of prepared images."""
+    if use_vit_embeddings():
+        return compute_vit_embeddings(image_pillow_objs)
+    return extract_features_from_images(image_pillow_objs, ModelManager.get_model('duplicate_image_detection_model'))
+
 
 # Function to extract features from an image
 def extract_features_from_image(image_pillow_obj, model):
-    img = image_pillow_obj.resize((224, 224))
-    img_array = np.array(img)
-    img_array = np.expand_dims(img_array, axis=0)
-    img_array = preprocess_input(img_array)
-    features = model.predict(img_array)
-    return features.flatten()
+    return extract_features_from_images([image_pillow_obj], model)[0]
 
 
-async def separate_duplicate_images(
-    images_path, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task, prev_image_metadata=[]
-):
-    start_time = time.time()
-    all_images_metadata = prev_image_metadata.copy()
-    total_images = len(images_path)
-    processed_files = set()
+# Function to extract features from a batch of images with a single model call
+def extract_features_from_images(image_pillow_objs, model):
+    # TensorFlow is imported on first use, workers in ViT embedding mode never load it
+    from tensorflow.keras.applications.resnet50 import preprocess_input  # type: ignore
 
-    # Step 1: Generate embeddings from local files
-    image_features = []
+    img_batch = np.stack([np.array(img.resize((224, 224))) for img in image_pillow_objs])
+    img_batch = preprocess_input(img_batch)
+    # predict_on_batch skips the per-call data adapter / callback setup that predict() pays
+    features = np.asarray(model.predict_on_batch(img_batch))
+    return features.reshape(len(image_pillow_objs), -1)
+
+
+# Function to find byte identical and near identical images before any CNN pass
+def find_hash_duplicates(images_path, max_distance):
+    """
+    Groups exact and near-exact copies using a SHA-256 content hash and a 64-bit dHash.
+
+    Returns:
+        list: Groups of two or more positions in `images_path` of images that are copies of each other.
+    """
+    hashed_images, content_hashes, thumbnails = [], [], []
     for idx, image in enumerate(images_path):
         try:
-            start_emb_time = time.time()
-            image_path = image['local_path']
-            image_name = image['name']
-            
-            # Load image directly from disk
-            with Image.open(image_path) as image_pil:
-                features = extract_features_from_image(
-                    image_pillow_obj=image_pil.convert("RGB"), 
-                    model=duplicate_model
-                )
-            
-            image_features.append({
-                'name': image_name,
-                'features': features,
-                'local_path': image_path,
-                'content_type': image['content_type']
-            })
-            
-            print(f"Features for Image {idx + 1}/{total_images} extracted in {time.time() - start_emb_time:.2f}s")
-            
-            # Update progress
-            progress = round(((idx + 1) / total_images) * 33.3, 2)
-            task.update_state(
-                state="PROGRESS",
-                meta={"progress": progress, "info": f"Processing {image_name}"}
-            )
-
-        except Exception as e:
-            task.update_state(
-                state="PROGRESS",
-                meta={"progress": progress, "info": f"Error processing {image_name}: {str(e)}"}
-            )
+            with open(image['local_path'], 'rb') as f:
+                image_bytes = f.read()
+            with Image.open(io.BytesIO(image_bytes)) as image_pil:
+                thumbnails.append(dhash_thumbnail(image_pil))
+            content_hashes.append(content_hash(image_bytes))
+            hashed_images.append(idx)
+        except Exception:
+            # undecodable images are reported by the feature extraction step
             continue
 
-    # Step 2: Detect duplicates using cosine similarity
+    if len(hashed_images) < 2:
+        return []
+
+    # all thumbnails are hashed together in one vectorized pass
+    groups = find_hash_duplicate_groups(content_hashes, dhash_batch(thumbnails), max_distance)
+    return [[hashed_images[idx] for idx in group] for group in groups]
+
+
+def find_embedding_duplicates(embedded_features, task, progress_offset=33.3, progress_span=33.3):
+    """
+    Runs the similarity search over the extracted features and returns the positions (in
+    `embedded_features`) of every image that belongs to a duplicate cluster. Positions, not names,
+    so two different images sharing a file name are never decided together.
+
+    Args:
+        embedded_features (list): Image dicts with 'name', 'features', 'captured_at' and 'camera_id'.
+        task: The celery task used for progress updates.
+        progress_offset (float): Progress already reported before the similarity search starts.
+        progress_span (float): Share of the total progress covered by the similarity search.
+    """
     duplicates = set()
-    if image_features:
-        try:
-            features_matrix = np.array([x['features'] for x in image_features])
-            similarity_matrix = cosine_similarity(features_matrix)
-            
-            for i in range(len(image_features)):
-                for j in range(i + 1, len(image_features)):
-                    if similarity_matrix[i][j] > settings.BLUR_IMAGE_THRESHOLD:
-                        duplicates.add(image_features[i]['name'])
-                        duplicates.add(image_features[j]['name'])
-                        
-                # Update progress
-                progress = round(33.3 + ((i + 1) / len(image_features)) * 33.3, 2)
-                task.update_state(
-                    state="PROGRESS",
-                    meta={"progress": progress, "info": "Analyzing similarities"}
-                )
-        except Exception as e:
+    if not embedded_features:
+        return duplicates
+
+    try:
+        def similarity_progress(rows_done, total_rows):
             task.update_state(
                 state="PROGRESS",
-                meta={"progress": 66.6, "info": f"Similarity analysis failed: {str(e)}"}
+                meta={"progress": round(progress_offset + (rows_done / total_rows) * progress_span, 2), "info": "Analyzing similarities"}
             )
 
-    # Step 3: Process duplicates and non-duplicates
-    async def process_image(img_data, is_duplicate):
+        # Large folders switch to the approximate HNSW search, pairs are merged into clusters with union-find
+        duplicate_clusters = find_duplicate_clusters(
+            features=[x['features'] for x in embedded_features],
+            threshold=duplicate_threshold(),
+            max_block_mb=settings.DUPLICATE_SIMILARITY_MAX_BLOCK_MB,
+            ann_min_images=settings.DUPLICATE_ANN_MIN_IMAGES,
+            ann_neighbours=settings.DUPLICATE_ANN_NEIGHBOURS,
+            ann_ef=settings.DUPLICATE_ANN_EF,
+            # Burst pruning: only shots inside the EXIF time window are compared
+            capture_times=[x['captured_at'] for x in embedded_features],
+            time_window_sec=settings.DUPLICATE_TIME_WINDOW_SEC,
+            camera_ids=[x['camera_id'] for x in embedded_features] if settings.DUPLICATE_SAME_CAMERA_ONLY else None,
+            untimed_full_scan=settings.DUPLICATE_UNTIMED_FULL_SCAN,
+            file_order_window=settings.DUPLICATE_FILE_ORDER_WINDOW,
+            progress_callback=similarity_progress
+        )
+        duplicates.update(idx for cluster in duplicate_clusters for idx in cluster)
+        print(f"Found {len(duplicate_clusters)} duplicate clusters, {len(duplicates)} duplicate images")
+    except Exception as e:
+        task.update_state(
+            state="PROGRESS",
+            meta={"progress": round(progress_offset + progress_span, 2), "info": f"Similarity analysis failed: {str(e)}"}
+        )
+    return duplicates
+
+
+async def upload_duplicate_results(image_features, duplicates, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task, progress_offset=66.6, checkpoint=None):
+    """
+    Uploads every image to the Duplicate or FineCollection folder, removes the local copies and
+    returns the metadata of the uploaded images. Images the checkpoint lists as uploaded by an
+    earlier attempt are not uploaded again, their recorded metadata is returned instead.
+    """
+    images_metadata = []
+    processed_files = set()
+    progress = progress_offset
+
+    async def process_image(idx, img_data, is_duplicate):
         try:
-            file_path = img_data['local_path']
-            if file_path in processed_files:
+            if idx in processed_files:
                 return None
 
-            # Read content just before upload
-            with open(file_path, 'rb') as f:
-                content = f.read()
+            def read_content():
+                # Read content just before upload
+                return io.BytesIO(read_image_bytes(img_data))
 
-            # Upload to appropriate folder
+            # Copy or upload to appropriate folder
             folder_type = settings.DUPLICATE_FOLDER if is_duplicate else settings.FINE_COLLECTION_FOLDER
             filename = f"{uuid4()}__{img_data['name']}"
             
-            await S3_util_obj.upload_smart_cull_images(
+            await store_culled_image(
+                image_info=img_data,
+                S3_util_obj=S3_util_obj,
                 root_folder=root_folder,
-                main_folder=inside_root_main_folder,
+                inside_root_main_folder=inside_root_main_folder,
                 upload_image_folder=folder_type,
-                image_data=io.BytesIO(content),
-                filename=filename
+                filename=filename,
+                read_image_data=read_content
             )
 
             # Generate presigned URL
@@ -388,8 +496,8 @@ async def separate_duplicate_images(
             )
 
             # Cleanup local file
-            os.remove(file_path)
-            processed_files.add(file_path)
+            release_image(img_data)
+            processed_files.add(idx)
 
             return {
                 "id": filename,
@@ -407,34 +515,191 @@ async def separate_duplicate_images(
             )
             return None
 
-    # Process all images
+    # Process all images, `duplicates` and the checkpoint hold positions in image_features
     for idx, img_data in enumerate(image_features):
-        is_dup = img_data['name'] in duplicates
-        metadata = await process_image(img_data, is_dup)
+        uploaded = checkpoint.get(str(idx)) if checkpoint else None
+        if uploaded:
+            images_metadata.append(uploaded['metadata'])
+            continue
+
+        is_dup = idx in duplicates
+        metadata = await process_image(idx, img_data, is_dup)
         if metadata:
-            all_images_metadata.append(metadata)
+            images_metadata.append(metadata)
+            if checkpoint:
+                checkpoint.record(str(idx), metadata['detection_status'], metadata=metadata)
 
         # Update progress
-        progress = round(66.6 + ((idx + 1) / len(image_features)) * 33.3, 2)
+        progress = round(progress_offset + ((idx + 1) / len(image_features)) * (100 - progress_offset), 2)
         task.update_state(
             state="PROGRESS",
             meta={"progress": progress, "info": "Finalizing uploads"}
         )
 
+    return images_metadata
+
+
+async def find_duplicates(images_path, task):
+    """
+    Hash prefilter, feature extraction and embedding duplicate search over the images.
+
+    Returns:
+        tuple: the entries to upload (features included) and the set of positions of the duplicates among them.
+    """
+    # Step 0: Hash prefilter, exact and near-exact copies are duplicates without a CNN forward pass
+    progress = 0.0
+    # positions in images_path, images sharing a name are still told apart
+    hash_duplicates = set()
+    skip_embedding = set()
+    if settings.DUPLICATE_HASH_PREFILTER:
+        try:
+            for group in find_hash_duplicates(images_path, settings.DUPLICATE_HASH_MAX_DISTANCE):
+                hash_duplicates.update(group)
+                # the first copy stays in the CNN step so other near duplicates can still match the group
+                skip_embedding.update(group[1:])
+            print(f"Hash prefilter marked {len(hash_duplicates)} images as duplicates, {len(skip_embedding)} skip feature extraction")
+        except Exception as e:
+            task.update_state(
+                state="PROGRESS",
+                meta={"progress": progress, "info": f"Hash prefilter failed: {str(e)}"}
+            )
+    images_to_embed = [{**image, 'source_index': idx} for idx, image in enumerate(images_path) if idx not in skip_embedding]
+
+    # Step 1: Generate embeddings from local files in fixed size batches
+    image_features = []
+    # position in images_path of every entry of image_features
+    feature_sources = []
+    cache = get_inference_cache()
+    decode_min_side = embedding_decode_min_side()
+    cache_model_id = embedding_cache_model_id(decode_min_side)
+    batch_size = max(1, int(settings.DUPLICATE_FEATURE_BATCH_SIZE))
+    for batch_start in range(0, len(images_to_embed), batch_size):
+        start_emb_time = time.time()
+        read_batch = []
+        for image in images_to_embed[batch_start:batch_start + batch_size]:
+            try:
+                with open(image['local_path'], 'rb') as f:
+                    image_bytes = f.read()
+                read_batch.append((image, image_bytes, content_hash(image_bytes)))
+            except Exception as e:
+                task.update_state(
+                    state="PROGRESS",
+                    meta={"progress": progress, "info": f"Error processing {image['name']}: {str(e)}"}
+                )
+
+        # Images seen by an earlier run reuse their cached features, only their EXIF header is parsed
+        cached_features = cache.get_many(
+            [image_hash for image, _, image_hash in read_batch if image.get('vit_embedding') is None], cache_model_id
+        ) if cache else {}
+        embedded_batch = []
+        decoded_batch = []
+        for image, image_bytes, image_hash in read_batch:
+            image_name = image['name']
+            try:
+                # Only the (shrunk) model input is kept in the batch
+                with Image.open(io.BytesIO(image_bytes)) as image_pil:
+                    captured_at, camera_id = read_capture_info(image_pil)
+                    image = {**image, 'captured_at': captured_at, 'camera_id': camera_id, 'content_hash': image_hash}
+                    if use_vit_embeddings() and image.get('vit_embedding') is not None:
+                        # the blur pass already produced this embedding
+                        embedded_batch.append((image, image.pop('vit_embedding')))
+                    elif image_hash in cached_features:
+                        embedded_batch.append((image, cached_features[image_hash]))
+                    else:
+                        decoded_batch.append((
+                            image,
+                            prepare_embedding_input(apply_draft(image_pil, decode_min_side).convert("RGB"))
+                        ))
+            except Exception as e:
+                task.update_state(
+                    state="PROGRESS",
+                    meta={"progress": progress, "info": f"Error processing {image_name}: {str(e)}"}
+                )
+
+        if decoded_batch:
+            try:
+                batch_features = embed_images([image_pil for _, image_pil in decoded_batch])
+                if cache:
+                    cache.put_many({image['content_hash']: features for (image, _), features in zip(decoded_batch, batch_features)}, cache_model_id)
+                embedded_batch.extend((image, features) for (image, _), features in zip(decoded_batch, batch_features))
+                print(f"Features for {len(decoded_batch)} images extracted in {time.time() - start_emb_time:.2f}s")
+            except Exception as e:
+                task.update_state(
+                    state="PROGRESS",
+                    meta={"progress": progress, "info": f"Error processing batch starting at {decoded_batch[0][0]['name']}: {str(e)}"}
+                )
+
+        for image, features in embedded_batch:
+            image_features.append({
+                'name': image['name'],
+                'features': features,
+                'local_path': image['local_path'],
+                'content_type': image['content_type'],
+                'captured_at': image['captured_at'],
+                'camera_id': image['camera_id'],
+                'url': image.get('url')
+            })
+            feature_sources.append(image['source_index'])
+
+            # Update progress
+            progress = round((len(image_features) / len(images_to_embed)) * 33.3, 2)
+            task.update_state(
+                state="PROGRESS",
+                meta={"progress": progress, "info": f"Processing {image['name']}"}
+            )
+
+    # Hash duplicates skipped the CNN, they only need to be uploaded
+    embedded_features = list(image_features)
+    for idx in sorted(skip_embedding):
+        image = images_path[idx]
+        image_features.append({'name': image['name'], 'features': None, 'local_path': image['local_path'], 'content_type': image['content_type'], 'url': image.get('url')})
+        feature_sources.append(idx)
+
+    # Step 2: Detect duplicates using cosine similarity, computed tile by tile on normalized float32 features
+    duplicates = {pos for pos, source in enumerate(feature_sources) if source in hash_duplicates}
+    # embedded_features is the head of image_features, its positions are the same
+    duplicates.update(find_embedding_duplicates(embedded_features, task))
+
+    return image_features, duplicates
+
+
+async def separate_duplicate_images(
+    images_path, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task, prev_image_metadata=[], checkpoint=None, decision_checkpoint=None
+):
+    start_time = time.time()
+    all_images_metadata = prev_image_metadata.copy()
+
+    # A retry reuses the decisions of the attempt that already started uploading
+    resumed = resume_duplicate_decisions(decision_checkpoint)
+    if resumed:
+        image_features, duplicates = resumed
+    else:
+        image_features, duplicates = await find_duplicates(images_path, task)
+        if decision_checkpoint:
+            record_duplicate_decisions(decision_checkpoint, image_features, duplicates)
+
+    # Step 3: Process duplicates and non-duplicates
+    all_images_metadata.extend(await upload_duplicate_results(
+        image_features, duplicates, root_folder, inside_root_main_folder, folder_id, S3_util_obj, task, checkpoint=checkpoint
+    ))
+
     # Cleanup any remaining files
     for img in images_path:
-        if img['local_path'] not in processed_files and os.path.exists(img['local_path']):
+        if os.path.exists(img['local_path']):
             os.remove(img['local_path'])
 
+    inference_cache = cache_stats()
     task.update_state(
         state="SUCCESS",
-        meta={"progress": 100, "info": "Duplicate processing complete"}
+        meta={"progress": 100, "info": "Duplicate processing complete", "inference_cache": inference_cache, "thread_budget": current_thread_budget()}
     )
     
     print(f"Total time: {time.time() - start_time:.2f}s")
     return {
         "status": "SUCCESS",
-        "images_metadata": all_images_metadata
+        "images_metadata": all_images_metadata,
+        "inference_cache": inference_cache,
+        "thread_budget": current_thread_budget()
     }
 
 
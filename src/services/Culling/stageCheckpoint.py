@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+from src.config.settings import get_settings
+from src.utils.jobManifestStore import sweep_stale_job_dirs, task_job_id
+
+settings = get_settings()
+
+
+def _encode(value):
+    # presigned URL validity in the uploaded images metadata
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj:dict):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+class StageCheckpoint:
+    """
+    Append-only manifest of the images a culling stage already finished, one JSON line per image.
+    Images are keyed by their position in the stage's input list, which a retry receives unchanged,
+    so different images sharing a file name keep separate records.
+
+    Celery autoretries re-run a stage from the start. With a checkpoint the retried stage restores
+    the outcome and uploaded image metadata of every finished image and only processes the rest,
+    so nothing is uploaded twice under a new name. Lines are flushed one by one, a crash loses at
+    most the image that was being written.
+    """
+
+    def __init__(self, job_id:str, stage:str, checkpoint_dir:str=None):
+        self.job_id = str(job_id)
+        self.stage = stage
+        self.path = os.path.join(checkpoint_dir or settings.CULLING_CHECKPOINT_DIR, self.job_id, f"{stage}.jsonl")
+        self._lock = threading.Lock()
+        self._records = self._load()
+
+    def _load(self) -> dict:
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook=_decode)
+                except json.JSONDecodeError:
+                    # a line cut short by a crash, that image is simply processed again
+                    continue
+                records[record['name']] = record
+        if records:
+            print(f"Checkpoint {self.job_id}/{self.stage}: resuming after {len(records)} finished images")
+        return records
+
+    def get(self, key:str):
+        """Returns the record of a finished image, None when it still has to be processed."""
+        return self._records.get(key)
+
+    def remaining(self, images:list) -> list:
+        """The images of `images` without a record, each copied with its key under 'checkpoint_key'."""
+        return [{**image, 'checkpoint_key': str(pos)} for pos, image in enumerate(images) if str(pos) not in self._records]
+
+    def completed(self, outcome:str=None) -> list:
+        """Records of the finished images, optionally only those with the given outcome."""
+        return [record for record in self._records.values() if outcome is None or record['outcome'] == outcome]
+
+    def record(self, key:str, outcome:str, metadata:dict=None, image:dict=None):
+        """
+        Marks an image as finished.
+
+        Args:
+            key (str): Position of the image in the stage's input, the 'checkpoint_key' set by `remaining`.
+            outcome (str): Stage decision, e.g. 'blurred' or 'sharp'.
+            metadata (dict): Metadata of the uploaded image, when the stage uploaded it.
+            image (dict): Entry handed to the next stage, when the image goes on.
+        """
+        self.record_many([(key, outcome, metadata, image)])
+
+    def record_many(self, records:list):
+        """Marks several images as finished at once, `records` holds (key, outcome, metadata, image) tuples."""
+        lines = [
+            json.dumps({'name': key, 'outcome': outcome, 'metadata': metadata, 'image': image}, default=_encode)
+            for key, outcome, metadata, image in records
+        ]
+        if not lines:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            for line in lines:
+                record = json.loads(line, object_hook=_decode)
+                self._records[record['name']] = record
+
+
+def record_duplicate_decisions(checkpoint, image_features:list, duplicates:set):
+    """
+    Stores the outcome of the duplicate search, before any of its images is uploaded.
+    `duplicates` holds positions in `image_features`, records are keyed by that position.
+    """
+    checkpoint.record_many([
+        (str(idx), 'duplicate' if idx in duplicates else 'unique', None,
+         {'name': image['name'], 'local_path': image.get('local_path'), 'content_type': image['content_type'], 'url': image.get('url')})
+        for idx, image in enumerate(image_features)
+    ])
+
+
+def resume_duplicate_decisions(checkpoint):
+    """
+    Outcome of the duplicate search of an earlier attempt. Its uploaded files are gone, so the
+    search can't run again over the same images.
+
+    Returns:
+        tuple: the entries to upload and the set of positions of the duplicates, None when nothing was recorded.
+    """
+    records = checkpoint.completed() if checkpoint else []
+    if not records:
+        return None
+    records.sort(key=lambda record: int(record['name']))
+    return [record['image'] for record in records], {int(record['name']) for record in records if record['outcome'] == 'duplicate'}
+
+
+def job_checkpoint(task, stage:str):
+    """
+    Checkpoint of a stage for the culling job the task belongs to, None when checkpointing is off.
+
+    The job is identified by the root task of the chain (culling_task), which stays the same for
+    every stage and across retries.
+    """
+    if not settings.CULLING_CHECKPOINT_ENABLED or task is None:
+        return None
+    job_id = task_job_id(task)
+    if not job_id:
+        return None
+    return StageCheckpoint(job_id, stage)
+
+
+def clear_job_checkpoints(job_id:str):
+    """Removes every checkpoint of a finished job, and those of failed or abandoned jobs past their TTL."""
+    if job_id:
+        shutil.rmtree(os.path.join(settings.CULLING_CHECKPOINT_DIR, str(job_id)), ignore_errors=True)
+    sweep_stale_checkpoints(settings.CULLING_CHECKPOINT_DIR, settings.CULLING_CHECKPOINT_TTL_SEC)
+
+
+def sweep_stale_checkpoints(checkpoint_dir:str, max_age_sec:float) -> int:
+    """Removes the checkpoints of failed or abandoned jobs none of whose stages wrote for `max_age_sec`."""
+    removed = sweep_stale_job_dirs(checkpoint_dir, max_age_sec)
+    if removed:
+        print(f"Removed the checkpoints of {removed} stale culling jobs")
+    return removed
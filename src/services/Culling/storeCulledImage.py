@@ -0,0 +1,41 @@
+from botocore.exceptions import ClientError
+from src.config.settings import get_settings
+
+settings = get_settings()
+
+
+async def store_culled_image(image_info:dict, S3_util_obj, root_folder:str, inside_root_main_folder:str, upload_image_folder:str, filename:str, read_image_data) -> str:
+    """
+    Puts a classified image into its result folder (Blur, ClosedEye, Duplicate or FineCollection).
+
+    With CULLING_RESULT_MODE 'copy' the original pre-cull object is copied server side, the
+    image keeps its original bytes and nothing is encoded or sent from the worker. Otherwise,
+    or when the image has no source object in the bucket, `read_image_data` is called for the
+    file-like object to upload, so the re-encode only happens when the image is uploaded.
+
+    Returns:
+        str: 'copy' or 'upload', how the image was stored.
+    """
+    source_key = S3_util_obj.key_from_url(image_info['url']) if settings.CULLING_RESULT_MODE == 'copy' and image_info.get('url') else None
+    if source_key:
+        try:
+            await S3_util_obj.copy_smart_cull_image(
+                source_key=source_key,
+                root_folder=root_folder,
+                main_folder=inside_root_main_folder,
+                upload_image_folder=upload_image_folder,
+                filename=filename
+            )
+            return 'copy'
+        except ClientError as e:
+            # e.g. the pre-cull object is gone, the local copy is still there to upload
+            print(f"Server side copy of {source_key} failed, uploading {image_info['name']} instead: {str(e)}")
+
+    await S3_util_obj.upload_smart_cull_images(
+        root_folder=root_folder,
+        main_folder=inside_root_main_folder,
+        upload_image_folder=upload_image_folder,
+        image_data=read_image_data(),
+        filename=filename
+    )
+    return 'upload'
@@ -9,6 +9,7 @@ from src.config.syncDatabase import celery_sync_session
 from src.model.CullingFolders import CullingFolder
 from src.model.CullingImagesMetaData import TemporaryImageURL
 from src.utils.S3Utils import S3Utils
+from src.utils.jobManifestStore import delete_job_manifests, is_manifest_ref, load_manifest
 from tqdm import tqdm
 from src.utils.UpdateUserStorage import sync_update_user_storage_in_db
 from src.utils.UpsertMetaDataToDB import insert_image_metadata, sync_upsert_folder_metadata_DB
@@ -77,6 +78,9 @@ def rollback_changes(user_id, workspace_id, folder_name, output_validated_storag
 )
 def upload_preculling_images_and_insert_metadata(self, user_id, image_paths, folder_name, workspace_id, output_validated_storage):
     self.update_state(state='STARTED', meta={'status': 'Task started'})
+    # callers may pass a manifest reference instead of the path list
+    manifest_ref = image_paths if is_manifest_ref(image_paths) else None
+    image_paths = load_manifest(image_paths)
     
     presigned_image_record = []
     total_images = len(image_paths)
@@ -148,6 +152,9 @@ def upload_preculling_images_and_insert_metadata(self, user_id, image_paths, fol
     except Exception as cleanup_error:
         # Log the error; you might want to use proper logging in production instead of print.
         print(f"Error cleaning up folder {folder_to_remove}: {cleanup_error}")
+
+    if manifest_ref:
+        delete_job_manifests(manifest_ref['job_id'])
     
     return presigned_image_record
 
@@ -7,14 +7,20 @@ from src.config.settings import get_settings
 from src.services.Culling.separateClosedEye import ClosedEyeDetection
 from src.config.syncDatabase import celery_sync_session
 from src.services.Culling.separateDuplicateImages import separate_duplicate_images
+from src.services.Culling.stageCheckpoint import clear_job_checkpoints, job_checkpoint
+from src.services.Culling.fusedCulling import cull_images_fused, merge_shard_results, separate_images_fused
 from src.utils.UpsertMetaDataToDB import insert_image_metadata
 from src.utils.CustomExceptions import SignatureDoesNotMatch, URLExpiredException
 from src.utils.S3Utils import S3Utils
+from src.utils.progressThrottle import ProgressThrottle
+from src.utils.imageStream import S3ImageStream, planned_images
+from src.utils.jobManifestStore import delete_job_manifests, load_manifest, store_manifest, task_job_id
 from src.Celery.utils import create_celery
 import requests
 from sqlalchemy import delete, select
 from src.model.CullingFolders import CullingFolder
-from celery import chain
+from celery import chain, chord
+from celery.result import GroupResult
 from sqlalchemy.orm.attributes import flag_modified
 
 #-----instances----
@@ -72,9 +78,36 @@ def bulk_save(images_record: list, folder_id:str):
 
 #---------------------Independenst Task For Culling------------------------------------------------
 
-#This task is used to get images from AWS server from the link which have provided as param to it 
-@celery.task(name='get_images_from_aws', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries':5}, queue='culling')
-def get_images_from_aws(self, uploaded_images_url:list, local_folder_path):
+# Helper function downloading one image by its presigned URL, for URLs outside the culling bucket
+def download_presigned_image(image_url:str, local_path:str):
+    try:
+        # Stream download to avoid memory overload
+        response = requests.get(image_url, stream=True)
+        response.raise_for_status()  # Check HTTP errors first
+
+        with open(local_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=8192):
+                f.write(chunk)
+
+    except requests.exceptions.HTTPError as e:
+        # Improved error handling using status codes
+        if response.status_code == 403:
+            raise URLExpiredException(f"Expired URL: {image_url}")
+        elif response.status_code == 404:
+            raise SignatureDoesNotMatch(f"Invalid signature: {image_url}")
+        else:
+            raise
+
+
+# Helper function downloading images to the local folder, reporting progress on the given task
+def download_images(task, uploaded_images_url:list, local_folder_path:str, progress_span:float=100):
+    """
+    Downloads the images to `local_folder_path`/images. Images of the culling bucket are fetched by
+    key, several at a time, the others one by one through their presigned URL.
+
+    Returns:
+        list: metadata + local path of every image, in the order of `uploaded_images_url`.
+    """
     images = []
     # Ensure event folder exists
     os.makedirs(local_folder_path, exist_ok=True)
@@ -83,62 +116,60 @@ def get_images_from_aws(self, uploaded_images_url:list, local_folder_path):
     path_to_save_images = os.path.join(local_folder_path, "images")
     os.makedirs(path_to_save_images, exist_ok=True)  # Safe directory creation
 
-    for index, image_url in enumerate(uploaded_images_url):
-        try:
-            # Stream download to avoid memory overload
-            response = requests.get(image_url, stream=True)
-            response.raise_for_status()  # Check HTTP errors first
-
-            # Extract filename and content type
-            image_name = image_url.split("/")[-1].split('?')[0]
-            content_type = f'image/{image_name.split(".")[-1]}'
-            
-            # Local file path
-            local_path = os.path.join(path_to_save_images, image_name)
-            
-            # Save image to disk
-            # with open(image_path, 'wb') as img_file:
-            #     img_file.write(image_content)
-                
-            with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            # Get file size from disk (more accurate)
-            image_size = os.path.getsize(local_path)
-            
-            # Store metadata + local path
-            images.append({
-                'name': image_name,
-                'content_type': content_type,
-                'size': image_size,
-                'local_path':local_path
-            })
-            # images.append(local_path)
+    # Filename and content type come from the URL
+    local_names = set()
+    for idx, image in enumerate(planned_images(uploaded_images_url)):
+        # URLs of different folders may share a file name, the later ones are prefixed with their position
+        local_name = image['name'] if image['name'] not in local_names else f"{idx}_{image['name']}"
+        local_names.add(local_name)
+        images.append({**image, 'local_path': os.path.join(path_to_save_images, local_name)})
+
+    def report_progress(done, total):
+        task.update_state(
+            state='PROGRESS',
+            meta={"progress": round(done / total * progress_span, 2), "info": f"Downloaded {done}/{total} images"}
+        )
+    progress = ProgressThrottle(report_progress, len(images), settings.S3_DOWNLOAD_PROGRESS_INTERVAL_SEC)
+
+    keys = [s3_utils.key_from_url(image['url']) if settings.S3_KEY_DOWNLOADS_ENABLED else None for image in images]
+    by_key = [(key, image['local_path']) for key, image in zip(keys, images) if key]
+    if by_key:
+        results = asyncio.run(s3_utils.download_objects(
+            by_key,
+            max_concurrency=settings.S3_DOWNLOAD_CONCURRENCY,
+            progress_callback=lambda done, total: progress.update(done)
+        ))
+        for key, _, error in results:
+            if error is not None:
+                print(f"Failed to download {key}: {str(error)}")
+                raise error
+
+    done = len(by_key)
+    for key, image in zip(keys, images):
+        if key is None:
+            download_presigned_image(image['url'], image['local_path'])
+            done += 1
+            progress.update(done)
+
+    for image in images:
+        # Get file size from disk (more accurate)
+        image['size'] = os.path.getsize(image['local_path'])
 
-            # Update progress
-            progress = ((index + 1) / len(uploaded_images_url)) * 100
-            self.update_state(
-                state='PROGRESS',
-                meta={"progress": progress, "info": f"Downloaded {image_name}"}
-            )
-            time.sleep(0.1)  # Optional: For progress visualization
-
-        except requests.exceptions.HTTPError as e:
-            # Improved error handling using status codes
-            if response.status_code == 403:
-                raise URLExpiredException(f"Expired URL: {image_url}")
-            elif response.status_code == 404:
-                raise SignatureDoesNotMatch(f"Invalid signature: {image_url}")
-            else:
-                raise
+    return images  # Returns list of metadata + local paths
+
+
+#This task is used to get images from AWS server from the link which have provided as param to it 
+@celery.task(name='get_images_from_aws', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries':5}, queue='culling')
+def get_images_from_aws(self, uploaded_images_url:list, local_folder_path):
+    images = download_images(self, uploaded_images_url, local_folder_path)
 
     self.update_state(
         state='SUCCESS',
         meta={"progress": 100, "info": "All images downloaded locally"}
     )
     time.sleep(0.4)
-    return images  # Returns list of metadata + local paths
+    # Only a reference to the list of metadata + local paths travels to the next task
+    return store_manifest(task_job_id(self), 'images', images)
 
 # @celery.task(name='get_images', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries':5}, queue='culling')
 # def get_images(self, uploaded_images_url: list):
@@ -197,6 +228,7 @@ def get_images_from_aws(self, uploaded_images_url:list, local_folder_path):
 #This task is used to separate blur images and upload them to aws server and finally return non-blur images, blur images metadata
 @celery.task(name='blur_image_separation', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries':3}, queue='culling')
 def blur_image_separation(self, images_path, user_id:str, folder:str, folder_id:int):
+    images_path = load_manifest(images_path)
     
     print()
     print()
@@ -216,24 +248,26 @@ def blur_image_separation(self, images_path, user_id:str, folder:str, folder_id:
                                                             inside_root_main_folder=folder,
                                                             folder_id=folder_id,
                                                             S3_util_obj=s3_utils,
-                                                            task=self
+                                                            task=self,
+                                                            checkpoint=job_checkpoint(self, 'blur')
                                                         ))  
-    return output_from_blur
+    return store_manifest(task_job_id(self), 'blur', output_from_blur)
 
 #This task is used to separate closed eye images and upload them to aws server and finally return non-closed-eye images, closed-eye images metadata
 @celery.task(name='closed_eye_separation', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
 def closed_eye_separation(self, output_from_blur:dict, user_id:str, folder:str, folder_id:int):
+    output_from_blur = load_manifest(output_from_blur)
     non_blur_images = output_from_blur.get('non_blur_images')
     images_metadata = output_from_blur.get('images_metadata')
 
     if len(non_blur_images)==0 and len(images_metadata)!=0:
         self.update_state(state='SUCCESS', meta={'progress': 100, 'info': "Closed eye images separation completed!"})
         # time.sleep(1)
-        return {
+        return store_manifest(task_job_id(self), 'closed_eye', {
             'status': 'closed_eye_warning',
             'message': "No images were found to detect closed eye, only blurred images were processed.",
             'images_metadata': images_metadata
-        }
+        })
     
     if len(non_blur_images)==0 and len(images_metadata)==0:
         return {
@@ -255,28 +289,30 @@ def closed_eye_separation(self, output_from_blur:dict, user_id:str, folder:str,
     result = asyncio.run(closed_eye_detect_obj.separate_closed_eye_images_and_upload_to_s3(     prev_images_metadata=images_metadata,
                                                                                                 images_path=non_blur_images, 
                                                                                                 task=self, 
-                                                                                                folder_id=folder_id
+                                                                                                folder_id=folder_id,
+                                                                                                checkpoint=job_checkpoint(self, 'closed_eye')
                                                                                             ))
-    return result
+    return store_manifest(task_job_id(self), 'closed_eye', result)
 
 #This task is used to separate duplicate images and upload them to aws server and finally return fine collection and duplicate images metadata
 @celery.task(name='duplicate_image_separation', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
 def duplicate_image_separation(self, output_from_closed_eye:dict, user_id:str, folder:str, folder_id:int):
+    output_from_closed_eye = load_manifest(output_from_closed_eye)
     if output_from_closed_eye.get('status') == 'error':
         return(output_from_closed_eye.get('message'))
     
     if output_from_closed_eye.get('status') == 'closed_eye_warning':
-        return output_from_closed_eye
+        return store_manifest(task_job_id(self), 'duplicate', output_from_closed_eye)
     
     if output_from_closed_eye.get('status')=='SUCCESS':
         if not output_from_closed_eye.get('open_eye_images') and output_from_closed_eye.get('images_metadata'):
             self.update_state(state='SUCCESS', meta={'progress': 100, 'info': "Duplicate images separation completed!"})
             # time.sleep(1)
-            return {
+            return store_manifest(task_job_id(self), 'duplicate', {
                 'status': 'duplicate_images_warning',
                 'message': "No images were found to detect duplicate, only closed eye and blurred images are processed.",
                 'images_metadata': output_from_closed_eye.get('images_metadata')
-            }
+            })
     print()
     print()
     print()
@@ -289,20 +325,135 @@ def duplicate_image_separation(self, output_from_closed_eye:dict, user_id:str, f
                                                    inside_root_main_folder=folder,
                                                    S3_util_obj=s3_utils,
                                                    task=self,
-                                                   images_path=output_from_closed_eye.get('open_eye_images')
+                                                   images_path=output_from_closed_eye.get('open_eye_images'),
+                                                   checkpoint=job_checkpoint(self, 'duplicate'),
+                                                   decision_checkpoint=job_checkpoint(self, 'duplicate_decisions')
                                                     ))
     
     print()
     print()
     print('all images metadata len',len(result.get('images_metadata')))
-    return result
+    return store_manifest(task_job_id(self), 'duplicate', result)
     
 
 
+#This task runs blur, closed eye and duplicate separation in one pass, decoding every image only once, and returns all images metadata
+@celery.task(name='fused_image_separation', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
+def fused_image_separation(self, images_path, user_id:str, folder:str, folder_id:int):
+    images_path = load_manifest(images_path)
+    # Validation
+    if not folder or not folder_id:
+        raise ValueError("Invalid folder or folder_id. Both must be provided.")
+    
+    if not images_path:
+        raise ValueError("No images provided for processing.")
+
+    print("total images received", len(images_path))
+
+    result = asyncio.run(separate_images_fused(
+                                                images_path=images_path,
+                                                root_folder=user_id,
+                                                inside_root_main_folder=folder,
+                                                folder_id=folder_id,
+                                                S3_util_obj=s3_utils,
+                                                task=self,
+                                                checkpoints={stage: job_checkpoint(self, stage) for stage in ('cull', 'duplicate', 'duplicate_decisions')}
+                                            ))
+    print('all images metadata len', len(result.get('images_metadata')))
+    return store_manifest(task_job_id(self), 'fused', result)
+
+
+#This task streams the images from S3 into the fused blur, closed eye and duplicate pass, without downloading the folder first
+@celery.task(name='streaming_image_separation', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
+def streaming_image_separation(self, uploaded_images_url:list, user_id:str, folder:str, folder_id:int, local_folder_path:str):
+    if not folder or not folder_id:
+        raise ValueError("Invalid folder or folder_id. Both must be provided.")
+
+    if not uploaded_images_url:
+        raise ValueError("No images provided for processing.")
+
+    print("total images received", len(uploaded_images_url))
+
+    # Images beyond the memory budget are spilled next to where the downloaded folder would be
+    with S3ImageStream(s3_utils, spill_folder=os.path.join(local_folder_path, "spill")) as image_stream:
+        result = asyncio.run(separate_images_fused(
+                                                    images_path=planned_images(uploaded_images_url),
+                                                    root_folder=user_id,
+                                                    inside_root_main_folder=folder,
+                                                    folder_id=folder_id,
+                                                    S3_util_obj=s3_utils,
+                                                    task=self,
+                                                    checkpoints={stage: job_checkpoint(self, stage) for stage in ('cull', 'duplicate', 'duplicate_decisions')},
+                                                    image_stream=image_stream
+                                                ))
+    print('all images metadata len', len(result.get('images_metadata')))
+    return store_manifest(task_job_id(self), 'streaming', result)
+
+
+#This task downloads one shard of the folder and runs blur, closed eye and duplicate feature extraction on it
+@celery.task(name='cull_shard', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
+def cull_shard(self, shard_urls:list, user_id:str, folder:str, folder_id:int, local_folder_path:str):
+    # Download is the first fifth of a shard's progress
+    images_path = download_images(self, shard_urls, local_folder_path, progress_span=20)
+    print(f"shard images received {len(images_path)}")
+
+    culled = asyncio.run(cull_images_fused(
+                                            images_path=images_path,
+                                            root_folder=user_id,
+                                            inside_root_main_folder=folder,
+                                            folder_id=folder_id,
+                                            S3_util_obj=s3_utils,
+                                            task=self,
+                                            progress_offset=20,
+                                            progress_span=80,
+                                            # the shard's task id survives its retries
+                                            checkpoint=job_checkpoint(self, f"cull_shard_{self.request.id}")
+                                        ))
+    self.update_state(state='SUCCESS', meta={'progress': 100, 'info': 'Shard culled', 'blur_tiers': culled['blur_tiers']})
+    return store_manifest(task_job_id(self), f"cull_shard_{self.request.id}", culled)
+
+
+#This task merges the culled shards, runs the duplicate search over the whole folder and returns all images metadata
+@celery.task(name='merge_culling_shards', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
+def merge_culling_shards(self, shard_results:list, user_id:str, folder:str, folder_id:int, local_folder_path:str):
+    shard_results = [load_manifest(shard) for shard in shard_results]
+    checkpoint = job_checkpoint(self, 'duplicate')
+
+    def fetch_missing(image_features):
+        # Shards culled on another node left their files there, only those images are fetched again
+        missing = [
+            image for idx, image in enumerate(image_features)
+            if not os.path.exists(image['local_path']) and not (checkpoint and checkpoint.get(str(idx)))
+        ]
+        if missing:
+            downloaded = download_images(self, [image['url'] for image in missing], local_folder_path, progress_span=10)
+            local_paths = {image['url']: image['local_path'] for image in downloaded}
+            for image in missing:
+                image['local_path'] = local_paths[image['url']]
+
+    merged = asyncio.run(merge_shard_results(
+                                            shard_results,
+                                            root_folder=user_id,
+                                            inside_root_main_folder=folder,
+                                            folder_id=folder_id,
+                                            S3_util_obj=s3_utils,
+                                            task=self,
+                                            progress_offset=10,
+                                            checkpoint=checkpoint,
+                                            decision_checkpoint=job_checkpoint(self, 'duplicate_decisions'),
+                                            fetch_missing=fetch_missing
+                                        ))
+
+    self.update_state(state='SUCCESS', meta={'progress': 100, 'info': 'Culling completed', 'blur_tiers': merged['blur_tiers']})
+    print('all images metadata len', len(merged['images_metadata']))
+    return store_manifest(task_job_id(self), 'merge', merged)
+
+
 #This task is use to bulk save images metadata into database
 @celery.task(name='bulk_save_image_metadata_db', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3}, queue='culling')
 def bulk_save_image_metadata_db(self, culled_metadata: dict, folder_id:str):
     try:
+        culled_metadata = load_manifest(culled_metadata)
         # Check for error status in culled_metadata
         if culled_metadata.get('status') == 'error':
             raise Exception(culled_metadata.get('message'))
@@ -323,10 +474,16 @@ def bulk_save_image_metadata_db(self, culled_metadata: dict, folder_id:str):
         # Ensure there's metadata to save
         if images_to_save:
             response = bulk_save(images_record=images_to_save, folder_id=folder_id)
+            # the job is done, its stage checkpoints and manifests are no longer needed
+            clear_job_checkpoints(task_job_id(self))
+            delete_job_manifests(task_job_id(self))
             self.update_state(state='SUCCESS', meta={'progress': 100, 'info': "Images save to database successfully!"})
             # time.sleep(1)
             return response
 
+        # nothing to save also ends the job
+        clear_job_checkpoints(task_job_id(self))
+        delete_job_manifests(task_job_id(self))
         return {
             "status": "NO_DATA",
             "message": "No metadata available to save to the database"
@@ -357,21 +514,51 @@ def culling_task(self, user_id:str, uploaded_images_url, folder:str, folder_id:s
     task_ids=[]
     try:
         # Chain the results
-        chain_result = chain(
-            get_images_from_aws.s(uploaded_images_url, local_folder_path),
-            blur_image_separation.s(user_id, folder, folder_id),
-            closed_eye_separation.s(user_id, folder, folder_id),
-            duplicate_image_separation.s(user_id, folder, folder_id),
-            bulk_save_image_metadata_db.s(folder_id),
-        ) 
+        if settings.CULLING_PIPELINE_MODE == 'sharded':
+            # Shards are culled in parallel on every free worker, one merge task then finds duplicates across all of them
+            shard_size = max(1, settings.CULLING_SHARD_SIZE)
+            chain_result = chain(
+                chord(
+                    [
+                        cull_shard.s(uploaded_images_url[start:start + shard_size], user_id, folder, folder_id, local_folder_path)
+                        for start in range(0, len(uploaded_images_url), shard_size)
+                    ],
+                    merge_culling_shards.s(user_id, folder, folder_id, local_folder_path)
+                ),
+                bulk_save_image_metadata_db.s(folder_id),
+            )
+        elif settings.CULLING_PIPELINE_MODE == 'streaming':
+            # Images go from S3 through memory into the fused pass, nothing is staged on disk
+            chain_result = chain(
+                streaming_image_separation.s(uploaded_images_url, user_id, folder, folder_id, local_folder_path),
+                bulk_save_image_metadata_db.s(folder_id),
+            )
+        elif settings.CULLING_PIPELINE_MODE == 'fused':
+            # Single decode per image shared by all three detectors
+            chain_result = chain(
+                get_images_from_aws.s(uploaded_images_url, local_folder_path),
+                fused_image_separation.s(user_id, folder, folder_id),
+                bulk_save_image_metadata_db.s(folder_id),
+            )
+        else:
+            chain_result = chain(
+                get_images_from_aws.s(uploaded_images_url, local_folder_path),
+                blur_image_separation.s(user_id, folder, folder_id),
+                closed_eye_separation.s(user_id, folder, folder_id),
+                duplicate_image_separation.s(user_id, folder, folder_id),
+                bulk_save_image_metadata_db.s(folder_id),
+            ) 
 
         result = chain_result.apply_async()
 
-        #to get the task id's of each one in chaining
+        #to get the task id's of each one in chaining, a chord header contributes the ids of its shard tasks
         task_ids.append(result.id)
         while result.parent:
             result = result.parent
-            task_ids.append(result.id)
+            if isinstance(result, GroupResult):
+                task_ids.extend(reversed([shard.id for shard in result.results]))
+            else:
+                task_ids.append(result.id)
 
         task_ids.reverse()  # Reverse to get the correct order of execution
         
@@ -5,8 +5,6 @@ from src.dependencies.mlModelsManager import ModelManager
 from src.config.settings import get_settings
 
 settings = get_settings()
-models = ModelManager.get_models(settings)
-face_detector = models["face_detector"]
 
 def is_face_forward_facing(detection, tolerance=0.1):
     """
@@ -58,7 +56,7 @@ def extract_face(image_content, image_name:str):
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
         # Detect faces in the image
-        detections = face_detector.detect_faces(image_rgb)
+        detections = ModelManager.get_model("face_detector").detect_faces(image_rgb)
 
         # Iterate through detected faces and save them
         face_images = []
@@ -1,3 +1,5 @@
+import asyncio
+import io
 import os
 import pickle
 import shutil
@@ -15,55 +17,123 @@ from src.dependencies.mlModelsManager import ModelManager
 from src.model.SmartShareFolders import PublishStatus, SmartShareFolder
 from src.utils.CustomExceptions import SignatureDoesNotMatch, URLExpiredException, UnauthorizedAccess
 from src.utils.MailSender import celery_send_mail
+from src.utils.progressThrottle import ProgressThrottle
+from src.utils.imageStream import S3ImageStream, image_source, planned_images, release_image
+from src.utils.S3Utils import S3Utils
 from PIL import Image
 from sqlalchemy import select
 from src.utils.template_engine import templates
 from src.utils.generateQRCode import generate_qr_code
+from src.utils.inferenceCache import get_inference_cache, inference_backend_tag
+from src.services.Culling.perceptualHash import content_hash
 
 #---instances---
 settings = get_settings()
 celery = create_celery()
+s3_utils = S3Utils(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_region=settings.AWS_REGION,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    bucket_name=settings.AWS_BUCKET_SMART_SHARE_NAME,
+                    aws_endpoint_url=settings.AWS_ENDPOINT_URL)
+
+
+def face_embedding_cache_model_id() -> str:
+    """Inference cache key of the FaceNet embeddings, ONNX and eager embeddings are kept apart."""
+    return f"facenet_vggface2:{inference_backend_tag('face_net_model')}"
 
-# #---Model---
-models = ModelManager.get_models(settings)
-mtcnn_model = models['face_detector']
-face_net_model = models['face_net_model']
 
 # Function for processing for face embedding
 def get_face_embedding(image_path):
-    """Detects faces and extracts embeddings."""
+    """
+    Detects faces and extracts embeddings, reusing cached embeddings of identical images.
+    `image_path` is the image file, or its bytes when the image was streamed into memory.
+    """
+    if isinstance(image_path, (bytes, bytearray)):
+        image_path = io.BytesIO(image_path)
+    cache = get_inference_cache()
+    if cache:
+        if isinstance(image_path, io.BytesIO):
+            image_hash = content_hash(image_path.getvalue())
+        else:
+            with open(image_path, 'rb') as f:
+                image_hash = content_hash(f.read())
+        cached_embeddings = cache.get(image_hash, face_embedding_cache_model_id())
+        if cached_embeddings is not None:
+            return cached_embeddings or None
+
+    # models are loaded on first use, not when the module is imported
+    mtcnn_model = ModelManager.get_model('face_detector')
+    face_net_model = ModelManager.get_model('face_net_model')
+
     image = Image.open(image_path).convert('RGB')
     faces = mtcnn_model(image)
 
-    if faces is None:
-        return None  # No face detected
-
     embeddings = []
-    for face in faces:
+    for face in faces if faces is not None else []:
         face = face.unsqueeze(0)  # Add batch dimension
         embedding = face_net_model(face)
         embeddings.append(embedding.detach().numpy())
 
-    return embeddings
-    
-
-#-----------------------Celery task for smart share----------------------------------
-
-@celery.task(name='download_and_process_images', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 4}, queue='smart_sharing')
-def download_and_process_images(self, user_id, user_name:str, event_id, event_name:str, event_folder_path: str, urls: list[str], index_hnswlib_filename: str, image_map_pickle_filename: str, recipients:list[str]):
-    """Downloads images from AWS, saves them locally, and processes them for face embeddings."""
+    if cache:
+        # images without faces are cached too, as an empty list
+        cache.put(image_hash, face_embedding_cache_model_id(), embeddings)
 
-    # Ensure event folder exists
-    os.makedirs(event_folder_path, exist_ok=True)
-
-    # Create 'images' directory inside event folder
-    path_to_save_images = os.path.join(event_folder_path, "images")
-    os.makedirs(path_to_save_images, exist_ok=True)  # Safe directory creation
+    return embeddings or None  # None when no face is detected
+    
 
+# Helper function downloading the event images to the local folder, reporting progress on the given task
+def download_event_images(task, urls:list, path_to_save_images:str):
     total_images = len(urls)
 
     with tqdm(total=total_images, desc="Downloading images", unit="image") as progress_bar:
-        for _,image_url in enumerate(urls):
+        def report_progress(done, total):
+            elapsed_time = progress_bar.format_dict.get("elapsed",0)
+            rate = progress_bar.format_dict.get('rate',0)
+            remaining_time = progress_bar.format_dict.get("remaining", "N/A")  # Estimated time left
+
+            # Update Celery state
+            try:
+                task.update_state(
+                    state="PROGRESS",
+                    meta={
+                        "current": "Downloading images",
+                        "total": total,
+                        "progress": f"{done / total * 100:.2f}%",
+                        "elapsed_time": elapsed_time,
+                        "remaining_time": remaining_time,
+                        "rate": rate
+                    }
+                )
+            except Exception as e:
+                print(f"Progress update error: {e}")
+        progress = ProgressThrottle(report_progress, total_images, settings.S3_DOWNLOAD_PROGRESS_INTERVAL_SEC)
+
+        def image_downloaded():
+            progress_bar.update(1)
+            progress.update(progress_bar.n)
+
+        # Images of the smart share bucket are fetched by key, several at a time
+        by_key = []
+        by_url = []
+        for image_url in urls:
+            image_path = os.path.join(path_to_save_images, image_url.split("/")[-1].split('?')[0])
+            key = s3_utils.key_from_url(image_url) if settings.S3_KEY_DOWNLOADS_ENABLED else None
+            if key:
+                by_key.append((key, image_path))
+            else:
+                by_url.append((image_url, image_path))
+
+        if by_key:
+            results = asyncio.run(s3_utils.download_objects(
+                by_key,
+                max_concurrency=settings.S3_DOWNLOAD_CONCURRENCY,
+                progress_callback=lambda done, total: image_downloaded()
+            ))
+            for key, _, error in results:
+                if error is not None:
+                    print(f"Failed to download image {key}: {error}")
+
+        for image_url, image_path in by_url:
             try:
                 response = requests.get(image_url)
                 if response.status_code !=200:
@@ -71,7 +141,6 @@ def download_and_process_images(self, user_id, user_name:str, event_id, event_na
                     continue
                 
                 image_content = response.content
-                image_name = image_url.split("/")[-1].split('?')[0]
 
                 # Check for S3 access errors
                 if b'<Error>' in image_content:
@@ -83,34 +152,41 @@ def download_and_process_images(self, user_id, user_name:str, event_id, event_na
                         raise UnauthorizedAccess()
 
                 # Save image to disk
-                image_path = os.path.join(path_to_save_images, image_name)
                 with open(image_path, 'wb') as img_file:
                     img_file.write(image_content)
-                
-                elapsed_time = progress_bar.format_dict.get("elapsed",0)
-                rate = progress_bar.format_dict.get('rate',0)
-                remaining_time = progress_bar.format_dict.get("remaining", "N/A")  # Estimated time left
-
-                # Update progress bar & Celery state
-                try:
-                    progress_bar.update(1)
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={
-                            "current": "Downloading images",
-                            "total": total_images,
-                            "progress": f"{progress_bar.n / total_images * 100:.2f}%",
-                            "elapsed_time": elapsed_time,
-                            "remaining_time": remaining_time,
-                            "rate": rate
-                        }
-                    )
-                except Exception as e:
-                    print(f"Progress update error: {e}")
+
+                image_downloaded()
                     
             except Exception as e:
                 print(f"Failed to download image {image_url}: {e}")
 
+
+#-----------------------Celery task for smart share----------------------------------
+
+@celery.task(name='download_and_process_images', bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 4}, queue='smart_sharing')
+def download_and_process_images(self, user_id, user_name:str, event_id, event_name:str, event_folder_path: str, urls: list[str], index_hnswlib_filename: str, image_map_pickle_filename: str, recipients:list[str]):
+    """Downloads images from AWS, saves them locally, and processes them for face embeddings."""
+
+    # Ensure event folder exists
+    os.makedirs(event_folder_path, exist_ok=True)
+
+    # Create 'images' directory inside event folder
+    path_to_save_images = os.path.join(event_folder_path, "images")
+    os.makedirs(path_to_save_images, exist_ok=True)  # Safe directory creation
+
+    total_images = len(urls)
+
+    if settings.SMART_SHARE_STREAMING_ENABLED:
+        # Images go from S3 straight into face detection, only what exceeds the memory budget is written to disk
+        image_stream = S3ImageStream(s3_utils, spill_folder=path_to_save_images, skip_errors=True)
+        saved_images = image_stream(planned_images(urls))
+        # images that fail to stream are skipped, they are left out of the processed count below
+        expected_images = total_images
+    else:
+        download_event_images(self, urls, path_to_save_images)
+        saved_images = [{'name': img_file, 'local_path': os.path.join(path_to_save_images, img_file)} for img_file in os.listdir(path_to_save_images)]
+        expected_images = len(saved_images)
+
     # # Step 2: Extract Face Embeddings and Build FAISS Index
     # index = faiss.IndexFlatL2(512)  # FaceNet produces 512-d embeddings
     # image_map = []
@@ -173,13 +249,13 @@ def download_and_process_images(self, user_id, user_name:str, event_id, event_na
     image_map = []
     id_counter = 0
 
-    saved_images = os.listdir(path_to_save_images)
-    total_processed_images = len(saved_images)
-
-    with tqdm(total=total_processed_images, desc="Processing images", unit="image") as progress_bar:
-        for img_file in saved_images:
-            img_path = os.path.join(path_to_save_images, img_file)
-            embeddings = get_face_embedding(img_path)
+    total_processed_images = 0
+    with tqdm(total=expected_images, desc="Processing images", unit="image") as progress_bar:
+        for image in saved_images:
+            img_file = image['name']
+            embeddings = get_face_embedding(image_source(image))
+            release_image(image)
+            total_processed_images += 1
 
             if embeddings:
                 for embedding in embeddings:
@@ -11,6 +11,7 @@ from src.model.SmartShareFolders import SmartShareFolder
 from src.model.User import User
 from src.services.SmartShare.tasks.smartShareImagesUploadingTask import upload_event_images_and_insert_metadata
 from src.utils.UpdateUserStorage import update_user_storage_in_db
+from src.utils.jobManifestStore import store_manifest
 
 settings = get_settings()
 
@@ -82,10 +83,11 @@ async def upload_smart_share_event_images(
 
         # Calculate updated storage
         updated_folder_storage = event_data.total_size + output_validated_storage
+        # only a reference to the path list goes through the broker
         task = upload_event_images_and_insert_metadata.apply_async(
             args=[
                 user_id,
-                image_paths,
+                store_manifest(str(uuid4()), 'image_paths', image_paths),
                 event_data.name,
                 event_data.id,
                 output_validated_storage
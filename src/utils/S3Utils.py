@@ -4,6 +4,7 @@ from botocore.exceptions import ClientError
 from fastapi import HTTPException,status
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
+from urllib.parse import unquote, urlparse
 from src.utils.CustomExceptions import FolderAlreadyExistsException
 
 class S3Utils:
@@ -266,7 +267,109 @@ class S3Utils:
         )
 
         return "image uploaded successfully"
-    
+
+    #It copies an object already in the bucket into a folder, the bytes never leave S3
+    async def copy_smart_cull_image(self, source_key, root_folder, main_folder, upload_image_folder, filename):
+        """
+        Copies an image of the bucket to a specific folder with a server side copy.
+
+        Objects above the multipart threshold are copied part by part (UploadPartCopy).
+
+        Args:
+            source_key (str): The S3 key of the image to copy.
+            root_folder (str): The root folder under which the main and upload folders are located.
+            main_folder (str): The main folder containing the upload folder.
+            upload_image_folder (str): The folder where the image will be copied.
+            filename (str): The name of the copied file.
+
+        Returns:
+            str: A success message.
+
+        Raises:
+            HTTPException: If the specified folders do not exist.
+        """
+        root_folder = f'{root_folder}/'
+        main_folder = f'{root_folder}{main_folder}/'
+        upload_image_folder = f'{main_folder}{upload_image_folder}/'
+
+        for folder in [root_folder, main_folder, upload_image_folder]:
+            if not await self.folder_exists(folder_key=folder):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'{folder} does not exist.')
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor,
+            lambda:self.client.copy(
+                {'Bucket': self.bucket_name, 'Key': source_key},
+                self.bucket_name,
+                f'{upload_image_folder}{filename}',
+                Config=self.transfer_config
+            )
+        )
+
+        return "image copied successfully"
+
+    #It downloads many objects at once by key, presigned URLs are not needed and can't expire mid job
+    async def download_objects(self, objects, max_concurrency=16, progress_callback=None):
+        """
+        Downloads objects of the bucket straight to local files, at most `max_concurrency` at a time.
+
+        Every object is streamed to disk through the pooled client (large objects in ranged parts),
+        a failed object doesn't stop the others.
+
+        Args:
+            objects (list): (key, local_path) pairs.
+            max_concurrency (int): Downloads running at the same time.
+            progress_callback (callable): Called with (done, total) after every finished object.
+
+        Returns:
+            list: (key, local_path, error) in the order of `objects`, error is None for downloaded objects.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max(1, int(max_concurrency or 1)))
+        done = 0
+
+        async def fetch(key, local_path):
+            nonlocal done
+            error = None
+            async with semaphore:
+                try:
+                    await loop.run_in_executor(
+                        self.executor,
+                        lambda:self.client.download_file(
+                            self.bucket_name,
+                            key,
+                            local_path,
+                            Config=self.transfer_config
+                        )
+                    )
+                except Exception as e:
+                    error = e
+            done += 1
+            if progress_callback:
+                progress_callback(done, len(objects))
+            return error
+
+        errors = await asyncio.gather(*(fetch(key, local_path) for key, local_path in objects))
+        return [(key, local_path, error) for (key, local_path), error in zip(objects, errors)]
+
+    def key_from_url(self, url):
+        """
+        Returns the S3 key of an object of this bucket from its (presigned) URL, None when the URL
+        points to another bucket. Handles both virtual hosted and path style URLs.
+        """
+        parsed = urlparse(url)
+        key = unquote(parsed.path).lstrip('/')
+        host = parsed.hostname or ''
+        if host.startswith(f'{self.bucket_name}.'):
+            return key or None
+        if '.s3.' in host or '.s3-' in host:
+            # virtual hosted URL of another bucket, its key may well start with our bucket's name
+            return None
+        if key.startswith(f'{self.bucket_name}/'):
+            return key[len(self.bucket_name) + 1:] or None
+        return None
+
         #This will upload the prdicted images to right folder like blur goes in blur_image_folder and vice versa
     async def upload_smart_share_images(self, root_folder, event_folder, image_data, filename):
         """
@@ -3,9 +3,6 @@ from src.config.settings import get_settings
 from src.dependencies.mlModelsManager import ModelManager
 
 settings = get_settings()
-models = ModelManager.get_models(settings)
-embedding_img_processor = models["embedding_img_processor"]
-embedding_model = models["embedding_model"]
 
 def generate_embeddings(image_name: str, image_pillow_obj):
     """
@@ -45,6 +42,9 @@ def generate_embeddings(image_name: str, image_pillow_obj):
         # with torch.no_grad():  # Disable gradient calculation
         #     outputs = model.encode_image(inputs)
 
+        embedding_img_processor = ModelManager.get_model("embedding_img_processor")
+        embedding_model = ModelManager.get_model("embedding_model")
+
         image = embedding_img_processor(image_pillow_obj, return_tensors="pt")
 
         pixel_values = image['pixel_values'].to(device)
@@ -0,0 +1,151 @@
+import os
+import shutil
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src.config.settings import get_settings
+
+settings = get_settings()
+
+
+def planned_images(urls:list) -> list:
+    """Entries ('name', 'content_type', 'url') of the images behind presigned URLs, before anything is fetched."""
+    images = []
+    for url in urls:
+        name = url.split("/")[-1].split('?')[0]
+        images.append({'name': name, 'content_type': f'image/{name.split(".")[-1]}', 'url': url})
+    return images
+
+
+def image_source(image_info:dict):
+    """The image's bytes when it is held in memory, otherwise the path of its local file."""
+    content = image_info.get('content')
+    return content if content is not None else image_info['local_path']
+
+
+def read_image_bytes(image_info:dict) -> bytes:
+    content = image_info.get('content')
+    if content is not None:
+        return content
+    with open(image_info['local_path'], 'rb') as f:
+        return f.read()
+
+
+def release_image(image_info:dict):
+    """Drops the image's in-memory bytes (returning them to the memory budget) or removes its local file."""
+    content = image_info.pop('content', None)
+    budget = image_info.pop('memory_budget', None)
+    if content is not None and budget is not None:
+        budget.release(len(content))
+    local_path = image_info.get('local_path')
+    if local_path and os.path.exists(local_path):
+        os.remove(local_path)
+
+
+class MemoryBudget:
+    """Bytes of image data a job may hold in memory at once, shared by the fetch threads."""
+
+    def __init__(self, limit_bytes:int):
+        self.limit_bytes = limit_bytes
+        self.held_bytes = 0
+        self._lock = threading.Lock()
+
+    def try_reserve(self, size:int) -> bool:
+        with self._lock:
+            if self.held_bytes + size > self.limit_bytes:
+                return False
+            self.held_bytes += size
+            return True
+
+    def release(self, size:int):
+        with self._lock:
+            self.held_bytes = max(0, self.held_bytes - size)
+
+
+class S3ImageStream:
+    """
+    Feeds images from S3 GetObject straight to their consumer, without staging them on disk first.
+
+    Calling the stream with image entries returns a generator of the same entries, in order, each
+    with its bytes under 'content'. At most `queue_size` images are fetched ahead of the consumer,
+    a slow consumer stops the fetching (backpressure) instead of letting it pile up in memory.
+    Once the bytes held in memory reach `memory_budget_mb` further images are spilled to a file in
+    `spill_folder` and carry a 'local_path' instead, consumers read both through `read_image_bytes`
+    and give them back with `release_image`.
+    """
+
+    def __init__(self, S3_util_obj, spill_folder:str, memory_budget_mb:float=None, queue_size:int=None, max_concurrency:int=None, skip_errors:bool=False):
+        self.S3 = S3_util_obj
+        self.spill_folder = spill_folder
+        self.budget = MemoryBudget(int((memory_budget_mb or settings.STREAMING_MEMORY_BUDGET_MB) * 1024 * 1024))
+        self.queue_size = max(1, int(queue_size or settings.STREAMING_QUEUE_SIZE))
+        self.max_concurrency = max(1, int(max_concurrency or settings.S3_DOWNLOAD_CONCURRENCY))
+        # failed images are logged and left out instead of failing the stream
+        self.skip_errors = skip_errors
+        self.spilled = 0
+
+    def __call__(self, images:list):
+        images = iter(images)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for image in images:
+                pending.append((image, executor.submit(self.fetch, image)))
+                if len(pending) >= self.queue_size:
+                    break
+            while pending:
+                image, future = pending.popleft()
+                # one more fetch is started only when the consumer takes an image
+                next_image = next(images, None)
+                if next_image is not None:
+                    pending.append((next_image, executor.submit(self.fetch, next_image)))
+                try:
+                    fetched = future.result()
+                except Exception as e:
+                    if not self.skip_errors:
+                        raise
+                    print(f"Failed to fetch image {image['name']}: {str(e)}")
+                    continue
+                yield fetched
+
+    def fetch(self, image:dict) -> dict:
+        """Reads one image into memory, or into the spill folder when the memory budget is used up."""
+        key = self.S3.key_from_url(image['url']) if image.get('url') else None
+        if key:
+            response = self.S3.client.get_object(Bucket=self.S3.bucket_name, Key=key)
+            body, size = response['Body'], response['ContentLength']
+        else:
+            response = requests.get(image['url'], stream=True)
+            response.raise_for_status()
+            body, size = response.raw, int(response.headers.get('Content-Length') or 0)
+
+        if size and self.budget.try_reserve(size):
+            content = body.read()
+            return {**image, 'content': content, 'size': len(content), 'memory_budget': self.budget}
+
+        os.makedirs(self.spill_folder, exist_ok=True)
+        # URLs of different folders may share a file name, the prefix keeps their spill files apart
+        local_path = os.path.join(self.spill_folder, f"{uuid.uuid4().hex}_{image['name']}")
+        with open(local_path, 'wb') as f:
+            shutil.copyfileobj(body, f, 1024 * 1024)
+        self.spilled += 1
+        return {**image, 'local_path': local_path, 'size': os.path.getsize(local_path)}
+
+    def restore(self, images:list):
+        """Fetches again the images of an earlier attempt whose bytes are gone, a retry resumes with them."""
+        for image in images:
+            if image.get('content') is None and not (image.get('local_path') and os.path.exists(image['local_path'])):
+                image.update(self.fetch(image))
+
+    def close(self):
+        """Removes the spill folder, every image still in memory is dropped with its entry."""
+        if self.spilled:
+            print(f"Image stream spilled {self.spilled} images to {self.spill_folder}, the memory budget is {self.budget.limit_bytes // (1024 * 1024)} MB")
+        shutil.rmtree(self.spill_folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,180 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from src.config.settings import get_settings
+
+
+class InferenceCache:
+    """
+    Persistent cache of model outputs keyed by image content hash and model identifier.
+
+    Entries live in a single SQLite file so every worker process on the host shares them, and the
+    least recently used entries are evicted once the stored values grow past `max_bytes`.
+    Values are pickled, so numpy features, logits and label lists are all stored as they are.
+    A broken or locked store never fails inference, lookups then simply miss.
+    """
+
+    # Eviction needs a full size scan, it is only checked every few writes
+    EVICTION_CHECK_INTERVAL = 64
+
+    def __init__(self, path:str, max_bytes:int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+        self._writes_since_check = 0
+
+    def _connect(self):
+        # sqlite connections must not cross a fork, prefork workers each open their own
+        if self._connection is None or self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS inference_cache ("
+                "content_hash TEXT NOT NULL, model_id TEXT NOT NULL, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (content_hash, model_id))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS inference_cache_last_used ON inference_cache (last_used)")
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get_many(self, content_hashes:list, model_id:str) -> dict:
+        """
+        Looks up several images for one model.
+
+        Returns:
+            dict: content hash -> cached value, only for the hashes that were found.
+        """
+        unique_hashes = list(dict.fromkeys(content_hashes))
+        found = {}
+        try:
+            with self._lock:
+                connection = self._connect()
+                # stay under SQLite's bound parameter limit
+                for start in range(0, len(unique_hashes), 500):
+                    chunk = unique_hashes[start:start + 500]
+                    rows = connection.execute(
+                        f"SELECT content_hash, value FROM inference_cache WHERE model_id = ? AND content_hash IN ({','.join('?' * len(chunk))})",
+                        [model_id, *chunk]
+                    ).fetchall()
+                    found.update((content_hash, pickle.loads(value)) for content_hash, value in rows)
+
+                if found:
+                    now = time.time()
+                    connection.executemany(
+                        "UPDATE inference_cache SET last_used = ? WHERE content_hash = ? AND model_id = ?",
+                        [(now, content_hash, model_id) for content_hash in found]
+                    )
+                    connection.commit()
+        except (sqlite3.Error, OSError, pickle.UnpicklingError) as e:
+            print(f"Inference cache lookup failed: {e}")
+            found = {}
+
+        self.hits[model_id] += sum(1 for content_hash in content_hashes if content_hash in found)
+        self.misses[model_id] += sum(1 for content_hash in content_hashes if content_hash not in found)
+        return found
+
+    def get(self, content_hash:str, model_id:str):
+        """Returns the cached value or None."""
+        return self.get_many([content_hash], model_id).get(content_hash)
+
+    def put_many(self, items:dict, model_id:str):
+        """Stores content hash -> value pairs for one model."""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for content_hash, value in items.items():
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((content_hash, model_id, blob, len(blob), now))
+
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.executemany("INSERT OR REPLACE INTO inference_cache VALUES (?, ?, ?, ?, ?)", rows)
+                connection.commit()
+                self._writes_since_check += len(rows)
+                if self._writes_since_check >= self.EVICTION_CHECK_INTERVAL:
+                    self._writes_since_check = 0
+                    self._evict(connection)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Inference cache write failed: {e}")
+
+    def put(self, content_hash:str, model_id:str, value):
+        self.put_many({content_hash: value}, model_id)
+
+    def _evict(self, connection):
+        total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM inference_cache").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        # Drop least recently used entries until the store is back to 90% of the budget
+        to_free = total_bytes - int(self.max_bytes * 0.9)
+        freed = 0
+        stale_keys = []
+        for content_hash, model_id, size in connection.execute(
+            "SELECT content_hash, model_id, size FROM inference_cache ORDER BY last_used"
+        ):
+            stale_keys.append((content_hash, model_id))
+            freed += size
+            if freed >= to_free:
+                break
+        connection.executemany("DELETE FROM inference_cache WHERE content_hash = ? AND model_id = ?", stale_keys)
+        connection.commit()
+        print(f"Inference cache evicted {len(stale_keys)} entries ({freed / 1024 / 1024:.1f} MB)")
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this process per model, plus the size of the shared store."""
+        with self._lock:
+            entries, total_bytes = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM inference_cache"
+            ).fetchone()
+        return {
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'entries': entries,
+            'size_mb': round(total_bytes / 1024 / 1024, 2),
+        }
+
+
+@lru_cache()
+def get_inference_cache():
+    """Returns the process wide cache, or None when INFERENCE_CACHE_ENABLED is off."""
+    settings = get_settings()
+    if not settings.INFERENCE_CACHE_ENABLED:
+        return None
+    return InferenceCache(settings.INFERENCE_CACHE_PATH, int(settings.INFERENCE_CACHE_MAX_MB * 1024 * 1024))
+
+
+def cache_stats() -> dict:
+    """Stats to attach to task results, empty when the cache is disabled."""
+    cache = get_inference_cache()
+    try:
+        return cache.stats() if cache else {}
+    except (sqlite3.Error, OSError) as e:
+        return {'error': str(e)}
+
+
+def inference_backend_tag(model_name:str) -> str:
+    """
+    Part of the cache keys of models the ONNX backend can serve, ONNX and int8 outputs differ
+    slightly from the eager ones and must not be mixed with them. The tag follows the model that
+    is actually loaded, a model the ONNX conversion kept eager caches under 'torch'.
+    """
+    if get_settings().INFERENCE_BACKEND != 'onnx':
+        return 'torch'
+    # torch and the models are only imported when the ONNX backend is selected
+    from src.dependencies.mlModelsManager import ModelManager
+    from src.dependencies.onnxBackend import OnnxModelAdapter
+    model = ModelManager.get_model(model_name)
+    return model.backend_tag if isinstance(model, OnnxModelAdapter) else 'torch'
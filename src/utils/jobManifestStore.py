@@ -0,0 +1,211 @@
+import os
+import pickle
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from src.config.settings import get_settings
+
+# Marks a task argument / return value as a reference into the manifest store
+MANIFEST_REF_KEY = '__job_manifest__'
+
+
+def sweep_stale_job_dirs(root:str, max_age_sec:float) -> int:
+    """
+    Removes the per job folders under `root` none of whose files were written for `max_age_sec`,
+    those jobs failed for good or were abandoned and nothing reads them again.
+
+    Returns:
+        int: number of jobs removed.
+    """
+    if not max_age_sec or not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - max_age_sec
+    removed = 0
+    for job_id in os.listdir(root):
+        job_dir = os.path.join(root, job_id)
+        try:
+            if not os.path.isdir(job_dir):
+                continue
+            last_write = max([os.path.getmtime(entry.path) for entry in os.scandir(job_dir)], default=os.path.getmtime(job_dir))
+        except OSError:
+            # removed by another process meanwhile
+            continue
+        if last_write < cutoff:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class JobManifestStore(ABC):
+    """
+    Holds the payloads the culling and upload tasks hand to each other, keyed by job id.
+
+    Tasks `put` their (possibly large) output and return only the small reference, the next task
+    `get`s it back by that reference, so the broker and the result backend never carry image lists.
+    Values are pickled, the same format the Celery messages used before.
+    """
+
+    def put(self, job_id:str, key:str, value) -> dict:
+        """Stores a value and returns the reference to pass through Celery."""
+        self._write(str(job_id), key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        return {MANIFEST_REF_KEY: True, 'job_id': str(job_id), 'key': key}
+
+    def get(self, ref:dict):
+        """Loads the value behind a reference, KeyError when it is gone."""
+        return pickle.loads(self._read(ref['job_id'], ref['key']))
+
+    @abstractmethod
+    def delete_job(self, job_id:str):
+        """Removes every value of a finished job."""
+
+    @abstractmethod
+    def _write(self, job_id:str, key:str, data:bytes):
+        """Stores the pickled value of a job under `key`."""
+
+    @abstractmethod
+    def _read(self, job_id:str, key:str) -> bytes:
+        """Pickled value of a job, KeyError when there is none."""
+
+
+class FileManifestStore(JobManifestStore):
+    """
+    One file per value under `root`, for workers sharing a volume with each other (and the API).
+    Jobs none of whose values were written for `ttl` seconds are swept whenever a new job starts
+    or a job is deleted, so failed and abandoned jobs don't pile up.
+    """
+
+    def __init__(self, root:str, ttl:int=0):
+        self.root = root
+        self.ttl = ttl
+
+    def _path(self, job_id:str, key:str) -> str:
+        return os.path.join(self.root, job_id, f"{key}.pkl")
+
+    def _write(self, job_id:str, key:str, data:bytes):
+        path = self._path(job_id, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            self.sweep_expired()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, a retried task never reads a half written value
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, job_id:str, key:str) -> bytes:
+        try:
+            with open(self._path(job_id, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # also what a worker sees when the value was written on another node
+            raise KeyError(f"{job_id}/{key} not found under {self.root}, workers on several nodes need JOB_MANIFEST_BACKEND=redis")
+
+    def delete_job(self, job_id:str):
+        shutil.rmtree(os.path.join(self.root, str(job_id)), ignore_errors=True)
+        self.sweep_expired()
+
+    def sweep_expired(self) -> int:
+        """Removes the jobs whose newest value is older than the TTL, returns how many were removed."""
+        return sweep_stale_job_dirs(self.root, self.ttl)
+
+
+class RedisManifestStore(JobManifestStore):
+    """Values in Redis, for workers on several nodes. Keys expire after `ttl` seconds as a safety net."""
+
+    def __init__(self, url:str, ttl:int):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id:str, key:str='') -> str:
+        return f"job_manifest:{job_id}:{key}"
+
+    def _write(self, job_id:str, key:str, data:bytes):
+        self.client.set(self._key(job_id, key), data, ex=self.ttl or None)
+
+    def _read(self, job_id:str, key:str) -> bytes:
+        data = self.client.get(self._key(job_id, key))
+        if data is None:
+            raise KeyError(f"{job_id}/{key}")
+        return data
+
+    def delete_job(self, job_id:str):
+        keys = list(self.client.scan_iter(match=self._key(job_id, '*')))
+        if keys:
+            self.client.delete(*keys)
+
+
+class MemoryManifestStore(JobManifestStore):
+    """
+    In-process stand-in for tests and single process (solo pool, eager) runs. Values never leave
+    the process, a reference the API stores can't be read by a worker.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _write(self, job_id:str, key:str, data:bytes):
+        with self._lock:
+            self._values[(job_id, key)] = data
+
+    def _read(self, job_id:str, key:str) -> bytes:
+        with self._lock:
+            return self._values[(job_id, key)]
+
+    def delete_job(self, job_id:str):
+        with self._lock:
+            for stored in [stored for stored in self._values if stored[0] == str(job_id)]:
+                del self._values[stored]
+
+
+@lru_cache()
+def get_manifest_store():
+    """Returns the process wide store selected by JOB_MANIFEST_BACKEND, None when it is 'none'."""
+    settings = get_settings()
+    backend = settings.JOB_MANIFEST_BACKEND
+    if backend == 'none':
+        return None
+    if backend == 'redis':
+        return RedisManifestStore(settings.JOB_MANIFEST_REDIS_URL, settings.JOB_MANIFEST_TTL_SEC)
+    if backend == 'memory':
+        return MemoryManifestStore()
+    if backend == 'file':
+        return FileManifestStore(settings.JOB_MANIFEST_DIR, settings.JOB_MANIFEST_TTL_SEC)
+    raise ValueError(f"Unknown JOB_MANIFEST_BACKEND {backend}, expected file, redis, memory or none")
+
+
+def is_manifest_ref(value) -> bool:
+    return isinstance(value, dict) and value.get(MANIFEST_REF_KEY) is True
+
+
+def store_manifest(job_id:str, key:str, value):
+    """Stores a task payload and returns its reference, or the value itself when the store is disabled."""
+    store = get_manifest_store()
+    if store is None or not job_id:
+        return value
+    return store.put(job_id, key, value)
+
+
+def load_manifest(value):
+    """Resolves a reference produced by `store_manifest`, anything else (inline payloads) is returned as is."""
+    if not is_manifest_ref(value):
+        return value
+    store = get_manifest_store()
+    if store is None:
+        raise ValueError(f"Received manifest reference {value['job_id']}/{value['key']} but JOB_MANIFEST_BACKEND is 'none'")
+    return store.get(value)
+
+
+def delete_job_manifests(job_id:str):
+    store = get_manifest_store()
+    if store is not None and job_id:
+        store.delete_job(str(job_id))
+
+
+def task_job_id(task) -> str:
+    """Job of a task, the root of its chain, the same for every stage and across retries."""
+    return getattr(task.request, 'root_id', None) or task.request.id
@@ -0,0 +1,45 @@
+import os
+try:
+    import resource
+except ImportError:
+    # Windows development setups have no resource module
+    resource = None
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process right now, in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 1024 / 1024
+    except (OSError, IndexError, ValueError):
+        # no procfs, the peak is the closest figure available
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    Highest resident set size this process reached, in MB, the figure the prefork pool compares
+    with worker_max_memory_per_child. 0 when the platform doesn't report it.
+    """
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_uss_mb() -> float:
+    """
+    Memory private to this process (USS) right now, in MB. Pages a prefork child still shares
+    copy-on-write with its parent (the preloaded models) are left out, RSS counts them in every
+    child. Falls back to RSS when procfs doesn't report it.
+    """
+    private_kb = 0
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    private_kb += int(line.split()[1])
+    except (OSError, IndexError, ValueError):
+        return current_rss_mb()
+    return private_kb / 1024 if private_kb else current_rss_mb()
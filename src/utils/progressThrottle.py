@@ -0,0 +1,21 @@
+import time
+
+
+class ProgressThrottle:
+    """
+    Forwards (done, total) progress to `report` at most once every `interval_sec`, and always for
+    the last item, so tasks processing many small items don't write the result backend per item.
+    """
+
+    def __init__(self, report, total:int, interval_sec:float=1.0):
+        self.report = report
+        self.total = total
+        self.interval_sec = interval_sec
+        self._last_report = None
+
+    def update(self, done:int):
+        now = time.monotonic()
+        if done < self.total and self._last_report is not None and now - self._last_report < self.interval_sec:
+            return
+        self._last_report = now
+        self.report(done, self.total)
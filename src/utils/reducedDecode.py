@@ -0,0 +1,84 @@
+import io
+import math
+import cv2
+import numpy as np
+from PIL import Image
+
+# cv2 flags that let libjpeg scale the DCT blocks while decoding, keyed by the reduction factor
+CV2_REDUCED_COLOR_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def draft_size(size:tuple, min_side:int) -> tuple:
+    """Returns the smallest (width, height) with the image aspect ratio whose shorter side is at least `min_side`."""
+    width, height = size
+    shorter_side = min(width, height)
+    # integer ceiling division, a float scale can overshoot the target by a pixel
+    return -(-width * min_side // shorter_side), -(-height * min_side // shorter_side)
+
+
+def scale_boxes(boxes:list, from_shape:tuple, to_shape:tuple) -> list:
+    """Maps (x1, y1, x2, y2) boxes found on an image of `from_shape` onto the same image decoded at `to_shape`."""
+    scale_y, scale_x = to_shape[0] / from_shape[0], to_shape[1] / from_shape[1]
+    if scale_y == 1 and scale_x == 1:
+        return list(boxes)
+    return [
+        (int(x1 * scale_x), int(y1 * scale_y), int(math.ceil(x2 * scale_x)), int(math.ceil(y2 * scale_y)))
+        for x1, y1, x2, y2 in boxes
+    ]
+
+
+def apply_draft(image_pillow_obj, min_side:int, mode:str='RGB'):
+    """
+    Configures an opened, not yet loaded, PIL image to decode at a reduced resolution.
+
+    For JPEGs `draft` picks the largest 1/2, 1/4 or 1/8 DCT scale that still keeps the shorter side
+    at least `min_side` pixels, so the full resolution image is never materialised. Other formats
+    and a `min_side` of 0 decode at full resolution.
+
+    Returns:
+        The same image object, for chaining.
+    """
+    if min_side and min_side > 0 and min(image_pillow_obj.size) > min_side:
+        image_pillow_obj.draft(mode, draft_size(image_pillow_obj.size, min_side))
+    return image_pillow_obj
+
+
+def open_reduced(source, min_side:int, mode:str='RGB'):
+    """
+    Opens and decodes an image at the smallest resolution that still satisfies `min_side`.
+
+    Args:
+        source (str | bytes | file object): Path, raw bytes or an open binary file.
+        min_side (int): Minimum length of the shorter side the consumer needs, 0 for full resolution.
+        mode (str): PIL mode of the returned image.
+
+    Returns:
+        PIL.Image.Image: The decoded image converted to `mode`.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    with Image.open(source) as image_pil:
+        return apply_draft(image_pil, min_side, mode).convert(mode)
+
+
+def decode_reduced_cv2(image_data:bytes, min_side:int):
+    """
+    cv2 counterpart of `open_reduced`, returns a BGR array decoded with `IMREAD_REDUCED_COLOR_*`.
+
+    Only the image header is parsed (through PIL, lazily) to choose the reduction factor.
+    """
+    nparr = np.frombuffer(image_data, np.uint8)
+    flag = cv2.IMREAD_COLOR
+    if min_side and min_side > 0:
+        with Image.open(io.BytesIO(image_data)) as image_pil:
+            shorter_side = min(image_pil.size)
+        for factor, reduced_flag in CV2_REDUCED_COLOR_FLAGS.items():
+            if shorter_side // factor >= min_side:
+                flag = reduced_flag
+                break
+    return cv2.imdecode(nparr, flag)
@@ -0,0 +1,49 @@
+import os
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """
+    Records how long each startup phase of a process takes, so slow cold starts can be traced
+    to the imports or the model loads that cause them.
+    """
+
+    def __init__(self, process_name:str):
+        self.process_name = process_name
+        self.started_at = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name:str):
+        """Times the wrapped block as one phase."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def record(self, name:str, seconds:float):
+        self.phases[name] = round(self.phases.get(name, 0.0) + seconds, 3)
+
+    def report(self, model_load_times:dict=None) -> dict:
+        """
+        Returns:
+            dict: seconds per phase, per loaded model and in total since the timer was created.
+        """
+        return {
+            'process': self.process_name,
+            'pid': os.getpid(),
+            'phases': dict(self.phases),
+            'models': dict(model_load_times or {}),
+            'total': round(time.perf_counter() - self.started_at, 3),
+        }
+
+    def print_report(self, model_load_times:dict=None) -> dict:
+        report = self.report(model_load_times)
+        print(f"Startup of {report['process']} (pid {report['pid']}) took {report['total']}s")
+        for name, seconds in report['phases'].items():
+            print(f"  {name}: {seconds}s")
+        for name, seconds in report['models'].items():
+            print(f"  model {name}: {seconds}s")
+        return report
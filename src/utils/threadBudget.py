@@ -0,0 +1,104 @@
+import os
+import sys
+
+# Environment variables read by the OpenMP / BLAS runtimes and TensorFlow when they initialise
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+# Budget applied in this process, None until apply_thread_budget runs
+_current_budget = None
+
+
+def compute_thread_budget(processes:int, cores:int=None, threads_per_process:int=0) -> dict:
+    """
+    Splits the cores of the node between the worker processes.
+
+    Args:
+        processes (int): Worker processes running tasks at the same time on this node.
+        cores (int): Available cores, by default the ones this process may run on.
+        threads_per_process (int): Explicit budget per process, 0 divides the cores evenly.
+
+    Returns:
+        dict: the budget of one process, intra-op threads for every library plus the inputs it came from.
+    """
+    if cores is None:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    processes = max(1, int(processes or 1))
+    threads = int(threads_per_process or 0) or max(1, cores // processes)
+    return {
+        'cores': cores,
+        'processes': processes,
+        'threads': threads,
+        'torch_intra_op': threads,
+        'torch_inter_op': 1,
+        'tf_intra_op': threads,
+        'tf_inter_op': 1,
+        'cv2': threads,
+        'blas': threads,
+    }
+
+
+def apply_env_budget(budget:dict):
+    """
+    Exports the budget to the environment, for runtimes that initialise after this point
+    (TensorFlow is only imported when ResNet50 is loaded) and for child processes.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(budget['blas'])
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(budget['tf_intra_op'])
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(budget['tf_inter_op'])
+
+
+def apply_thread_budget(budget:dict) -> dict:
+    """
+    Applies a budget to every threaded library of this process that is already loaded.
+
+    Returns:
+        dict: the budget, with the libraries it was applied to under 'applied'.
+    """
+    global _current_budget
+    apply_env_budget(budget)
+    applied = ['env']
+
+    import torch
+    torch.set_num_threads(budget['torch_intra_op'])
+    try:
+        torch.set_num_interop_threads(budget['torch_inter_op'])
+    except RuntimeError:
+        # only allowed before the first inter-op parallel work of the process
+        pass
+    applied.append('torch')
+
+    try:
+        import cv2
+        cv2.setNumThreads(budget['cv2'])
+        applied.append('cv2')
+    except ImportError:
+        pass
+
+    # TensorFlow reads the env vars above when it starts, it is configured here only if already imported
+    if 'tensorflow' in sys.modules:
+        try:
+            tf = sys.modules['tensorflow']
+            tf.config.threading.set_intra_op_parallelism_threads(budget['tf_intra_op'])
+            tf.config.threading.set_inter_op_parallelism_threads(budget['tf_inter_op'])
+            applied.append('tensorflow')
+        except RuntimeError:
+            # TensorFlow refuses once its runtime is initialised
+            pass
+
+    # NumPy's BLAS pool is sized when numpy is imported, threadpoolctl resizes it afterwards
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(budget['blas'])
+        applied.append('blas')
+    except ImportError:
+        pass
+
+    _current_budget = {**budget, 'applied': applied}
+    print(f"Thread budget (pid {os.getpid()}): {_current_budget}")
+    return _current_budget
+
+
+def current_thread_budget() -> dict:
+    """Budget applied in this process, reported with task results, empty when none was applied."""
+    return dict(_current_budget) if _current_budget else {}
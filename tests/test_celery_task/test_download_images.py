@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("celery")
+from src.services.Culling.tasks import cullingTask
+
+
+class FakeClient:
+    def __init__(self):
+        self.keys = []
+
+    def download_file(self, bucket, key, local_path, Config=None):
+        self.keys.append(key)
+        with open(local_path, 'w') as f:
+            f.write(key)
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    presigned = []
+
+    def download_presigned_image(image_url, local_path):
+        presigned.append(image_url)
+        with open(local_path, 'w') as f:
+            f.write('presigned')
+
+    client = FakeClient()
+    monkeypatch.setattr(cullingTask.s3_utils, 'bucket_name', 'smart-cull')
+    monkeypatch.setattr(cullingTask.s3_utils, 'client', client)
+    monkeypatch.setattr(cullingTask, 'download_presigned_image', download_presigned_image)
+    monkeypatch.setattr(cullingTask, 'settings', SimpleNamespace(S3_KEY_DOWNLOADS_ENABLED=True, S3_DOWNLOAD_CONCURRENCY=4, S3_DOWNLOAD_PROGRESS_INTERVAL_SEC=0))
+    return SimpleNamespace(keys=client.keys, presigned=presigned)
+
+
+def test_images_of_other_buckets_fall_back_to_their_presigned_url(downloads, tmp_path):
+    urls = [
+        'https://smart-cull.s3.amazonaws.com/user/event/a.jpg?X-Amz-Signature=abc',
+        'https://other.s3.amazonaws.com/user/event/b.jpg?X-Amz-Signature=def',
+        'https://s3.amazonaws.com/smart-cull/user/event/c.png',
+    ]
+    task = SimpleNamespace(update_state=lambda **kwargs: None)
+
+    images = cullingTask.download_images(task, urls, str(tmp_path))
+
+    assert sorted(downloads.keys) == ['user/event/a.jpg', 'user/event/c.png']
+    assert downloads.presigned == [urls[1]]
+    assert [image['url'] for image in images] == urls
+    assert [image['content_type'] for image in images] == ['image/jpg', 'image/jpg', 'image/png']
+    assert all(image['size'] > 0 for image in images)
+
+
+def test_key_downloads_can_be_turned_off(downloads, tmp_path, monkeypatch):
+    monkeypatch.setattr(cullingTask.settings, 'S3_KEY_DOWNLOADS_ENABLED', False)
+    urls = ['https://smart-cull.s3.amazonaws.com/user/event/a.jpg']
+
+    cullingTask.download_images(SimpleNamespace(update_state=lambda **kwargs: None), urls, str(tmp_path))
+
+    assert downloads.keys == [] and downloads.presigned == urls
+
+
+def test_same_named_images_get_separate_local_files(downloads, tmp_path):
+    urls = ['https://smart-cull.s3.amazonaws.com/user/cam1/IMG_0001.jpg', 'https://smart-cull.s3.amazonaws.com/user/cam2/IMG_0001.jpg']
+
+    images = cullingTask.download_images(SimpleNamespace(update_state=lambda **kwargs: None), urls, str(tmp_path))
+
+    assert [image['name'] for image in images] == ['IMG_0001.jpg', 'IMG_0001.jpg']
+    assert [open(image['local_path']).read() for image in images] == ['user/cam1/IMG_0001.jpg', 'user/cam2/IMG_0001.jpg']
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("celery")
+from src.Celery import signals
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    def apply(memory_mb=0, tasks=0):
+        monkeypatch.setattr(signals, 'settings', SimpleNamespace(CELERY_MAX_MEMORY_PER_CHILD_MB=memory_mb, CELERY_MAX_TASKS_PER_CHILD=tasks))
+    return apply
+
+
+def test_memory_ceiling_applies_to_growth_beyond_the_shared_models(limits):
+    limits(memory_mb=1000)
+
+    # 3000 MB of preloaded models shared at fork, 800 MB of the child's own
+    assert signals.recycle_reason(3800, 1, shared_rss=3000) is None
+    assert 'ceiling' in signals.recycle_reason(4100, 1, shared_rss=3000)
+    assert 'ceiling' in signals.recycle_reason(1100, 1)
+
+
+def test_task_count_limit(limits):
+    limits(tasks=5)
+
+    assert signals.recycle_reason(100, 4) is None
+    assert 'limit of 5 tasks' in signals.recycle_reason(100, 5)
+
+
+def test_disabled_limits_never_recycle(limits):
+    limits()
+
+    assert signals.recycle_reason(10 ** 6, 10 ** 6) is None
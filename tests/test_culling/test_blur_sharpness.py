@@ -0,0 +1,24 @@
+import numpy as np
+from PIL import Image, ImageFilter
+from src.services.Culling.blurSharpness import cascade_labels, laplacian_variance, sharpness_scores
+
+
+def checkerboard(size=256, square=8):
+    pattern = ((np.arange(size)[:, None] // square + np.arange(size)[None, :] // square) % 2) * 255
+    return Image.fromarray(pattern.astype(np.uint8)).convert('RGB')
+
+
+def test_laplacian_variance_is_zero_for_flat_image():
+    assert laplacian_variance(np.full((64, 64), 128, dtype=np.float32)) == 0.0
+
+
+def test_blurring_lowers_sharpness_score():
+    sharp = checkerboard()
+    blurred = sharp.filter(ImageFilter.GaussianBlur(radius=4))
+    sharp_score, blurred_score = sharpness_scores([sharp, blurred])
+    assert sharp_score > blurred_score * 10
+
+
+def test_cascade_labels_leave_ambiguous_band_to_model():
+    labels = cascade_labels([5.0, 100.0, 900.0], blurred_below=30.0, sharp_above=600.0)
+    assert labels == ['blurred', None, 'undistorted']
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from src.services.Culling.duplicateSimilarity import (DisjointSet, find_duplicate_clusters, find_duplicate_indices,
+                                                     iter_similar_pairs, normalize_features)
+
+
+def brute_force_duplicates(features, threshold):
+    normalized = normalize_features(features)
+    duplicates = set()
+    for i in range(len(normalized)):
+        for j in range(i + 1, len(normalized)):
+            if float(normalized[i] @ normalized[j]) > threshold:
+                duplicates.update((i, j))
+    return duplicates
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(7)
+    base = rng.normal(size=(40, 64)).astype(np.float32)
+    # plant a few near-copies so there is something to find
+    near_copies = base[[3, 11, 25]] + rng.normal(scale=0.01, size=(3, 64)).astype(np.float32)
+    return np.vstack([base, near_copies])
+
+
+@pytest.mark.parametrize("max_block_mb", [1e-6, 0.001, 64])
+def test_blockwise_matches_brute_force(features, max_block_mb):
+    expected = brute_force_duplicates(features, threshold=0.9)
+    assert expected == {3, 11, 25, 40, 41, 42}
+    assert find_duplicate_indices(features, threshold=0.9, max_block_mb=max_block_mb) == expected
+
+
+def test_only_upper_triangle_pairs_are_reported(features):
+    for _, pair_i, pair_j in iter_similar_pairs(features, threshold=0.9, max_block_mb=0.001):
+        assert np.all(pair_j > pair_i)
+
+
+def test_zero_vectors_are_never_duplicates():
+    features = np.zeros((3, 8), dtype=np.float32)
+    assert find_duplicate_indices(features, threshold=0.5) == set()
+
+
+def test_disjoint_set_merges_transitive_pairs():
+    disjoint_set = DisjointSet(6)
+    disjoint_set.union_pairs([0, 1, 4], [1, 2, 5])
+    assert sorted(sorted(cluster) for cluster in disjoint_set.clusters()) == [[0, 1, 2], [4, 5]]
+
+
+def test_exact_clusters_cover_the_duplicate_set(features):
+    clusters = find_duplicate_clusters(features, threshold=0.9)
+    assert {idx for cluster in clusters for idx in cluster} == brute_force_duplicates(features, threshold=0.9)
+    assert sorted(sorted(cluster) for cluster in clusters) == [[3, 40], [11, 41], [25, 42]]
+
+
+def test_ann_clusters_match_exact_search(features):
+    exact = find_duplicate_clusters(features, threshold=0.9)
+    approximate = find_duplicate_clusters(features, threshold=0.9, ann_min_images=10, ann_neighbours=5)
+    assert sorted(map(sorted, approximate)) == sorted(map(sorted, exact))
+
+
+def test_time_window_only_compares_burst_neighbours(features):
+    # every near-copy (40, 41, 42) is shot right after its original, except 42 which is an hour later
+    capture_times = [float(idx * 100) for idx in range(len(features))]
+    capture_times[40], capture_times[41], capture_times[42] = 301.0, 1101.0, 3600.0 * 5
+    clusters = find_duplicate_clusters(features, threshold=0.9, capture_times=capture_times, time_window_sec=5)
+    assert sorted(map(sorted, clusters)) == [[3, 40], [11, 41]]
+
+
+def test_time_window_respects_camera_bodies(features):
+    capture_times = [0.0] * len(features)
+    camera_ids = ["body-a"] * len(features)
+    camera_ids[41] = "body-b"
+    clusters = find_duplicate_clusters(features, threshold=0.9, capture_times=capture_times, time_window_sec=1, camera_ids=camera_ids)
+    assert sorted(map(sorted, clusters)) == [[3, 40], [25, 42]]
+
+
+@pytest.mark.parametrize("untimed_full_scan, expected", [(True, [[3, 40], [11, 41], [25, 42]]), (False, [[25, 42]])])
+def test_untimed_images_fall_back(features, untimed_full_scan, expected):
+    capture_times = [None] * len(features)
+    clusters = find_duplicate_clusters(
+        features, threshold=0.9, capture_times=capture_times, time_window_sec=5,
+        untimed_full_scan=untimed_full_scan, file_order_window=20,
+    )
+    assert sorted(map(sorted, clusters)) == expected
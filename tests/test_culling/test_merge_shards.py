@@ -0,0 +1,73 @@
+import asyncio
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from src.services.Culling import fusedCulling
+from src.services.Culling.stageCheckpoint import StageCheckpoint, record_duplicate_decisions
+
+
+def shard(names:list, content_hashes:list, tiers:dict, seed:int) -> dict:
+    rng = np.random.default_rng(seed)
+    return {
+        'images_metadata': [{'id': f"blurred__{names[0]}"}],
+        'image_features': [
+            {'name': name, 'content_hash': digest, 'dhash_thumbnail': rng.integers(0, 255, size=(8, 9), dtype=np.uint8)}
+            for name, digest in zip(names, content_hashes)
+        ],
+        'blur_tiers': tiers,
+    }
+
+
+@pytest.fixture
+def fake_search(monkeypatch):
+    searched = {}
+
+    def find_embedding_duplicates(image_features, task, progress_offset=0, progress_span=0):
+        searched['names'] = [image['name'] for image in image_features]
+        return set()
+
+    async def upload_duplicate_results(image_features, duplicates, *args, **kwargs):
+        return [{'id': image['name'], 'duplicate': idx in duplicates} for idx, image in enumerate(image_features)]
+
+    monkeypatch.setattr(fusedCulling, 'settings', SimpleNamespace(DUPLICATE_HASH_PREFILTER=True, DUPLICATE_HASH_MAX_DISTANCE=3))
+    monkeypatch.setattr(fusedCulling, 'find_embedding_duplicates', find_embedding_duplicates)
+    monkeypatch.setattr(fusedCulling, 'upload_duplicate_results', upload_duplicate_results)
+    return searched
+
+
+def test_shards_are_merged_and_searched_for_duplicates_together(fake_search):
+    # a.jpg of the first shard was uploaded again in the second one
+    shards = [
+        shard(['a.jpg', 'b.jpg'], ['h-a', 'h-b'], {'sharp': 2, 'blurred': 1}, seed=1),
+        shard(['c.jpg', 'a-copy.jpg'], ['h-c', 'h-a'], {'sharp': 1, 'soft': 3}, seed=2),
+    ]
+    fetched = []
+
+    merged = asyncio.run(fusedCulling.merge_shard_results(
+        shards, 'user', 'folder', 1, S3_util_obj=None, task=None, fetch_missing=fetched.extend
+    ))
+
+    assert fake_search['names'] == ['a.jpg', 'b.jpg', 'c.jpg', 'a-copy.jpg']
+    assert [image['name'] for image in fetched] == fake_search['names']
+    assert merged['images_metadata'][:2] == [{'id': 'blurred__a.jpg'}, {'id': 'blurred__c.jpg'}]
+    assert {item['id'] for item in merged['images_metadata'][2:] if item['duplicate']} == {'a.jpg', 'a-copy.jpg'}
+    assert merged['blur_tiers'] == {'sharp': 3, 'blurred': 1, 'soft': 3}
+    assert merged['shards'] == 2 and merged['status'] == 'SUCCESS'
+
+
+def test_resumed_uploads_only_restore_images_not_uploaded_yet(fake_search, tmp_path):
+    features = [{'name': name, 'local_path': None, 'content_type': 'image/jpg', 'url': f'https://bucket/{name}'} for name in ['a.jpg', 'b.jpg', 'c.jpg']]
+    decisions = StageCheckpoint('job', 'duplicate_decisions', checkpoint_dir=str(tmp_path))
+    record_duplicate_decisions(decisions, features, {0, 1})
+    uploads = StageCheckpoint('job', 'duplicate', checkpoint_dir=str(tmp_path))
+    uploads.record('0', 'Duplicate', metadata={'id': 'a.jpg'})
+    restored = []
+
+    asyncio.run(fusedCulling.merge_duplicates(
+        [], 'user', 'folder', 1, S3_util_obj=None, task=None,
+        checkpoint=uploads, decision_checkpoint=decisions, restore_images=restored.extend
+    ))
+
+    assert [image['name'] for image in restored] == ['b.jpg', 'c.jpg']
@@ -0,0 +1,23 @@
+import numpy as np
+from PIL import Image
+from src.services.Culling.perceptualHash import dhash_batch, dhash_thumbnail, find_hash_duplicate_groups, hamming_distances
+
+
+def test_resized_copy_keeps_its_dhash():
+    rng = np.random.default_rng(3)
+    original = Image.fromarray(rng.integers(0, 255, size=(300, 400, 3), dtype=np.uint8))
+    other = Image.fromarray(rng.integers(0, 255, size=(300, 400, 3), dtype=np.uint8))
+    hashes = dhash_batch([dhash_thumbnail(image) for image in (original, original.resize((200, 150)), other)])
+    distances = hamming_distances(hashes[0], hashes)
+    assert distances[1] <= 3 < distances[2]
+
+
+def test_groups_identical_bytes_and_close_hashes():
+    rng = np.random.default_rng(5)
+    hashes = rng.integers(0, 2 ** 63, size=50, dtype=np.uint64)
+    hashes[20] = hashes[4] ^ np.uint64(0b111)       # 3 bits away, near-exact copy
+    hashes[30] = hashes[8] ^ np.uint64(0b11111)     # 5 bits away, too far for max_distance=3
+    content_hashes = [str(idx) for idx in range(50)]
+    content_hashes[45] = content_hashes[12]          # byte identical re-upload
+    groups = find_hash_duplicate_groups(content_hashes, hashes, max_distance=3)
+    assert sorted(map(sorted, groups)) == [[4, 20], [12, 45]]
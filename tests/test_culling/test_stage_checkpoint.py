@@ -0,0 +1,57 @@
+import os
+import time
+from datetime import datetime
+from src.services.Culling.stageCheckpoint import StageCheckpoint, record_duplicate_decisions, resume_duplicate_decisions, sweep_stale_checkpoints
+
+
+def test_retried_stage_resumes_with_recorded_outcomes(tmp_path):
+    images = [{'name': f'{i}.jpg', 'local_path': f'/tmp/{i}.jpg', 'content_type': 'image/jpg'} for i in range(3)]
+    metadata = {'id': 'abc__0.jpg', 'image_download_validity': datetime(2024, 1, 1, 12, 30)}
+
+    checkpoint = StageCheckpoint('job', 'blur', checkpoint_dir=str(tmp_path))
+    pending = checkpoint.remaining(images)
+    checkpoint.record(pending[0]['checkpoint_key'], 'blurred', metadata=metadata)
+    checkpoint.record(pending[1]['checkpoint_key'], 'sharp', image=images[1])
+
+    resumed = StageCheckpoint('job', 'blur', checkpoint_dir=str(tmp_path))
+    assert resumed.remaining(images) == [{**images[2], 'checkpoint_key': '2'}]
+    assert resumed.completed('blurred')[0]['metadata'] == metadata
+    assert resumed.completed('sharp')[0]['image'] == images[1]
+
+
+def test_same_named_images_keep_separate_records(tmp_path):
+    # two cameras uploaded a file with the same name
+    images = [{'name': 'IMG_0001.jpg', 'local_path': '/tmp/cam1/IMG_0001.jpg', 'content_type': 'image/jpg'},
+              {'name': 'IMG_0001.jpg', 'local_path': '/tmp/cam2/IMG_0001.jpg', 'content_type': 'image/jpg'}]
+
+    checkpoint = StageCheckpoint('job', 'blur', checkpoint_dir=str(tmp_path))
+    first = checkpoint.remaining(images)[0]
+    checkpoint.record(first['checkpoint_key'], 'sharp', image=images[0])
+
+    resumed = StageCheckpoint('job', 'blur', checkpoint_dir=str(tmp_path))
+    assert [image['local_path'] for image in resumed.remaining(images)] == ['/tmp/cam2/IMG_0001.jpg']
+    assert [record['image'] for record in resumed.completed('sharp')] == [images[0]]
+
+
+def test_duplicate_decisions_round_trip(tmp_path):
+    # two different images with the same file name keep separate decisions
+    features = [{'name': 'a.jpg', 'local_path': '/tmp/a.jpg', 'content_type': 'image/jpg', 'features': None},
+                {'name': 'b.jpg', 'local_path': '/tmp/b.jpg', 'content_type': 'image/jpg', 'features': None},
+                {'name': 'b.jpg', 'local_path': '/tmp/cam2/b.jpg', 'content_type': 'image/jpg', 'features': None}]
+    checkpoint = StageCheckpoint('job', 'duplicate_decisions', checkpoint_dir=str(tmp_path))
+    assert resume_duplicate_decisions(checkpoint) is None
+
+    record_duplicate_decisions(checkpoint, features, {1})
+    image_features, duplicates = resume_duplicate_decisions(StageCheckpoint('job', 'duplicate_decisions', checkpoint_dir=str(tmp_path)))
+    assert [image['local_path'] for image in image_features] == ['/tmp/a.jpg', '/tmp/b.jpg', '/tmp/cam2/b.jpg']
+    assert duplicates == {1}
+
+
+def test_sweep_removes_only_stale_jobs(tmp_path):
+    StageCheckpoint('stale', 'blur', checkpoint_dir=str(tmp_path)).record('0.jpg', 'sharp')
+    StageCheckpoint('active', 'blur', checkpoint_dir=str(tmp_path)).record('0.jpg', 'sharp')
+    old = time.time() - 3600
+    os.utime(tmp_path / 'stale' / 'blur.jsonl', (old, old))
+
+    assert sweep_stale_checkpoints(str(tmp_path), max_age_sec=600) == 1
+    assert sorted(os.listdir(tmp_path)) == ['active']
@@ -0,0 +1,57 @@
+import asyncio
+import io
+from types import SimpleNamespace
+import pytest
+
+botocore_exceptions = pytest.importorskip("botocore.exceptions")
+from src.services.Culling import storeCulledImage
+
+
+class FakeS3:
+    def __init__(self, copy_error=None):
+        self.copy_error = copy_error
+        self.copied = []
+        self.uploaded = []
+
+    def key_from_url(self, url):
+        return url.split('/', 3)[-1]
+
+    async def copy_smart_cull_image(self, source_key, root_folder, main_folder, upload_image_folder, filename):
+        if self.copy_error:
+            raise self.copy_error
+        self.copied.append((source_key, upload_image_folder, filename))
+
+    async def upload_smart_cull_images(self, root_folder, main_folder, upload_image_folder, image_data, filename):
+        self.uploaded.append((upload_image_folder, filename, image_data.read()))
+
+
+def store(S3_util_obj, read_image_data):
+    image_info = {'name': 'a.jpg', 'url': 'https://bucket.s3.amazonaws.com/user/folder/before/a.jpg'}
+    return asyncio.run(storeCulledImage.store_culled_image(
+        image_info, S3_util_obj, 'user', 'folder', 'Blur', 'abc__a.jpg', read_image_data
+    ))
+
+
+@pytest.fixture(autouse=True)
+def copy_mode(monkeypatch):
+    monkeypatch.setattr(storeCulledImage, 'settings', SimpleNamespace(CULLING_RESULT_MODE='copy'))
+
+
+def test_copy_mode_copies_server_side_without_reading_the_image():
+    S3 = FakeS3()
+
+    def read_image_data():
+        raise AssertionError("the image must not be read for a server side copy")
+
+    assert store(S3, read_image_data) == 'copy'
+    assert S3.copied == [('user/folder/before/a.jpg', 'Blur', 'abc__a.jpg')]
+    assert S3.uploaded == []
+
+
+def test_failed_copy_falls_back_to_upload():
+    missing = botocore_exceptions.ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'gone'}}, 'CopyObject')
+    S3 = FakeS3(copy_error=missing)
+
+    assert store(S3, lambda: io.BytesIO(b'image bytes')) == 'upload'
+    assert S3.copied == []
+    assert S3.uploaded == [('Blur', 'abc__a.jpg', b'image bytes')]
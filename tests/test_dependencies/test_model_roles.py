@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("torch")
+from src.dependencies.mlModelsManager import MODEL_LOADERS, MODEL_ROLES, ModelManager
+
+
+@pytest.mark.parametrize('role', list(MODEL_ROLES))
+def test_each_role_loads_the_models_it_declares(role):
+    assert ModelManager.models_for_roles(role) == list(MODEL_ROLES[role])
+
+
+def test_combined_roles_load_each_model_once():
+    models = ModelManager.models_for_roles(['culling', 'smart_sharing'])
+
+    assert models == ['feature_extractor', 'blur_detect_model', 'closed_eye_detection_model', 'face_detector', 'duplicate_image_detection_model', 'face_net_model']
+    assert ModelManager.models_for_roles('all') == list(MODEL_LOADERS)
+
+
+def test_process_roles_are_read_from_the_setting():
+    assert ModelManager.process_roles(SimpleNamespace(PROCESS_ROLE=' culling, email ')) == ['culling', 'email']
+    assert ModelManager.process_roles(SimpleNamespace(PROCESS_ROLE='')) == []
+
+
+def test_unknown_role_falls_back_to_all_models():
+    roles = ModelManager.process_roles(SimpleNamespace(PROCESS_ROLE='culling,cullng'))
+
+    assert roles == ['all']
+    assert ModelManager.models_for_roles(roles) == list(MODEL_LOADERS)
@@ -0,0 +1,90 @@
+import logging
+from types import SimpleNamespace
+import pytest
+
+torch = pytest.importorskip("torch")
+from src.dependencies import onnxBackend
+
+
+def onnx_settings(**overrides):
+    values = dict(
+        ONNX_MODEL_DIR='/nonexistent/onnx', ONNX_QUANTIZE=True, ONNX_INTRA_OP_THREADS=1,
+        ONNX_PARITY_CHECK=True, ONNX_PARITY_MIN_AGREEMENT=0.9, ONNX_PARITY_SAMPLE_DIR='',
+    )
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+
+def test_parity_ok_thresholds():
+    assert onnxBackend.parity_ok({'label_agreement': 0.95})
+    assert not onnxBackend.parity_ok({'label_agreement': 0.85})
+    assert onnxBackend.parity_ok({'label_agreement': 0.85}, min_label_agreement=0.8)
+    assert onnxBackend.parity_ok({'cosine_min': 0.99})
+    assert not onnxBackend.parity_ok({'cosine_min': 0.9})
+
+
+def test_check_parity_of_identical_models_on_given_inputs():
+    model = torch.nn.Linear(4, 8)
+    inputs = torch.randn(5, 4)
+
+    report = onnxBackend.check_parity('face_net_model', model, model, inputs)
+
+    assert report['samples'] == 5
+    assert report['max_abs_diff'] == 0
+    assert report['cosine_min'] == pytest.approx(1.0)
+
+
+def test_missing_package_keeps_eager_models_and_names_it(monkeypatch, caplog):
+    monkeypatch.setattr(onnxBackend, 'missing_onnx_packages', lambda: ['onnxruntime'])
+    models = {'face_net_model': object()}
+
+    with caplog.at_level(logging.WARNING):
+        converted = onnxBackend.convert_models(models, onnx_settings())
+
+    assert converted == models
+    assert 'onnxruntime' in caplog.text
+
+
+def test_failed_export_keeps_eager_model(monkeypatch, caplog):
+    def failing_export(name, model, onnx_dir, quantize=False):
+        raise RuntimeError("unsupported operator")
+
+    monkeypatch.setattr(onnxBackend, 'missing_onnx_packages', lambda: [])
+    monkeypatch.setattr(onnxBackend, 'export_model', failing_export)
+    eager_model = object()
+
+    with caplog.at_level(logging.WARNING):
+        converted = onnxBackend.convert_models({'face_net_model': eager_model}, onnx_settings())
+
+    assert converted['face_net_model'] is eager_model
+    assert 'unsupported operator' in caplog.text
+
+
+def test_load_sample_images_skips_unreadable_files(tmp_path):
+    from PIL import Image
+
+    Image.new('RGB', (32, 24), 'red').save(tmp_path / 'a.jpg')
+    (tmp_path / 'notes.txt').write_text('not an image')
+
+    images = onnxBackend.load_sample_images(str(tmp_path))
+
+    assert len(images) == 1 and images[0].mode == 'RGB'
+    assert onnxBackend.load_sample_images('') == []
+
+
+class FakeSession:
+    def get_inputs(self):
+        return [SimpleNamespace(name='pixel_values')]
+
+
+def test_cache_tag_follows_the_loaded_model(monkeypatch):
+    from src.dependencies.mlModelsManager import ModelManager
+    from src.utils import inferenceCache
+
+    adapter = onnxBackend.OnnxFaceNet(FakeSession(), 'face_net_model', quantized=True)
+    monkeypatch.setattr(inferenceCache, 'get_settings', lambda: SimpleNamespace(INFERENCE_BACKEND='onnx'))
+    # the blur model stands for one the conversion kept eager
+    monkeypatch.setattr(ModelManager, 'get_model', staticmethod(lambda name, settings=None: adapter if name == 'face_net_model' else object()))
+
+    assert inferenceCache.inference_backend_tag('face_net_model') == 'onnx-int8'
+    assert inferenceCache.inference_backend_tag('blur_detect_model') == 'torch'
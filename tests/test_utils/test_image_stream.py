@@ -0,0 +1,57 @@
+import io
+import os
+from src.utils.imageStream import S3ImageStream, read_image_bytes, release_image
+
+
+class FakeS3:
+    bucket_name = 'bucket'
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.client = self
+
+    def key_from_url(self, url):
+        return url.split('/', 3)[-1]
+
+    def get_object(self, Bucket, Key):
+        data = self.objects[Key]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+
+def test_images_arrive_in_order_and_spill_to_disk_beyond_the_memory_budget(tmp_path):
+    objects = {f"user/folder/{idx}.jpg": bytes([idx]) * 400 * 1024 for idx in range(5)}
+    images = [{'name': key.rsplit('/', 1)[-1], 'url': f"https://s3/{key}"} for key in objects]
+    stream = S3ImageStream(FakeS3(objects), spill_folder=str(tmp_path / 'spill'), memory_budget_mb=1, queue_size=1, max_concurrency=1)
+
+    streamed = list(stream(images))
+
+    assert [image['name'] for image in streamed] == [image['name'] for image in images]
+    assert [read_image_bytes(image) for image in streamed] == list(objects.values())
+    in_memory = [image for image in streamed if 'content' in image]
+    spilled = [image for image in streamed if 'local_path' in image]
+    assert len(in_memory) == 2 and len(spilled) == 3
+
+    for image in streamed:
+        release_image(image)
+    assert stream.budget.held_bytes == 0
+    assert not any(os.path.exists(image['local_path']) for image in spilled)
+    stream.close()
+    assert not os.path.exists(tmp_path / 'spill')
+
+
+def test_failed_images_are_skipped_when_asked(tmp_path):
+    images = [{'name': 'gone.jpg', 'url': 'https://s3/user/gone.jpg'}, {'name': 'a.jpg', 'url': 'https://s3/user/a.jpg'}]
+    stream = S3ImageStream(FakeS3({'user/a.jpg': b'a'}), spill_folder=str(tmp_path), memory_budget_mb=1, skip_errors=True)
+
+    assert [image['name'] for image in stream(images)] == ['a.jpg']
+
+
+def test_spilled_images_with_the_same_name_keep_their_own_bytes(tmp_path):
+    objects = {'user/a/img.jpg': b'a' * 1024, 'user/b/img.jpg': b'b' * 1024}
+    images = [{'name': 'img.jpg', 'url': f"https://s3/{key}"} for key in objects]
+    stream = S3ImageStream(FakeS3(objects), spill_folder=str(tmp_path), memory_budget_mb=0.0001, max_concurrency=2)
+
+    streamed = list(stream(images))
+
+    assert len({image['local_path'] for image in streamed}) == 2
+    assert [read_image_bytes(image) for image in streamed] == list(objects.values())
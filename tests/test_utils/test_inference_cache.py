@@ -0,0 +1,21 @@
+import numpy as np
+from src.utils.inferenceCache import InferenceCache
+
+
+def test_round_trip_and_hit_miss_counters(tmp_path):
+    cache = InferenceCache(str(tmp_path / 'cache.sqlite3'), max_bytes=10 * 1024 * 1024)
+    cache.put('abc', 'resnet', np.arange(4, dtype=np.float32))
+
+    assert np.array_equal(cache.get('abc', 'resnet'), np.arange(4, dtype=np.float32))
+    assert cache.get('abc', 'blur') is None
+    assert cache.stats()['hits']['resnet'] == 1
+    assert cache.stats()['misses']['blur'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = InferenceCache(str(tmp_path / 'cache.sqlite3'), max_bytes=8 * 1024)
+    cache.put_many({f'old-{idx}': np.zeros(256, dtype=np.float32) for idx in range(InferenceCache.EVICTION_CHECK_INTERVAL - 1)}, 'resnet')
+    cache.put('newest', 'resnet', np.zeros(256, dtype=np.float32))
+
+    assert cache.stats()['entries'] < InferenceCache.EVICTION_CHECK_INTERVAL
+    assert cache.get('newest', 'resnet') is not None
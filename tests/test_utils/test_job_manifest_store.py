@@ -0,0 +1,38 @@
+import os
+import time
+import pytest
+from src.utils.jobManifestStore import FileManifestStore, JobManifestStore, MemoryManifestStore, is_manifest_ref, load_manifest
+
+
+@pytest.mark.parametrize('backend', ['memory', 'file'])
+def test_values_round_trip_by_reference_and_are_deleted_with_their_job(backend, tmp_path):
+    store = MemoryManifestStore() if backend == 'memory' else FileManifestStore(str(tmp_path))
+    images = [{'name': 'a.jpg', 'local_path': '/tmp/a.jpg'}]
+
+    ref = store.put('job-1', 'images', images)
+    assert is_manifest_ref(ref)
+    assert store.get(ref) == images
+
+    store.delete_job('job-1')
+    with pytest.raises(KeyError):
+        store.get(ref)
+
+
+def test_inline_payloads_pass_through():
+    assert load_manifest([{'name': 'a.jpg'}]) == [{'name': 'a.jpg'}]
+
+
+def test_file_store_sweeps_expired_jobs(tmp_path):
+    store = FileManifestStore(str(tmp_path), ttl=600)
+    store.put('abandoned', 'images', [])
+    old = time.time() - 3600
+    os.utime(tmp_path / 'abandoned' / 'images.pkl', (old, old))
+
+    store.put('new-job', 'images', [])
+
+    assert sorted(os.listdir(tmp_path)) == ['new-job']
+
+
+def test_base_store_is_abstract():
+    with pytest.raises(TypeError):
+        JobManifestStore()
@@ -0,0 +1,10 @@
+import sys
+import pytest
+from src.utils.processMemory import current_rss_mb, current_uss_mb
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="procfs")
+def test_private_memory_leaves_out_shared_pages():
+    uss = current_uss_mb()
+
+    assert 0 < uss <= current_rss_mb()
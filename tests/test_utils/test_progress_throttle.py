@@ -0,0 +1,21 @@
+from src.utils.progressThrottle import ProgressThrottle
+
+
+def test_reports_first_and_last_update_and_throttles_the_rest():
+    reports = []
+    progress = ProgressThrottle(lambda done, total: reports.append((done, total)), total=100, interval_sec=3600)
+
+    for done in range(1, 101):
+        progress.update(done)
+
+    assert reports == [(1, 100), (100, 100)]
+
+
+def test_every_update_is_reported_without_interval():
+    reports = []
+    progress = ProgressThrottle(lambda done, total: reports.append(done), total=3, interval_sec=0)
+
+    for done in range(1, 4):
+        progress.update(done)
+
+    assert reports == [1, 2, 3]
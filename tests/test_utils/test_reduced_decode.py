@@ -0,0 +1,54 @@
+import io
+import pytest
+
+pytest.importorskip("cv2")
+from PIL import Image
+from src.utils.reducedDecode import apply_draft, decode_reduced_cv2, draft_size, open_reduced, scale_boxes
+
+
+def jpeg_bytes(size:tuple) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'gray').save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def test_draft_size_keeps_the_aspect_ratio_at_the_target_shorter_side():
+    assert draft_size((4000, 3000), 224) == (299, 224)
+    assert draft_size((3000, 4000), 224) == (224, 299)
+
+
+def test_draft_picks_the_largest_dct_scale_that_stays_above_the_target():
+    # 1500 / 8 would fall below 224, so 1/4 is the largest reduction allowed
+    with Image.open(io.BytesIO(jpeg_bytes((2000, 1500)))) as image:
+        apply_draft(image, 224)
+        image.load()
+        assert image.size == (500, 375)
+
+
+@pytest.mark.parametrize('min_side', [64, 224, 500, 1499])
+def test_decodes_are_never_reduced_below_the_target(min_side):
+    data = jpeg_bytes((2000, 1500))
+
+    assert min(open_reduced(data, min_side).size) >= min_side
+    assert min(decode_reduced_cv2(data, min_side).shape[:2]) >= min_side
+
+
+def test_zero_min_side_decodes_at_full_resolution():
+    data = jpeg_bytes((2000, 1500))
+
+    assert open_reduced(data, 0).size == (2000, 1500)
+    assert decode_reduced_cv2(data, 0).shape[:2] == (1500, 2000)
+
+
+def test_box_rescale_round_trips():
+    data = jpeg_bytes((2000, 1500))
+    reduced_shape = decode_reduced_cv2(data, 224).shape
+    full_shape = decode_reduced_cv2(data, 0).shape
+    boxes = [(10, 20, 60, 90), (100, 150, 180, 260)]
+
+    full_boxes = scale_boxes(boxes, reduced_shape, full_shape)
+    assert full_boxes[0] == (40, 80, 240, 360)
+
+    for box, round_trip in zip(boxes, scale_boxes(full_boxes, full_shape, reduced_shape)):
+        assert all(abs(a - b) <= 1 for a, b in zip(box, round_trip))
+    assert scale_boxes(boxes, full_shape, full_shape) == boxes
@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("fastapi")
+from src.utils.S3Utils import S3Utils
+
+
+class FakeClient:
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+
+    def download_file(self, bucket, key, local_path, Config=None):
+        if key in self.missing:
+            raise FileNotFoundError(key)
+        with open(local_path, 'w') as f:
+            f.write(f"{bucket}/{key}")
+
+
+@pytest.fixture
+def s3():
+    return S3Utils(aws_region='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret', bucket_name='smart-cull', aws_endpoint_url=None)
+
+
+@pytest.mark.parametrize('url, key', [
+    ('https://smart-cull.s3.amazonaws.com/user/event/a.jpg', 'user/event/a.jpg'),
+    ('https://smart-cull.s3.eu-west-1.amazonaws.com/user/event/a.jpg', 'user/event/a.jpg'),
+    ('https://s3.eu-west-1.amazonaws.com/smart-cull/user/event/a.jpg', 'user/event/a.jpg'),
+    ('http://localhost:9000/smart-cull/user/event/a.jpg', 'user/event/a.jpg'),
+    ('https://smart-cull.s3.amazonaws.com/user/my%20event/caf%C3%A9%2B1.jpg', 'user/my event/café+1.jpg'),
+    ('https://smart-cull.s3.amazonaws.com/user/event/a.jpg?X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Expires=3600&X-Amz-Signature=abc', 'user/event/a.jpg'),
+    ('https://s3.amazonaws.com/smart-cull/user/event/a.jpg?X-Amz-Signature=abc%2Fdef', 'user/event/a.jpg'),
+])
+def test_key_from_url_of_the_bucket(s3, url, key):
+    assert s3.key_from_url(url) == key
+
+
+@pytest.mark.parametrize('url', [
+    'https://other.s3.amazonaws.com/user/event/a.jpg',
+    'https://s3.amazonaws.com/other/user/event/a.jpg',
+    'https://other.s3.amazonaws.com/smart-cull/a.jpg',
+    'https://cdn.example.com/a.jpg',
+    'https://smart-cull.s3.amazonaws.com/',
+])
+def test_urls_outside_the_bucket_have_no_key(s3, url):
+    assert s3.key_from_url(url) is None
+
+
+def test_download_objects_keeps_order_and_isolates_failures(s3, tmp_path):
+    s3.client = FakeClient(missing={'user/b.jpg'})
+    objects = [(f'user/{name}', str(tmp_path / name)) for name in ['a.jpg', 'b.jpg', 'c.jpg']]
+    progress = []
+
+    results = asyncio.run(s3.download_objects(objects, max_concurrency=2, progress_callback=lambda done, total: progress.append((done, total))))
+
+    assert [(key, local_path) for key, local_path, _ in results] == objects
+    assert [error is None for _, _, error in results] == [True, False, True]
+    assert (tmp_path / 'c.jpg').read_text() == 'smart-cull/user/c.jpg'
+    assert progress[-1] == (3, 3) and len(progress) == 3
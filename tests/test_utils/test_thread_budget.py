@@ -0,0 +1,14 @@
+from src.utils.threadBudget import compute_thread_budget
+
+
+def test_cores_are_split_between_pool_processes():
+    budget = compute_thread_budget(processes=4, cores=16)
+
+    assert budget['threads'] == 4
+    assert budget['torch_intra_op'] == budget['cv2'] == budget['blas'] == 4
+    assert budget['torch_inter_op'] == budget['tf_inter_op'] == 1
+
+
+def test_every_process_keeps_at_least_one_thread_and_explicit_budget_wins():
+    assert compute_thread_budget(processes=8, cores=2)['threads'] == 1
+    assert compute_thread_budget(processes=2, cores=16, threads_per_process=3)['threads'] == 3